@@ -1,37 +1,168 @@
+import argparse
+import json
+import os
+import sys
 import uuid
 
-from utils.agent import (
-    format_agent_response,
-    get_agent_alias_id_by_name,
-    get_agent_id_by_name,
+# The modules in utils import each other by name, like when running the scripts in
+# there, so they are imported the same way here and every module is loaded only once
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils"))
+
+from botocore.config import Config  # noqa: E402
+
+from agent import (  # noqa: E402
+    AgentEventDecoder,
+    format_agent_event,
+    resolve_agent_ids,
+)
+from batch import BATCH_CONCURRENCY, BATCH_RATE_LIMIT, run_batch  # noqa: E402
+from config.aws_clients import (  # noqa: E402
+    bedrock_agent_client,
+    bedrock_agent_runtime_client,
+    get_client,
+    get_session,
 )
-from utils.config.aws_clients import bedrock_agent_client, bedrock_agent_runtime_client
-from utils.config.constants import AGENT_ALIAS_NAME, AGENT_NAME
+from config.constants import (  # noqa: E402
+    AGENT_ALIAS_NAME,
+    AGENT_NAME,
+    GLUE_DATABASE_NAME,
+    SCHEMA_DIGEST_IN_INSTRUCTION,
+    SCHEMA_DIGEST_KEY,
+    resolve,
+)
+from profiler import AgentProfiler, format_waterfall, to_otel_spans  # noqa: E402
+from schema import load_schema_digest  # noqa: E402
+from session import SessionManager  # noqa: E402
+
+
+def invoke_text_to_sql(
+    query,
+    agent_id,
+    agent_alias_id,
+    profile=False,
+    otel_file=None,
+    session_manager=None,
+):
+    session_id, session_state = (
+        session_manager.next_turn() if session_manager else (str(uuid.uuid4()), {})
+    )
+    decoder = AgentEventDecoder()
+    profiler = AgentProfiler()
+    try:
+        agent_response = bedrock_agent_runtime_client.invoke_agent(
+            inputText=query,
+            agentId=agent_id,
+            agentAliasId=agent_alias_id,
+            sessionId=session_id,
+            sessionState=session_state,
+            enableTrace=True,
+        )
+
+        for event in agent_response.get("completion"):
+            for agent_event in decoder.decode(event):
+                profiler.add(agent_event)
+                if formatted_response := format_agent_event(agent_event):
+                    print(formatted_response)
+    except Exception:
+        # Starts over with a new session in case this one got invalid
+        if session_manager:
+            session_manager.reset()
+        raise
+
+    if profile:
+        print(format_waterfall(profiler.waterfall()))
+
+    if otel_file:
+        otel_file.write(json.dumps(to_otel_spans(profiler.waterfall(), query)) + "\n")
+        otel_file.flush()
 
 
-def invoke_text_to_sql(query, agent_id, agent_alias_id):
-    agent_response = bedrock_agent_runtime_client.invoke_agent(
-        inputText=query,
-        agentId=agent_id,
-        agentAliasId=agent_alias_id,
-        sessionId=str(uuid.uuid4()),
-        enableTrace=True,
+def load_schema():
+    # The agent instruction holds the digest instead, initialize_environment.py
+    # updates it after the crawl
+    if SCHEMA_DIGEST_IN_INSTRUCTION:
+        return None
+
+    # Clients are fetched here, so that the batch mode doesn't create them
+    return load_schema_digest(
+        get_client("glue"),
+        get_client("s3"),
+        GLUE_DATABASE_NAME,
+        resolve("BUCKET_NAME"),
+        SCHEMA_DIGEST_KEY,
     )
 
-    for event in agent_response.get("completion"):
-        if formatted_response := format_agent_response(event):
-            print(formatted_response)
+
+def invoke_batch(args, agent_id, agent_alias_id):
+    # Every concurrent session keeps its own connection open while streaming
+    runtime_client = get_session().client(
+        "bedrock-agent-runtime",
+        config=Config(
+            max_pool_connections=args.concurrency,
+            retries={"max_attempts": 5, "mode": "adaptive"},
+        ),
+    )
+    input_file = sys.stdin if args.batch == "-" else open(args.batch)
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    otel_file = open(args.otel_output, "w") if args.otel_output else None
+
+    try:
+        run_batch(
+            runtime_client,
+            agent_id,
+            agent_alias_id,
+            input_file,
+            output_file,
+            concurrency=args.concurrency,
+            rate_limit=args.rate_limit,
+            otel_file=otel_file,
+        )
+    finally:
+        for file in [input_file, output_file, otel_file]:
+            if file not in [sys.stdin, sys.stdout, None]:
+                file.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Text to SQL Agent")
+    parser.add_argument(
+        "--batch",
+        help="JSONL file with one question per line, or - for stdin",
+    )
+    parser.add_argument("--output", default="-", help="JSONL file for batch results")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=BATCH_RATE_LIMIT,
+        help="Agent invocations per second",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the step timings and tokens after every answer",
+    )
+    parser.add_argument(
+        "--otel-output",
+        help="JSONL file for the step timings as OpenTelemetry (OTLP JSON) spans",
+    )
+    args = parser.parse_args()
+
+    if args.batch:
+        invoke_batch(
+            args, *resolve_agent_ids(bedrock_agent_client, AGENT_NAME, AGENT_ALIAS_NAME)
+        )
+        sys.exit()
+
     print("\n🧠 Text to SQL Agent 🧠\n")
     print("Options:")
     print("  'exit' - Exit the program")
 
-    current_agent_id = get_agent_id_by_name(bedrock_agent_client, AGENT_NAME)
-    current_agent_alias_id = get_agent_alias_id_by_name(
-        bedrock_agent_client, current_agent_id, AGENT_ALIAS_NAME
+    current_agent_id, current_agent_alias_id = resolve_agent_ids(
+        bedrock_agent_client, AGENT_NAME, AGENT_ALIAS_NAME
     )
+    otel_output_file = open(args.otel_output, "a") if args.otel_output else None
+    session_manager = SessionManager(load_schema)
 
     while True:
         try:
@@ -41,7 +172,14 @@ if __name__ == "__main__":
                 print("\nGoodbye! 👋")
                 break
 
-            invoke_text_to_sql(user_input, current_agent_id, current_agent_alias_id)
+            invoke_text_to_sql(
+                user_input,
+                current_agent_id,
+                current_agent_alias_id,
+                profile=args.profile,
+                otel_file=otel_output_file,
+                session_manager=session_manager,
+            )
 
         except KeyboardInterrupt:
             print("\n\nExecution interrupted. Exiting.")
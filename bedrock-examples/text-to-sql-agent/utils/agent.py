@@ -1,119 +1,301 @@
 import json
+import os
+import tempfile
+import time
+from collections import namedtuple
 
+from botocore.exceptions import ClientError
 
-def get_agent_id_by_name(bedrock_client, name):
-    try:
-        list_agent = bedrock_client.list_agents().get("agentSummaries", [])
-        agent_id_list = [
-            agent.get("agentId")
-            for agent in list_agent
-            if agent.get("agentName", "") == name
-        ]
+AGENT_ID_CACHE_PATH = os.getenv(
+    "AGENT_ID_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "text-2-sql-agent", "agent_ids.json"),
+)
+AGENT_ID_CACHE_TTL_SECONDS = int(os.getenv("AGENT_ID_CACHE_TTL_SECONDS", "86400"))
+
+# Typed events decoded from the invoke_agent completion stream
+ChunkEvent = namedtuple("ChunkEvent", ["text"])
+ModelInvocationEvent = namedtuple(
+    "ModelInvocationEvent",
+    ["stage", "step", "phase", "usage", "metadata", "event_time"],
+)
+ToolCallEvent = namedtuple("ToolCallEvent", ["step", "name"])
+ActionGroupEvent = namedtuple(
+    "ActionGroupEvent",
+    ["step", "phase", "api_path", "parameters", "metadata", "event_time"],
+)
+FinishEvent = namedtuple("FinishEvent", ["step", "text"])
+UnexpectedEvent = namedtuple("UnexpectedEvent", ["event"])
+NO_AGENT_EVENTS = ()
 
-        if not agent_id_list:
-            raise ValueError(f"Agent with name '{name}' not found")
 
-        if len(agent_id_list) > 1:
-            raise ValueError(f"Search with by name '{name}' returned multiple agents")
+def find_id_by_name(pages, summaries_key, name_key, id_key, name, description):
+    id_list = [
+        summary.get(id_key)
+        for page in pages
+        for summary in page.get(summaries_key, [])
+        if summary.get(name_key, "") == name
+    ]
 
-        return agent_id_list[0]
+    if not id_list:
+        raise ValueError(f"{description} with name '{name}' not found")
+
+    if len(id_list) > 1:
+        raise ValueError(
+            f"Search with by name '{name}' returned {len(id_list)} matches"
+        )
+
+    return id_list[0]
+
+
+def get_agent_id_by_name(bedrock_client, name):
+    try:
+        return find_id_by_name(
+            bedrock_client.get_paginator("list_agents").paginate(),
+            "agentSummaries",
+            "agentName",
+            "agentId",
+            name,
+            "Agent",
+        )
     except Exception as e:
         print("Error fetching agent id by name:", e)
 
 
 def get_action_group_id_by_name(bedrock_client, agent_id, name):
     try:
-        list_action_group = bedrock_client.list_agent_action_groups(
-            agentId=agent_id,
-            agentVersion="1",
-        ).get("actionGroupSummaries", [])
-
-        action_group_id_list = [
-            agent.get("actionGroupId")
-            for agent in list_action_group
-            if agent.get("actionGroupName", "") == name
-        ]
-
-        if not action_group_id_list:
-            raise ValueError(f"Action group with name '{name}' not found")
-
-        if len(action_group_id_list) > 1:
-            raise ValueError(
-                f"Search with by name '{name}' returned multiple action groups"
-            )
-
-        return action_group_id_list[0]
+        return find_id_by_name(
+            bedrock_client.get_paginator("list_agent_action_groups").paginate(
+                agentId=agent_id,
+                agentVersion="1",
+            ),
+            "actionGroupSummaries",
+            "actionGroupName",
+            "actionGroupId",
+            name,
+            "Action group",
+        )
     except Exception as e:
         print("Error fetching group id by name:", e)
 
 
 def get_agent_alias_id_by_name(bedrock_client, agent_id, name):
     try:
-        response = bedrock_client.list_agent_aliases(
-            agentId=agent_id,
+        return find_id_by_name(
+            bedrock_client.get_paginator("list_agent_aliases").paginate(
+                agentId=agent_id,
+            ),
+            "agentAliasSummaries",
+            "agentAliasName",
+            "agentAliasId",
+            name,
+            "Alias",
         )
+    except Exception as e:
+        print("Error fetching agent alias id by name:", e)
 
-        agent_alias_id_list = [
-            agent.get("agentAliasId")
-            for agent in response.get("agentAliasSummaries", [])
-            if agent.get("agentAliasName", "") == name
-        ]
 
-        if not agent_alias_id_list:
-            raise ValueError(f"Alias with name '{name}' not found")
+def read_agent_id_cache():
+    try:
+        with open(AGENT_ID_CACHE_PATH) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
 
-        if len(agent_alias_id_list) > 1:
-            raise ValueError(f"Search with by name '{name}' returned multiple aliases")
 
-        return agent_alias_id_list[0]
-    except Exception as e:
-        print("Error fetching agent alias id by name:", e)
+def write_agent_id_cache(cache_key, entry):
+    try:
+        entries = read_agent_id_cache()
+        entries[cache_key] = entry
+        os.makedirs(os.path.dirname(AGENT_ID_CACHE_PATH), exist_ok=True)
+        with open(AGENT_ID_CACHE_PATH, "w") as file:
+            json.dump(entries, file)
+    except OSError as e:
+        print("Error caching agent ids:", e)
+
+
+def is_cached_agent_valid(bedrock_client, entry, agent_name):
+    try:
+        agent = bedrock_client.get_agent(agentId=entry.get("agentId")).get("agent", {})
+    except ClientError:
+        return False
+
+    if agent.get("agentStatus") in ["DELETING", "FAILED"]:
+        return False
+
+    return agent.get("agentName") == agent_name
+
+
+def resolve_agent_ids(bedrock_client, agent_name, alias_name):
+    # Aliases are only created with the agent, so validating the agent covers both ids
+    cache_key = f"{bedrock_client.meta.region_name}:{agent_name}:{alias_name}"
+    entry = read_agent_id_cache().get(cache_key, {})
+
+    if entry.get("expires_at", 0) > time.time() and is_cached_agent_valid(
+        bedrock_client, entry, agent_name
+    ):
+        return entry.get("agentId"), entry.get("agentAliasId")
+
+    agent_id = get_agent_id_by_name(bedrock_client, agent_name)
+    agent_alias_id = (
+        get_agent_alias_id_by_name(bedrock_client, agent_id, alias_name)
+        if agent_id
+        else None
+    )
+
+    if agent_id and agent_alias_id:
+        write_agent_id_cache(
+            cache_key,
+            {
+                "agentId": agent_id,
+                "agentAliasId": agent_alias_id,
+                "expires_at": time.time() + AGENT_ID_CACHE_TTL_SECONDS,
+            },
+        )
+
+    return agent_id, agent_alias_id
+
+
+class AgentEventDecoder:
+    """
+    Incremental decoder for the invoke_agent completion stream.
+    Every event is classified once into typed events.
+    """
+
+    def __init__(self):
+        # Other trace parts (rationale, guardrails, ...) are skipped
+        self.part_decoders = {
+            "modelInvocationInput": self.decode_model_invocation_input,
+            "modelInvocationOutput": self.decode_model_invocation_output,
+            "invocationInput": self.decode_invocation_input,
+            "observation": self.decode_observation,
+        }
+
+    def decode(self, event):
+        # Trace events outnumber the chunks of the final answer
+        trace = event.get("trace")
+        if trace is None:
+            if "chunk" in event:
+                return (ChunkEvent(event["chunk"].get("bytes", b"").decode("utf8")),)
+            return (UnexpectedEvent(event),)
+
+        # A trace event holds a single stage with a single part, and nearly all of
+        # them are orchestration steps
+        stage_traces = trace.get("trace", {})
+        stage = "orchestrationTrace"
+        stage_trace = stage_traces.get(stage)
+        if stage_trace is None:
+            stage, stage_trace = next(iter(stage_traces.items()), (None, {}))
+
+        for part_name, part in stage_trace.items():
+            if part_decoder := self.part_decoders.get(part_name):
+                return part_decoder(stage, part, trace.get("eventTime"))
+
+        return NO_AGENT_EVENTS
+
+    def decode_model_invocation_input(self, stage, part, event_time):
+        return (
+            ModelInvocationEvent(
+                stage, part.get("traceId"), "input", {}, {}, event_time
+            ),
+        )
+
+    def decode_model_invocation_output(self, stage, part, event_time):
+        trace_id = part.get("traceId")
+        metadata = part.get("metadata", {})
+        model_event = ModelInvocationEvent(
+            stage, trace_id, "output", metadata.get("usage", {}), metadata, event_time
+        )
+
+        # Only responses that contain a tool call are worth parsing
+        content = part.get("rawResponse", {}).get("content", "")
+        if '"toolUse"' not in content:
+            return (model_event,)
+
+        try:
+            message = json.loads(content).get("output", {}).get("message", {})
+        except ValueError:
+            return (model_event,)
+
+        return (
+            model_event,
+            *(
+                ToolCallEvent(trace_id, tool_call.get("name", ""))
+                for block in message.get("content", [])
+                if (tool_call := block.get("toolUse"))
+            ),
+        )
+
+    def decode_invocation_input(self, stage, part, event_time):
+        action_group_input = part.get("actionGroupInvocationInput")
+        if not action_group_input:
+            return NO_AGENT_EVENTS
+
+        content = action_group_input.get("requestBody", {}).get("content", {})
+        parameters = action_group_input.get("parameters", []) + content.get(
+            "application/json", []
+        )
+        return (
+            ActionGroupEvent(
+                part.get("traceId"),
+                "input",
+                action_group_input.get("apiPath"),
+                {
+                    parameter.get("name"): parameter.get("value")
+                    for parameter in parameters
+                },
+                {},
+                event_time,
+            ),
+        )
+
+    def decode_observation(self, stage, part, event_time):
+        trace_id = part.get("traceId")
+        if action_group_output := part.get("actionGroupInvocationOutput"):
+            metadata = action_group_output.get("metadata", {})
+            return (
+                ActionGroupEvent(trace_id, "output", None, {}, metadata, event_time),
+            )
+
+        if part.get("type") == "FINISH":
+            return (
+                FinishEvent(trace_id, part.get("finalResponse", {}).get("text", "")),
+            )
+
+        return NO_AGENT_EVENTS
+
+
+def format_model_invocation_event(agent_event):
+    if agent_event.stage == "orchestrationTrace" and agent_event.phase == "input":
+        return "Calling LLM..."
+
+    return None
+
+
+AGENT_EVENT_FORMATTERS = {
+    ChunkEvent: lambda agent_event: agent_event.text,
+    ModelInvocationEvent: format_model_invocation_event,
+    ToolCallEvent: lambda agent_event: f"Trying to call {agent_event.name}...",
+    FinishEvent: lambda agent_event: "Final response were generated!\n\n",
+    UnexpectedEvent: lambda agent_event: f"Unexpected event: {agent_event.event}",
+}
+
+
+def format_agent_event(agent_event):
+    if formatter := AGENT_EVENT_FORMATTERS.get(type(agent_event)):
+        return formatter(agent_event)
+
+    return None
+
 
+def format_agent_response(event, decoder=None):
+    agent_events = (decoder or AgentEventDecoder()).decode(event)
+    # Most events decode to a single agent event, or none at all
+    if len(agent_events) <= 1:
+        return (format_agent_event(agent_events[0]) or None) if agent_events else None
 
-def format_agent_response(event):
-    if "chunk" in event:
-        data = event.get("chunk", {}).get("bytes", b"No bytes in chunk!")
-        return data.decode("utf8")
-
-    elif "trace" in event:
-        if (
-            event.get("trace", {})
-            .get("trace", {})
-            .get("orchestrationTrace", {})
-            .get("modelInvocationInput", {})
-        ):
-            return "Calling LLM..."
-        elif (
-            response_content := event.get("trace", {})
-            .get("trace", {})
-            .get("orchestrationTrace", {})
-            .get("modelInvocationOutput", {})
-            .get("rawResponse", {})
-            .get("content", "")
-        ):
-            response_content = json.loads(response_content)
-            if (
-                response_content := response_content.get("output", {})
-                .get("message", {})
-                .get("content", [])
-            ):
-                if tool_call := response_content[0].get("toolUse", {}):
-                    return f"Trying to call {tool_call.get('name', '')}..."
-                else:
-                    return None
-            else:
-                return None
-        elif (
-            event.get("trace", {})
-            .get("trace", {})
-            .get("orchestrationTrace", {})
-            .get("observation", {})
-            .get("type", "")
-            == "FINISH"
-        ):
-            return "Final response were generated!\n\n"
-        else:
-            return None
-
-    else:
-        return f"Unexpected event: {event}"
+    messages = [
+        message
+        for agent_event in agent_events
+        if (message := format_agent_event(agent_event))
+    ]
+    return "".join(messages) or None
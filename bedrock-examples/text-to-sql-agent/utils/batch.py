@@ -0,0 +1,181 @@
+import json
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from agent import (
+    ActionGroupEvent,
+    AgentEventDecoder,
+    ChunkEvent,
+    ModelInvocationEvent,
+)
+from profiler import AgentProfiler, format_summary, summarize_waterfalls, to_otel_spans
+
+BATCH_CONCURRENCY = 4
+# Requests per second, keep below the InvokeAgent quota of the account
+BATCH_RATE_LIMIT = 2.0
+
+
+class RateLimiter:
+    """
+    Token bucket shared by the batch workers, allows short bursts up to the
+    concurrency limit while keeping the average rate of requests.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+
+def read_questions(file):
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+
+        try:
+            question = json.loads(line)
+        except ValueError as e:
+            print(f"Error reading question on line {line_number}:", e, file=sys.stderr)
+            continue
+
+        if isinstance(question, str):
+            question = {"question": question}
+
+        yield question
+
+
+def run_question(
+    bedrock_agent_runtime_client, agent_id, agent_alias_id, question, rate_limiter
+):
+    result = {
+        **question,
+        "answer": "",
+        "sql": [],
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "error": None,
+    }
+
+    rate_limiter.acquire()
+    started = time.perf_counter()
+    try:
+        agent_response = bedrock_agent_runtime_client.invoke_agent(
+            inputText=question.get("question"),
+            agentId=agent_id,
+            agentAliasId=agent_alias_id,
+            sessionId=str(uuid.uuid4()),
+            enableTrace=True,
+        )
+
+        decoder = AgentEventDecoder()
+        profiler = AgentProfiler()
+        for event in agent_response.get("completion"):
+            for agent_event in decoder.decode(event):
+                profiler.add(agent_event)
+                if isinstance(agent_event, ChunkEvent):
+                    result["answer"] += agent_event.text
+                elif isinstance(agent_event, ModelInvocationEvent):
+                    result["input_tokens"] += agent_event.usage.get("inputTokens", 0)
+                    result["output_tokens"] += agent_event.usage.get("outputTokens", 0)
+                elif (
+                    isinstance(agent_event, ActionGroupEvent)
+                    and agent_event.api_path == "/querydatabase"
+                ):
+                    result["sql"].append(agent_event.parameters.get("query"))
+        result["waterfall"] = profiler.waterfall()
+    except Exception as e:
+        result["error"] = str(e)
+
+    result["latency_seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def run_batch(
+    bedrock_agent_runtime_client,
+    agent_id,
+    agent_alias_id,
+    input_file,
+    output_file,
+    concurrency=BATCH_CONCURRENCY,
+    rate_limit=BATCH_RATE_LIMIT,
+    otel_file=None,
+):
+    rate_limiter = RateLimiter(rate_limit, burst=concurrency)
+    waterfalls = []
+    latencies = []
+    failed_questions = 0
+    total_tokens = 0
+    started = time.perf_counter()
+
+    def run(question):
+        return run_question(
+            bedrock_agent_runtime_client,
+            agent_id,
+            agent_alias_id,
+            question,
+            rate_limiter,
+        )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Results are written in input order as soon as they are available
+        for done, result in enumerate(executor.map(run, read_questions(input_file)), 1):
+            output_file.write(json.dumps(result) + "\n")
+            output_file.flush()
+
+            if otel_file and result.get("waterfall"):
+                otel_file.write(
+                    json.dumps(
+                        to_otel_spans(result["waterfall"], result.get("question", ""))
+                    )
+                    + "\n"
+                )
+
+            latencies.append(result["latency_seconds"])
+            waterfalls.append(result.get("waterfall", []))
+            total_tokens += result["input_tokens"] + result["output_tokens"]
+            if result["error"]:
+                failed_questions += 1
+                print(f"[{done}] Error: {result['error']}", file=sys.stderr)
+            else:
+                print(
+                    f"[{done}] Answered in {result['latency_seconds']:.1f}s.",
+                    file=sys.stderr,
+                )
+
+    elapsed = time.perf_counter() - started
+    if latencies:
+        print(
+            f"Answered {len(latencies) - failed_questions} of {len(latencies)} questions "
+            f"in {elapsed:.1f}s ({len(latencies) / elapsed * 60:.1f}/min), "
+            f"median latency {statistics.median(latencies):.1f}s, {total_tokens} tokens.",
+            file=sys.stderr,
+        )
+        print(
+            format_summary(summarize_waterfalls(waterfalls, latencies)),
+            file=sys.stderr,
+        )
+
+    return len(latencies), failed_questions
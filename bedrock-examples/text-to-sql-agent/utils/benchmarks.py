@@ -0,0 +1,686 @@
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+os.environ.setdefault("OUTPUT_LOCATION", "s3://local-benchmark/athena_result/")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+
+import boto3  # noqa: E402
+import pyarrow.parquet as pq  # noqa: E402
+from botocore.stub import Stubber  # noqa: E402
+
+import lambda_function  # noqa: E402
+from agent import (  # noqa: E402
+    AgentEventDecoder,
+    format_agent_event,
+    format_agent_response,
+)
+from batch import run_batch  # noqa: E402
+from fakes import (  # noqa: E402
+    FakeAthenaClient,
+    FakeBedrockAgentRuntimeClient,
+    FakeS3Client,
+    create_trace_events,
+)
+from ingest import convert_to_parquet, read_csv_table  # noqa: E402
+from profiler import AgentProfiler  # noqa: E402
+from schema import (  # noqa: E402
+    collect_sample_values,
+    compile_schema_digest,
+    estimate_tokens,
+    fetch_schema,
+)
+from session import SessionManager  # noqa: E402
+from transfer import purge_bucket, upload_files  # noqa: E402
+
+
+def busy_wait_queries(athena_client, queries):
+    # Replicates the original tight get_query_execution loop without any sleep
+    for query in queries:
+        query_execution_id = athena_client.start_query_execution(QueryString=query).get(
+            "QueryExecutionId"
+        )
+        response = athena_client.get_query_execution(
+            QueryExecutionId=query_execution_id
+        )
+        while lambda_function.get_query_state(response.get("QueryExecution", {})) in [
+            "QUEUED",
+            "RUNNING",
+        ]:
+            response = athena_client.get_query_execution(
+                QueryExecutionId=query_execution_id
+            )
+
+
+def backoff_wait_queries(athena_client, queries):
+    query_execution_ids = lambda_function.start_queries(athena_client, queries)
+    lambda_function.wait_for_queries(
+        athena_client, query_execution_ids, lambda_function.get_query_deadline()
+    )
+
+
+def benchmark_polling(args):
+    durations = {f"SELECT {i}": args.duration * (i + 1) for i in range(args.queries)}
+
+    for name, wait in [
+        ("busy-wait", busy_wait_queries),
+        ("backoff", backoff_wait_queries),
+    ]:
+        athena_client = FakeAthenaClient(durations=durations)
+        started = time.perf_counter()
+        wait(athena_client, list(durations))
+        elapsed = time.perf_counter() - started
+        polls = (
+            athena_client.calls["get_query_execution"]
+            + athena_client.calls["batch_get_query_execution"]
+        )
+        print(f"{name:>10}: {elapsed:6.2f}s wall time, {polls} poll calls")
+
+
+def read_all_pages(athena_client, query_execution_id):
+    # Materializes every page the way a non-streaming reader would
+    return list(lambda_function.iter_result_rows(athena_client, query_execution_id))
+
+
+def read_streaming(athena_client, query_execution_id):
+    return lambda_function.take_result_rows(
+        lambda_function.iter_result_rows(athena_client, query_execution_id),
+        query_execution_id,
+        lambda_function.MAX_RESULT_ROWS,
+        lambda_function.MAX_RESULT_BYTES,
+    )
+
+
+def create_result_set(args, s3_client=None, latency=0.0):
+    athena_client = FakeAthenaClient(
+        columns=[("customer_id", "integer"), ("name", "varchar"), ("amount", "double")],
+        rows=[(i, f"customer-{i}", i * 1.25) for i in range(args.rows)],
+        s3_client=s3_client,
+        latency=latency,
+    )
+    query_execution_id = athena_client.start_query_execution(QueryString="SELECT *")[
+        "QueryExecutionId"
+    ]
+    return athena_client, query_execution_id
+
+
+def benchmark_results(args):
+    athena_client, query_execution_id = create_result_set(args)
+
+    for name, fetch in [
+        ("all pages", read_all_pages),
+        ("streaming", read_streaming),
+    ]:
+        athena_client.calls.clear()
+        tracemalloc.start()
+        started = time.perf_counter()
+        result_data = fetch(athena_client, query_execution_id)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"{name:>10}: {elapsed * 1000:8.1f}ms, peak {peak / 1024:9.1f} KiB, "
+            f"{len(result_data)} rows, "
+            f"{athena_client.calls['get_query_results']} get_query_results calls"
+        )
+
+
+# Throughput of a single S3 GET inside the region
+CSV_RESULT_BANDWIDTH = 80 * 1024 * 1024
+
+
+def benchmark_csv_results(args):
+    # Every Athena and S3 request pays the round trip, the CSV object also its transfer
+    s3_client = FakeS3Client(latency=args.latency, bandwidth=CSV_RESULT_BANDWIDTH)
+    athena_client, query_execution_id = create_result_set(
+        args, s3_client, latency=args.latency
+    )
+    query_execution = athena_client.get_query_execution(
+        QueryExecutionId=query_execution_id
+    ).get("QueryExecution")
+
+    def read_json(max_rows, max_bytes):
+        rows = lambda_function.iter_result_rows(athena_client, query_execution_id)
+        return lambda_function.take_result_rows(
+            rows, query_execution_id, max_rows, max_bytes
+        )
+
+    def read_csv(max_rows, max_bytes):
+        return lambda_function.fetch_result_data(
+            athena_client, s3_client, query_execution, max_rows, max_bytes
+        )
+
+    for name, fetch in [("json api", read_json), ("s3 csv", read_csv)]:
+        athena_client.calls.clear()
+        s3_client.calls.clear()
+        started = time.perf_counter()
+        result_data = fetch(args.rows, float("inf"))
+        elapsed = time.perf_counter() - started
+        calls = athena_client.calls["get_query_results"] + s3_client.calls["get_object"]
+        print(
+            f"{name:>10}: {elapsed * 1000:8.1f}ms, {len(result_data)} rows, "
+            f"{calls} API calls"
+        )
+
+
+def benchmark_clients(args):
+    response = {"TableList": []}
+
+    def cold_invocation():
+        # Mirrors the previous handler, which built a new client on every call
+        glue_client = boto3.client("glue", config=lambda_function.CLIENT_CONFIG)
+        with Stubber(glue_client) as stubber:
+            stubber.add_response("get_tables", response)
+            glue_client.get_tables(DatabaseName="financialdata")
+
+    def warm_invocation():
+        glue_client = lambda_function.get_client("glue")
+        with Stubber(glue_client) as stubber:
+            stubber.add_response("get_tables", response)
+            glue_client.get_tables(DatabaseName="financialdata")
+
+    lambda_function.clients.clear()
+    for name, invoke in [("cold", cold_invocation), ("warm", warm_invocation)]:
+        started = time.perf_counter()
+        for _ in range(args.invocations):
+            invoke()
+        elapsed = time.perf_counter() - started
+        print(f"{name:>10}: {elapsed / args.invocations * 1000:8.2f}ms per invocation")
+
+
+IMPORT_TIME_SCRIPT = """
+import time
+started = time.perf_counter()
+import main
+{setup}
+print(time.perf_counter() - started)
+"""
+
+
+def benchmark_imports(args):
+    main_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # Mirrors the previous modules, which built every client and asked STS for the
+    # account ID at import
+    eager_setup = "\n".join(
+        [
+            "from config.aws_clients import CLIENT_NAMES, get_client",
+            "for service_name in CLIENT_NAMES.values():",
+            "    get_client(service_name)",
+            f"time.sleep({args.latency})",
+        ]
+    )
+
+    for name, setup in [("eager", eager_setup), ("lazy", "")]:
+        # A new interpreter for every round, modules are only imported once
+        rounds = [
+            float(
+                subprocess.run(
+                    [sys.executable, "-c", IMPORT_TIME_SCRIPT.format(setup=setup)],
+                    cwd=main_path,
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout.split()[-1]
+            )
+            for _ in range(5)
+        ]
+        print(f"{name:>10}: {min(rounds):.3f}s to import main.py, best of 5")
+
+
+LOCAL_QUERIES = [
+    """
+    SELECT c.first_name, c.last_name, SUM(t.amount) AS total_spent
+    FROM customer_data c
+    JOIN transaction_data t ON c.customer_id = t.customer_id
+    GROUP BY c.customer_id, c.first_name, c.last_name
+    ORDER BY total_spent DESC
+    LIMIT 3;
+    """,
+    """
+    SELECT e.first_name, e.last_name, COUNT(s.sale_id) AS sales_count
+    FROM employee_data e
+    JOIN sales_data s ON e.employee_id = s.employee_id
+    GROUP BY e.employee_id, e.first_name, e.last_name
+    ORDER BY sales_count DESC
+    LIMIT 5;
+    """,
+    """
+    SELECT payment_method, MAX(amount) AS highest_amount
+    FROM transaction_data
+    GROUP BY payment_method
+    ORDER BY highest_amount DESC;
+    """,
+]
+
+
+def create_query_event(query):
+    return {
+        "apiPath": "/querydatabase",
+        "requestBody": {
+            "content": {
+                "application/json": {"properties": [{"name": "query", "value": query}]}
+            }
+        },
+    }
+
+
+def benchmark_local_backend(args):
+    lambda_function.QUERY_BACKEND = "local"
+
+    started = time.perf_counter()
+    lambda_function.lambda_handler({"apiPath": "/getschema"}, None)
+    print(f"{'load':>10}: {(time.perf_counter() - started) * 1000:8.1f}ms")
+
+    for query in LOCAL_QUERIES:
+        started = time.perf_counter()
+        for _ in range(args.invocations):
+            lambda_function.lambda_handler(create_query_event(query), None)
+        elapsed = (time.perf_counter() - started) / args.invocations
+        print(f"{'query':>10}: {elapsed * 1000:8.1f}ms per invocation")
+
+
+DATA_PATH = "../../../resources/FinancialData/"
+# Columns each example query reads, plus the year it is limited to
+SCANNED_COLUMNS = [
+    (
+        "top customers by spend",
+        {
+            "customer_data": ["customer_id", "first_name", "last_name"],
+            "transaction_data": ["customer_id", "amount"],
+        },
+        None,
+    ),
+    (
+        "top employees by sales",
+        {
+            "employee_data": ["employee_id", "first_name", "last_name"],
+            "sales_data": ["employee_id", "sale_id"],
+        },
+        None,
+    ),
+    (
+        "max amount by payment",
+        {"transaction_data": ["payment_method", "amount"]},
+        None,
+    ),
+    ("2024 transaction total", {"transaction_data": ["amount"]}, 2024),
+]
+
+
+def list_files(path, extension, year=None):
+    for root, _, files in os.walk(path):
+        if year is not None and f"year={year}" not in root:
+            continue
+        for filename in files:
+            if filename.endswith(extension):
+                yield os.path.join(root, filename)
+
+
+def scan_csv(tables):
+    scanned_bytes = 0
+    for table_name in tables:
+        for csv_path in list_files(os.path.join(DATA_PATH, table_name), ".csv"):
+            scanned_bytes += os.path.getsize(csv_path)
+            read_csv_table(csv_path)
+
+    return scanned_bytes
+
+
+def scan_parquet(parquet_path, tables, year):
+    scanned_bytes = 0
+    for table_name, columns in tables.items():
+        table_path = os.path.join(parquet_path, table_name)
+        for file_path in list_files(table_path, ".parquet", year):
+            parquet_file = pq.ParquetFile(file_path)
+            metadata = parquet_file.metadata
+            for row_group in range(metadata.num_row_groups):
+                for column in range(metadata.num_columns):
+                    chunk = metadata.row_group(row_group).column(column)
+                    if chunk.path_in_schema in columns:
+                        scanned_bytes += chunk.total_compressed_size
+            parquet_file.read(columns=columns)
+
+    return scanned_bytes
+
+
+def benchmark_parquet(args):
+    parquet_path = convert_to_parquet(
+        DATA_PATH, os.path.join(tempfile.mkdtemp(), "FinancialData/")
+    )
+
+    for name, tables, year in SCANNED_COLUMNS:
+        for file_format, scan in [
+            ("csv", lambda: scan_csv(tables)),
+            ("parquet", lambda: scan_parquet(parquet_path, tables, year)),
+        ]:
+            started = time.perf_counter()
+            scanned_bytes = scan()
+            elapsed = time.perf_counter() - started
+            print(
+                f"{name:>24} {file_format:>8}: {scanned_bytes / 1024:8.1f} KiB "
+                f"scanned, {elapsed * 1000:7.1f}ms"
+            )
+
+
+def benchmark_upload(args):
+    parquet_path = convert_to_parquet(
+        DATA_PATH, os.path.join(tempfile.mkdtemp(), "FinancialData/")
+    )
+    uploads = [
+        (file_path, os.path.relpath(file_path, parquet_path))
+        for file_path in list_files(parquet_path, ".parquet")
+    ]
+
+    s3_client = FakeS3Client(latency=args.duration / 20, bandwidth=20 * 1024 * 1024)
+    for name, max_workers in [("serial", 1), ("parallel", 8), ("re-run", 8)]:
+        if name != "re-run":
+            s3_client.objects.clear()
+        started = time.perf_counter()
+        upload_files(s3_client, uploads, "local-benchmark", max_workers=max_workers)
+        print(
+            f"{name:>10}: {time.perf_counter() - started:6.2f}s for {len(uploads)} files"
+        )
+
+
+def delete_first_page(s3_client, bucket_name):
+    # Replicates the original single list_objects and delete_objects call
+    response = next(
+        s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket_name)
+    )
+    s3_client.delete_objects(
+        Bucket=bucket_name,
+        Delete={
+            "Objects": [{"Key": obj.get("Key")} for obj in response.get("Contents", [])]
+        },
+    )
+
+
+def benchmark_purge(args):
+    # A 1000-key delete takes several times longer than listing a page
+    s3_client = FakeS3Client(
+        latency=args.duration / 20, delete_latency=args.duration / 4
+    )
+
+    for name, max_workers in [("original", None), ("serial", 1), ("parallel", 8)]:
+        s3_client.objects = {
+            ("local-benchmark", f"athena_result/{i}.csv"): b"" for i in range(args.rows)
+        }
+        started = time.perf_counter()
+        if max_workers:
+            purge_bucket(s3_client, "local-benchmark", max_workers=max_workers)
+        else:
+            delete_first_page(s3_client, "local-benchmark")
+        print(
+            f"{name:>10}: {time.perf_counter() - started:6.2f}s, "
+            f"{len(s3_client.objects)} of {args.rows} objects left"
+        )
+
+
+def benchmark_batch(args):
+    questions = "".join(
+        json.dumps({"id": i, "question": f"Question {i}"}) + "\n"
+        for i in range(args.queries)
+    )
+
+    for name, concurrency, rate_limit in [
+        ("serial", 1, 100.0),
+        ("concurrent", 8, 100.0),
+        ("rate-limited", 8, 4.0),
+    ]:
+        runtime_client = FakeBedrockAgentRuntimeClient(
+            duration=args.duration, scale_trace=True
+        )
+        output_file = io.StringIO()
+        started = time.perf_counter()
+        run_batch(
+            runtime_client,
+            "AGENT",
+            "ALIAS",
+            io.StringIO(questions),
+            output_file,
+            concurrency=concurrency,
+            rate_limit=rate_limit,
+        )
+        results = [json.loads(line) for line in output_file.getvalue().splitlines()]
+        print(
+            f"{name:>12}: {time.perf_counter() - started:6.2f}s for {len(results)} "
+            f"questions, {runtime_client.max_running} sessions at once, "
+            f"in order: {[result['id'] for result in results] == list(range(args.queries))}"
+        )
+
+
+def format_agent_response_original(event):
+    # Replicates the previous formatter, which walked the trace and parsed the raw response
+    if "chunk" in event:
+        return event.get("chunk", {}).get("bytes", b"").decode("utf8")
+
+    orchestration_trace = (
+        event.get("trace", {}).get("trace", {}).get("orchestrationTrace", {})
+    )
+    if orchestration_trace.get("modelInvocationInput", {}):
+        return "Calling LLM..."
+    elif (
+        content := orchestration_trace.get("modelInvocationOutput", {})
+        .get("rawResponse", {})
+        .get("content", "")
+    ):
+        content = (
+            json.loads(content).get("output", {}).get("message", {}).get("content", [])
+        )
+        if content and (tool_call := content[0].get("toolUse", {})):
+            return f"Trying to call {tool_call.get('name', '')}..."
+        return None
+    elif orchestration_trace.get("observation", {}).get("type", "") == "FINISH":
+        return "Final response were generated!\n\n"
+    return None
+
+
+def extract_trace_original(event):
+    # Replicates the separate walks the batch mode used for token usage and SQL
+    usage = [
+        step_trace.get("modelInvocationOutput", {}).get("metadata", {}).get("usage", {})
+        for step_trace in event.get("trace", {}).get("trace", {}).values()
+    ]
+    action_group_input = (
+        event.get("trace", {})
+        .get("trace", {})
+        .get("orchestrationTrace", {})
+        .get("invocationInput", {})
+        .get("actionGroupInvocationInput", {})
+    )
+    properties = (
+        action_group_input.get("requestBody", {})
+        .get("content", {})
+        .get("application/json", [])
+    )
+    return usage, [
+        prop.get("value") for prop in properties if prop.get("name") == "query"
+    ]
+
+
+def benchmark_trace(args):
+    streams = [
+        create_trace_events(f"Question {i}", LOCAL_QUERIES[0])
+        for i in range(args.invocations)
+    ]
+    events = sum(len(stream) for stream in streams)
+
+    def original_with_extraction(stream):
+        for event in stream:
+            format_agent_response_original(event)
+            extract_trace_original(event)
+
+    def decode(stream):
+        decoder = AgentEventDecoder()
+        for event in stream:
+            format_agent_response(event, decoder)
+
+    def decode_with_profiler(stream):
+        decoder = AgentEventDecoder()
+        profiler = AgentProfiler()
+        for event in stream:
+            for agent_event in decoder.decode(event):
+                profiler.add(agent_event)
+                format_agent_event(agent_event)
+
+    for name, format_stream in [
+        (
+            "original",
+            lambda stream: [format_agent_response_original(event) for event in stream],
+        ),
+        ("decoder", decode),
+        ("original+extraction", original_with_extraction),
+        ("decoder+profiler", decode_with_profiler),
+    ]:
+        # Best of several rounds, a single round is too noisy to compare
+        rounds = []
+        for _ in range(5):
+            started = time.perf_counter()
+            for _ in range(20):
+                for stream in streams:
+                    format_stream(stream)
+            rounds.append(time.perf_counter() - started)
+        print(f"{name:>20}: {events * 20 / min(rounds):10.0f} events/s")
+
+
+def run_conversation(runtime_client, questions, next_turn):
+    llm_turns = 0
+    timeline_ms = 0
+    for question in questions:
+        session_id, session_state = next_turn()
+        response = runtime_client.invoke_agent(
+            inputText=question, sessionId=session_id, sessionState=session_state
+        )
+        decoder = AgentEventDecoder()
+        profiler = AgentProfiler()
+        for event in response.get("completion"):
+            for agent_event in decoder.decode(event):
+                profiler.add(agent_event)
+
+        waterfall = profiler.waterfall()
+        llm_turns += sum(span["name"].startswith("llm:") for span in waterfall)
+        timeline_ms += max(
+            span["offset_ms"] + span["duration_ms"] for span in waterfall
+        )
+
+    return llm_turns, timeline_ms
+
+
+def benchmark_session(args):
+    questions = [f"Question {i}" for i in range(args.queries)]
+    glue_client = boto3.client("glue")
+    reused_session_id = "reused"
+
+    with Stubber(glue_client) as stubber:
+        stubber.add_response(
+            "get_tables",
+            {
+                "TableList": [
+                    {
+                        "Name": "transaction_data",
+                        "StorageDescriptor": {
+                            "Columns": [{"Name": "amount", "Type": "double"}]
+                        },
+                    }
+                ]
+            },
+        )
+        session_manager = SessionManager(
+            lambda: fetch_schema(glue_client, "financialdata")
+        )
+
+        for name, next_turn in [
+            ("new session per question", lambda: (str(uuid.uuid4()), {})),
+            ("reused session", lambda: (reused_session_id, {})),
+            ("session manager", session_manager.next_turn),
+        ]:
+            runtime_client = FakeBedrockAgentRuntimeClient(duration=0)
+            llm_turns, timeline_ms = run_conversation(
+                runtime_client, questions, next_turn
+            )
+            print(
+                f"{name:>24}: {llm_turns / len(questions):.2f} LLM turns and "
+                f"{timeline_ms / len(questions) / 1000:.2f}s per question"
+            )
+
+
+def benchmark_schema(args):
+    from config.constants import AGENT_PROMPT
+
+    tables = lambda_function.get_local_database()["tables"]
+    started = time.perf_counter()
+    digest = compile_schema_digest(tables, collect_sample_values(DATA_PATH))
+    print(f"Digest compiled in {(time.perf_counter() - started) * 1000:.1f}ms:")
+    print(digest)
+
+    instruction_tokens = estimate_tokens(AGENT_PROMPT)
+    full_tokens = estimate_tokens(str(lambda_function.build_schema(tables)))
+    digest_tokens = estimate_tokens(digest)
+    print(f"\n{'/getschema answer':>24}: {full_tokens} tokens")
+    print(f"{'schema digest':>24}: {digest_tokens} tokens\n")
+
+    questions = [f"Question {i}" for i in range(args.queries)]
+    for name, schema, schema_tokens in [
+        ("/getschema call", None, full_tokens),
+        (
+            "full schema attribute",
+            str(lambda_function.build_schema(tables)),
+            full_tokens,
+        ),
+        ("schema digest attribute", digest, digest_tokens),
+    ]:
+        session_state = (
+            {"promptSessionAttributes": {"database_schema": schema}} if schema else {}
+        )
+        runtime_client = FakeBedrockAgentRuntimeClient(duration=0)
+        llm_turns, _ = run_conversation(
+            runtime_client, questions, lambda: (str(uuid.uuid4()), session_state)
+        )
+        turns = llm_turns / len(questions)
+        # The schema is in the prompt of every turn, except for the first one
+        # when the agent still has to call /getschema
+        schema_turns = turns if schema else turns - 1
+        prompt_tokens = turns * instruction_tokens + schema_turns * schema_tokens
+        print(
+            f"{name:>24}: {turns:.2f} LLM turns and ~{prompt_tokens:.0f} "
+            "prompt tokens per question"
+        )
+
+
+BENCHMARKS = {
+    "polling": benchmark_polling,
+    "results": benchmark_results,
+    "csv-results": benchmark_csv_results,
+    "clients": benchmark_clients,
+    "imports": benchmark_imports,
+    "local-backend": benchmark_local_backend,
+    "parquet": benchmark_parquet,
+    "upload": benchmark_upload,
+    "purge": benchmark_purge,
+    "batch": benchmark_batch,
+    "trace": benchmark_trace,
+    "session": benchmark_session,
+    "schema": benchmark_schema,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline text-to-SQL benchmarks.")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--queries", type=int, default=3)
+    parser.add_argument("--duration", type=float, default=1.0)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--invocations", type=int, default=50)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Seconds per AWS API request"
+    )
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
@@ -3,6 +3,7 @@ from agent import (
     get_agent_alias_id_by_name,
     get_agent_id_by_name,
 )
+from botocore.exceptions import ClientError
 from config.aws_clients import (
     bedrock_agent_client,
     glue_client,
@@ -28,10 +29,18 @@ from config.constants import (
     LAMBDA_ROLE_NAME,
     SCHEMA_KEY,
 )
+from provisioning import run_steps
+from readiness import wait_for_crawler_ready, wait_for_deletion
+from transfer import purge_bucket
 
 
 def delete_glue_crawler(crawler_name):
     try:
+        crawler = glue_client.get_crawler(Name=crawler_name).get("Crawler", {})
+        if crawler.get("State", "") == "RUNNING":
+            glue_client.stop_crawler(Name=crawler_name)
+        wait_for_crawler_ready(glue_client, crawler_name)
+
         glue_client.delete_crawler(Name=crawler_name)
         print(f"Crawler {crawler_name} deleted successfully.")
     except Exception as e:
@@ -63,15 +72,8 @@ def delete_glue_database(database_name):
 
 def clean_s3_bucket(bucket_name):
     try:
-        objects = s3_client.list_objects(Bucket=bucket_name)
-        s3_client.delete_objects(
-            Bucket=bucket_name,
-            Delete={
-                "Objects": [
-                    {"Key": obj.get("Key")} for obj in objects.get("Contents", [])
-                ]
-            },
-        )
+        # Includes every Athena result and object version, not only the first 1000 keys
+        purge_bucket(s3_client, bucket_name)
         s3_client.delete_bucket(Bucket=bucket_name)
         print(f"Bucket {bucket_name} cleaned successfully.")
     except Exception as e:
@@ -113,22 +115,37 @@ def delete_agent_action_group(
         print(f"Error deleting agent action group {action_group_name}:", e)
 
 
+def is_no_such_entity(error):
+    return (
+        isinstance(error, ClientError)
+        and error.response.get("Error", {}).get("Code") == "NoSuchEntity"
+    )
+
+
+# Each policy and role is handled on its own, so a re-run after a partial teardown
+# still detaches and deletes whatever is left
 def detach_role_policies(iam_client, policy_arns, role_name):
-    try:
-        for policy_arn in policy_arns:
+    for policy_arn in policy_arns:
+        try:
             iam_client.detach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
-        print(f"Policies {policy_arns} detached successfully from {role_name}.")
-    except Exception as e:
-        print(f"Error detaching policies from {role_name} role:", e)
+            print(f"Policy {policy_arn} detached successfully from {role_name}.")
+        except Exception as e:
+            if is_no_such_entity(e):
+                print(f"Policy {policy_arn} is already detached from {role_name}.")
+            else:
+                print(f"Error detaching policy {policy_arn} from {role_name}:", e)
 
 
 def delete_roles(iam_client, role_names):
-    try:
-        for role_name in role_names:
+    for role_name in role_names:
+        try:
             iam_client.delete_role(RoleName=role_name)
-        print(f"Roles {role_names} deleted successfully.")
-    except Exception as e:
-        print(f"Error deleting {role_names} roles:", e)
+            print(f"Role {role_name} deleted successfully.")
+        except Exception as e:
+            if is_no_such_entity(e):
+                print(f"Role {role_name} is already deleted.")
+            else:
+                print(f"Error deleting role {role_name}:", e)
 
 
 def delete_policy_by_name(policy_name):
@@ -151,6 +168,12 @@ def delete_policy_by_name(policy_name):
 def delete_agent_alias(bedrock_agent, agent_id, agent_alias_id):
     try:
         bedrock_agent.delete_agent_alias(agentId=agent_id, agentAliasId=agent_alias_id)
+        wait_for_deletion(
+            lambda: bedrock_agent.get_agent_alias(
+                agentId=agent_id, agentAliasId=agent_alias_id
+            ),
+            f"agent alias {agent_alias_id}",
+        )
         print(f"Agent alias {agent_alias_id} deleted successfully.")
     except Exception as e:
         print(f"Error deleting agent alias {agent_alias_id}:", e)
@@ -159,6 +182,9 @@ def delete_agent_alias(bedrock_agent, agent_id, agent_alias_id):
 def delete_agent(bedrock_agent, agent_id):
     try:
         bedrock_agent.delete_agent(agentId=agent_id)
+        wait_for_deletion(
+            lambda: bedrock_agent.get_agent(agentId=agent_id), f"agent {agent_id}"
+        )
         print(f"Agent {agent_id} deleted successfully.")
     except Exception as e:
         print(f"Error deleting agent {agent_id}:", e)
@@ -180,33 +206,82 @@ agent_alias_id = get_agent_alias_id_by_name(
     bedrock_agent_client, agent_id, AGENT_ALIAS_NAME
 )
 
-
-delete_glue_crawler(GLUE_CRAWLER_NAME)
-delete_glue_tables(GLUE_DATABASE_NAME)
-delete_glue_database(GLUE_DATABASE_NAME)
-
-delete_agent_action_group(
-    lambda_client,
-    bedrock_agent_client,
-    agent_id,
-    action_group_id,
-    LAMBDA_NAME,
-    ACTION_GROUP_NAME,
-    BUCKET_NAME,
-    SCHEMA_KEY,
-)
-delete_agent_alias(bedrock_agent_client, agent_id, agent_alias_id)
-delete_agent(bedrock_agent_client, agent_id)
-
-clean_s3_bucket(BUCKET_NAME)
-
-delete_lambda(lambda_client, LAMBDA_NAME)
-
-detach_role_policies(iam_client, LAMBDA_POLICY_ARNS, LAMBDA_ROLE_NAME)
-detach_role_policies(iam_client, GLUE_POLICY_ARNS, GLUE_ROLE_NAME)
-detach_role_policies(iam_client, BEDROCK_POLICY_ARNS, AGENT_ROLE_NAME)
-
-delete_policy_by_name(BEDROCK_AGENT_BEDROCK_ALLOW_POLICY_NAME)
-delete_policy_by_name(BEDROCK_AGENT_S3_ALLOW_POLICY_NAME)
-
-delete_roles(iam_client, [AGENT_ROLE_NAME, LAMBDA_ROLE_NAME, GLUE_ROLE_NAME])
+# Each step lists the steps it depends on, independent resources are deleted concurrently.
+# Every step is safe to re-run, resources that are already gone are only reported.
+TEARDOWN_STEPS = {
+    "crawler": ([], lambda results: delete_glue_crawler(GLUE_CRAWLER_NAME)),
+    "tables": (["crawler"], lambda results: delete_glue_tables(GLUE_DATABASE_NAME)),
+    "database": (
+        ["tables"],
+        lambda results: delete_glue_database(GLUE_DATABASE_NAME),
+    ),
+    # The action group update needs both the Lambda function and the schema in S3
+    "action_group": (
+        [],
+        lambda results: delete_agent_action_group(
+            lambda_client,
+            bedrock_agent_client,
+            agent_id,
+            action_group_id,
+            LAMBDA_NAME,
+            ACTION_GROUP_NAME,
+            BUCKET_NAME,
+            SCHEMA_KEY,
+        ),
+    ),
+    "alias": (
+        [],
+        lambda results: delete_agent_alias(
+            bedrock_agent_client, agent_id, agent_alias_id
+        ),
+    ),
+    "agent": (
+        ["action_group", "alias"],
+        lambda results: delete_agent(bedrock_agent_client, agent_id),
+    ),
+    "bucket": (["action_group"], lambda results: clean_s3_bucket(BUCKET_NAME)),
+    "lambda": (
+        ["action_group"],
+        lambda results: delete_lambda(lambda_client, LAMBDA_NAME),
+    ),
+    "lambda_role_policies": (
+        ["lambda"],
+        lambda results: detach_role_policies(
+            iam_client, LAMBDA_POLICY_ARNS, LAMBDA_ROLE_NAME
+        ),
+    ),
+    "glue_role_policies": (
+        ["crawler"],
+        lambda results: detach_role_policies(
+            iam_client, GLUE_POLICY_ARNS, GLUE_ROLE_NAME
+        ),
+    ),
+    "agent_role_policies": (
+        ["agent"],
+        lambda results: detach_role_policies(
+            iam_client, BEDROCK_POLICY_ARNS, AGENT_ROLE_NAME
+        ),
+    ),
+    "bedrock_policy": (
+        ["agent_role_policies"],
+        lambda results: delete_policy_by_name(BEDROCK_AGENT_BEDROCK_ALLOW_POLICY_NAME),
+    ),
+    "s3_schema_policy": (
+        ["agent_role_policies"],
+        lambda results: delete_policy_by_name(BEDROCK_AGENT_S3_ALLOW_POLICY_NAME),
+    ),
+    "agent_role": (
+        ["agent_role_policies"],
+        lambda results: delete_roles(iam_client, [AGENT_ROLE_NAME]),
+    ),
+    "lambda_role": (
+        ["lambda_role_policies"],
+        lambda results: delete_roles(iam_client, [LAMBDA_ROLE_NAME]),
+    ),
+    "glue_role": (
+        ["glue_role_policies"],
+        lambda results: delete_roles(iam_client, [GLUE_ROLE_NAME]),
+    ),
+}
+
+run_steps(TEARDOWN_STEPS)
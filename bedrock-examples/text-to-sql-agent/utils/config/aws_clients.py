@@ -1,23 +1,46 @@
 import os
+from functools import cache
 
 from boto3 import session
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Create boto3 session with manually defined credentials.
-base_session = session.Session(
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID", ""),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY", ""),
-    aws_session_token=os.getenv("AWS_SESSION_TOKEN", ""),
-    region_name=os.getenv("AWS_REGION_NAME", "us-west-2"),
-)
-
-athena_client = base_session.client("athena")
-bedrock_agent_client = base_session.client("bedrock-agent")
-bedrock_agent_runtime_client = base_session.client("bedrock-agent-runtime")
-glue_client = base_session.client("glue")
-iam_client = base_session.client("iam")
-s3_client = base_session.client("s3")
-sts_client = base_session.client("sts")
-lambda_client = base_session.client("lambda")
+# Module attributes resolved to clients on first access
+CLIENT_NAMES = {
+    "athena_client": "athena",
+    "bedrock_agent_client": "bedrock-agent",
+    "bedrock_agent_runtime_client": "bedrock-agent-runtime",
+    "glue_client": "glue",
+    "iam_client": "iam",
+    "s3_client": "s3",
+    "sts_client": "sts",
+    "lambda_client": "lambda",
+}
+
+
+@cache
+def get_session():
+    # Create boto3 session with manually defined credentials.
+    return session.Session(
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID", ""),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY", ""),
+        aws_session_token=os.getenv("AWS_SESSION_TOKEN", ""),
+        region_name=os.getenv("AWS_REGION_NAME", "us-west-2"),
+    )
+
+
+@cache
+def get_client(service_name):
+    return get_session().client(service_name)
+
+
+def __getattr__(name):
+    # Keeps `from config.aws_clients import s3_client` working while only the
+    # imported clients get built
+    if name not in CLIENT_NAMES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    client = get_client(CLIENT_NAMES[name])
+    globals()[name] = client
+    return client
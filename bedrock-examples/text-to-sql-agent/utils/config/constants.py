@@ -1,24 +1,32 @@
+import hashlib
+import json
 import os
+import tempfile
+from functools import cache
 
-from aws_clients import sts_client
+from aws_clients import get_client, get_session
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # Overall constants
-ACCOUNT_ID = sts_client.get_caller_identity().get("Account")
 AGENT_ALIAS_NAME = "sample-agent"
 AGENT_NAME = "text-2-sql-agent"
 REGION = os.getenv("AWS_REGION_NAME", "us-west-2")
-SUFFIX = f"{REGION}-{ACCOUNT_ID}"
-AGENT_ROLE_NAME = f"AmazonBedrockExecutionRoleForAgents_{SUFFIX}"
+# Account ids resolved by STS are kept here per credentials, set to "" to disable
+ACCOUNT_ID_CACHE_PATH = os.getenv(
+    "ACCOUNT_ID_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), AGENT_NAME, "account_ids.json"),
+)
 ACTION_GROUP_NAME = "QueryAthenaActionGroup"
 AGENT_PROMPT = """You are an expert database querying assistant that can create simple and complex SQL queries to get
 answers about enterprise financial data.
 
 Follow these instructions:
-* First, you have to fetch the database schema by calling the /getschema endpoint.
-* Then, based on the received schema, create an SQL query that calls the most relevant tables and fetches the most
+* First, you have to fetch the database schema by calling the /getschema endpoint, unless the database schema is
+already given in the prompt session attributes or in these instructions, then use that schema and don't call
+/getschema.
+* Then, based on the schema, create an SQL query that calls the most relevant tables and fetches the most
 relevant data from them. You have to generate the SQL query by converting the user's natural language request.
 * After query creation, you have to call the /querydatabase endpoint and send the created SQL query as the request body.
 This endpoint will return the query execution result.
@@ -37,6 +45,8 @@ SQL Query Best Practices:
 - For revenue calculations, multiply transaction amount by quantity: `t.amount * s.quantity`
 - Use PARTITION BY in window functions for category-based rankings
 - Include all necessary columns in GROUP BY clauses
+- transaction_data and sales_data are partitioned by `year` and `month` of the transaction/sale date, filter on these
+columns when a question is limited to a time range so that only the matching partitions are scanned
 
 Here is an example:
 &lt;example&gt;
@@ -107,24 +117,20 @@ Assistant Action:
 &lt;/example&gt; """
 
 # S3 constants
-BEDROCK_AGENT_S3_ALLOW_POLICY_NAME = f"{AGENT_NAME}-s3-allow-{SUFFIX}"
-BUCKET_NAME = f"{AGENT_NAME}-{SUFFIX}"
 SCHEMA_KEY = f"{AGENT_NAME}-schema.json"
-
-SCHEMA_ARN = f"arn:aws:s3:::{BUCKET_NAME}/{SCHEMA_KEY}"
 SCHEMA_NAME = "text_to_sql_openai_schema.json"
-
-S3_SCHEMA_PATH = f"{BUCKET_NAME}/{SCHEMA_KEY}"
+SCHEMA_DIGEST_KEY = f"{AGENT_NAME}-schema-digest.json"
 S3_DATA_PATH = "data"
-S3_GLUE_TARGET = f"s3://{BUCKET_NAME}/{S3_DATA_PATH}/FinancialData/"
+RESULT_CACHE_PATH = "result_cache"
+# S3 lifecycle rules expire objects in whole days, the Lambda deletes expired
+# result cache entries it reads before that
+RESULT_CACHE_EXPIRATION_DAYS = 1
 
 # Bedrock constants
-BEDROCK_AGENT_BEDROCK_ALLOW_POLICY_NAME = f"{AGENT_NAME}-allow-{SUFFIX}"
 FOUNDATION_MODEL = os.getenv("AWS_BEDROCK_MODEL_ID", "us.writer.palmyra-x5-v1:0")
-BEDROCK_POLICY_ARNS = [
-    f"arn:aws:iam::{ACCOUNT_ID}:policy/{BEDROCK_AGENT_BEDROCK_ALLOW_POLICY_NAME}",
-    f"arn:aws:iam::{ACCOUNT_ID}:policy/{BEDROCK_AGENT_S3_ALLOW_POLICY_NAME}",
-]
+# Adds the compiled schema digest to the agent instruction instead of sending it
+# with every question
+SCHEMA_DIGEST_IN_INSTRUCTION = os.getenv("SCHEMA_DIGEST_IN_INSTRUCTION", "") == "true"
 
 # Glue constants
 GLUE_CRAWLER_NAME = "FinancialData"
@@ -135,15 +141,11 @@ GLUE_POLICY_ARNS = [
     "arn:aws:iam::aws:policy/AmazonS3FullAccess",
 ]
 DATA_PATH = "../../../resources/FinancialData/"
+PARQUET_DATA_PATH = os.path.join(tempfile.gettempdir(), AGENT_NAME, "FinancialData/")
 RESOURCES_PATH = "../../../resources/"
 
-# Athena constants
-ATHENA_RESULT_LOC = f"s3://{BUCKET_NAME}/athena_result/"
-
 # Lambda constants
 LAMBDA_CODE_PATH = "lambda_function.py"
-LAMBDA_NAME = f"{AGENT_NAME}-{SUFFIX}"
-LAMBDA_ROLE_NAME = f"{AGENT_NAME}-lambda-role-{SUFFIX}"
 LAMBDA_POLICY_ARNS = [
     "arn:aws:iam::aws:policy/AmazonAthenaFullAccess",
     "arn:aws:iam::aws:policy/AWSGlueConsoleFullAccess",
@@ -151,3 +153,84 @@ LAMBDA_POLICY_ARNS = [
     "arn:aws:iam::aws:policy/service-role/AWSGlueServiceRole",
     "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole",
 ]
+
+
+def get_credentials_key():
+    credentials = get_session().get_credentials()
+    if not credentials or not credentials.access_key:
+        return None
+
+    return hashlib.sha256(credentials.access_key.encode()).hexdigest()
+
+
+def read_account_id_cache():
+    try:
+        with open(ACCOUNT_ID_CACHE_PATH) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_account_id_cache(credentials_key, account_id):
+    try:
+        account_ids = read_account_id_cache()
+        account_ids[credentials_key] = account_id
+        os.makedirs(os.path.dirname(ACCOUNT_ID_CACHE_PATH), exist_ok=True)
+        with open(ACCOUNT_ID_CACHE_PATH, "w") as file:
+            json.dump(account_ids, file)
+    except OSError as e:
+        print("Error caching account id:", e)
+
+
+@cache
+def get_account_id():
+    credentials_key = get_credentials_key() if ACCOUNT_ID_CACHE_PATH else None
+    if credentials_key and (account_id := read_account_id_cache().get(credentials_key)):
+        return account_id
+
+    account_id = get_client("sts").get_caller_identity().get("Account")
+    if credentials_key:
+        write_account_id_cache(credentials_key, account_id)
+
+    return account_id
+
+
+# Constants derived from the account id, resolved on first access so that
+# importing this module doesn't need an STS round-trip
+LAZY_CONSTANTS = {
+    "ACCOUNT_ID": get_account_id,
+    "SUFFIX": lambda: f"{REGION}-{resolve('ACCOUNT_ID')}",
+    "AGENT_ROLE_NAME": lambda: f"AmazonBedrockExecutionRoleForAgents_{resolve('SUFFIX')}",
+    # S3 constants
+    "BEDROCK_AGENT_S3_ALLOW_POLICY_NAME": lambda: f"{AGENT_NAME}-s3-allow-{resolve('SUFFIX')}",
+    "BUCKET_NAME": lambda: f"{AGENT_NAME}-{resolve('SUFFIX')}",
+    "SCHEMA_ARN": lambda: f"arn:aws:s3:::{resolve('BUCKET_NAME')}/{SCHEMA_KEY}",
+    "S3_SCHEMA_PATH": lambda: f"{resolve('BUCKET_NAME')}/{SCHEMA_KEY}",
+    "S3_GLUE_TARGET": lambda: f"s3://{resolve('BUCKET_NAME')}/{S3_DATA_PATH}/FinancialData/",
+    # Bedrock constants
+    "BEDROCK_AGENT_BEDROCK_ALLOW_POLICY_NAME": lambda: f"{AGENT_NAME}-allow-{resolve('SUFFIX')}",
+    "BEDROCK_POLICY_ARNS": lambda: [
+        f"arn:aws:iam::{resolve('ACCOUNT_ID')}:policy/{resolve('BEDROCK_AGENT_BEDROCK_ALLOW_POLICY_NAME')}",
+        f"arn:aws:iam::{resolve('ACCOUNT_ID')}:policy/{resolve('BEDROCK_AGENT_S3_ALLOW_POLICY_NAME')}",
+    ],
+    # Athena constants
+    "ATHENA_RESULT_LOC": lambda: f"s3://{resolve('BUCKET_NAME')}/athena_result/",
+    "RESULT_CACHE_LOC": lambda: f"s3://{resolve('BUCKET_NAME')}/{RESULT_CACHE_PATH}/",
+    # Lambda constants
+    "LAMBDA_NAME": lambda: f"{AGENT_NAME}-{resolve('SUFFIX')}",
+    "LAMBDA_ROLE_NAME": lambda: f"{AGENT_NAME}-lambda-role-{resolve('SUFFIX')}",
+}
+
+
+def resolve(name):
+    if name not in globals():
+        globals()[name] = LAZY_CONSTANTS[name]()
+
+    return globals()[name]
+
+
+def __getattr__(name):
+    if name not in LAZY_CONSTANTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    return resolve(name)
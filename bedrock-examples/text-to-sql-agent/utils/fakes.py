@@ -0,0 +1,569 @@
+import csv
+import hashlib
+import io
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from transfer import TRANSFER_CONFIG, compute_etag
+
+
+class FakeAthenaClient:
+    """
+    Local stand-in for the boto3 Athena client, used to benchmark the Lambda offline.
+    Every query "runs" for a configured number of seconds and returns the configured rows.
+    When an S3 stand-in is given, the rows are also written there as the CSV result object.
+    Every API request takes the configured latency.
+    """
+
+    def __init__(
+        self,
+        durations=None,
+        default_duration=1.0,
+        columns=None,
+        rows=None,
+        s3_client=None,
+        data_scanned=10_000_000,
+        latency=0.0,
+    ):
+        self.durations = durations or {}
+        self.default_duration = default_duration
+        self.columns = columns or [("value", "varchar")]
+        self.rows = rows or []
+        self.s3_client = s3_client
+        self.data_scanned = data_scanned
+        self.latency = latency
+        self.calls = Counter()
+        self.executions = {}
+
+    def _request(self, operation):
+        self.calls[operation] += 1
+        time.sleep(self.latency)
+
+    def start_query_execution(self, QueryString, ResultConfiguration=None, **kwargs):
+        self._request("start_query_execution")
+        query_execution_id = str(uuid.uuid4())
+        output_location = (ResultConfiguration or {}).get(
+            "OutputLocation", "s3://local-benchmark/athena_result/"
+        )
+        self.executions[query_execution_id] = {
+            "query": QueryString,
+            "started": time.monotonic(),
+            "duration": self.durations.get(QueryString, self.default_duration),
+            "stopped": False,
+            "output_location": f"{output_location}{query_execution_id}.csv",
+        }
+
+        if self.s3_client is not None:
+            self._write_csv_result(self.executions[query_execution_id])
+
+        return {"QueryExecutionId": query_execution_id}
+
+    def _write_csv_result(self, execution):
+        stream = io.StringIO()
+        writer = csv.writer(stream, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        writer.writerow([name for name, _ in self.columns])
+        writer.writerows(self.rows)
+
+        bucket_name, key = execution["output_location"][5:].split("/", 1)
+        self.s3_client.put_object(
+            Bucket=bucket_name, Key=key, Body=stream.getvalue().encode("utf-8")
+        )
+
+    def _describe(self, query_execution_id):
+        execution = self.executions[query_execution_id]
+        elapsed = time.monotonic() - execution["started"]
+
+        if execution["stopped"]:
+            state = "CANCELLED"
+        elif elapsed < execution["duration"]:
+            state = "RUNNING"
+        else:
+            state = "SUCCEEDED"
+
+        return {
+            "QueryExecutionId": query_execution_id,
+            "Query": execution["query"],
+            "Status": {"State": state},
+            "ResultConfiguration": {"OutputLocation": execution["output_location"]},
+            "Statistics": {
+                "EngineExecutionTimeInMillis": int(
+                    min(elapsed, execution["duration"]) * 1000
+                ),
+                "DataScannedInBytes": self.data_scanned,
+            },
+        }
+
+    def get_query_execution(self, QueryExecutionId):
+        self._request("get_query_execution")
+        return {"QueryExecution": self._describe(QueryExecutionId)}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self._request("batch_get_query_execution")
+        return {
+            "QueryExecutions": [
+                self._describe(query_execution_id)
+                for query_execution_id in QueryExecutionIds
+            ],
+            "UnprocessedQueryExecutionIds": [],
+        }
+
+    def stop_query_execution(self, QueryExecutionId):
+        self._request("stop_query_execution")
+        self.executions[QueryExecutionId]["stopped"] = True
+        return {}
+
+    def get_query_results(self, QueryExecutionId, NextToken=None, MaxResults=1000):
+        self._request("get_query_results")
+        start = int(NextToken or 0)
+        end = start + MaxResults
+
+        rows = []
+        if start == 0:
+            # Athena returns the header as the first row of the first page
+            rows.append({"Data": [{"VarCharValue": name} for name, _ in self.columns]})
+            end -= 1
+
+        rows.extend(
+            {"Data": [{"VarCharValue": str(value)} for value in row]}
+            for row in self.rows[start:end]
+        )
+
+        response = {
+            "ResultSet": {
+                "Rows": rows,
+                "ResultSetMetadata": {
+                    "ColumnInfo": [
+                        {"Name": name, "Type": column_type}
+                        for name, column_type in self.columns
+                    ]
+                },
+            }
+        }
+        if end < len(self.rows):
+            response["NextToken"] = str(end)
+
+        return response
+
+
+class FakeS3Client:
+    """
+    Local in-memory stand-in for the boto3 S3 client.
+    Uploads and downloads can be slowed down with a fixed latency and a bandwidth limit in
+    bytes per second.
+    Listings pay the same latency and return 1000 keys a page, batch deletes take delete_latency.
+    """
+
+    def __init__(
+        self, latency=0.0, bandwidth=None, versioning=None, delete_latency=0.0
+    ):
+        self.objects = {}
+        self.etags = {}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.versioning = versioning
+        self.delete_latency = delete_latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def _count(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        self._count("put_object")
+        self.objects[(Bucket, Key)] = Body
+        self.etags[(Bucket, Key)] = (
+            f'"{hashlib.md5(Body, usedforsecurity=False).hexdigest()}"'
+        )
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, Config=None, **kwargs):
+        self._count("upload_file")
+        with open(Filename, "rb") as file:
+            body = file.read()
+
+        time.sleep(self.latency + (len(body) / self.bandwidth if self.bandwidth else 0))
+        self.objects[(Bucket, Key)] = body
+        self.etags[(Bucket, Key)] = compute_etag(Filename, Config or TRANSFER_CONFIG)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._count("head_object")
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404", "Message": Key}}, "HeadObject")
+
+        return {
+            "ContentLength": len(self.objects[(Bucket, Key)]),
+            "ETag": self.etags[(Bucket, Key)],
+        }
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._count("get_object")
+        if (Bucket, Key) not in self.objects:
+            raise ClientError(
+                {"Error": {"Code": "NoSuchKey", "Message": Key}}, "GetObject"
+            )
+
+        data = self.objects[(Bucket, Key)]
+        time.sleep(self.latency + (len(data) / self.bandwidth if self.bandwidth else 0))
+        return {
+            "Body": StreamingBody(io.BytesIO(data), len(data)),
+            "ContentLength": len(data),
+        }
+
+    def get_bucket_versioning(self, Bucket, **kwargs):
+        self._count("get_bucket_versioning")
+        return {"Status": self.versioning} if self.versioning else {}
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(self, operation_name)
+
+    def list_page(self, operation_name, Bucket, ContinuationToken=None, Prefix=""):
+        self._count(operation_name)
+        time.sleep(self.latency)
+        with self.lock:
+            keys = sorted(
+                key
+                for bucket, key in self.objects
+                if bucket == Bucket and key.startswith(Prefix)
+            )
+
+        # Like S3, the token continues after the last listed key
+        if ContinuationToken:
+            keys = [key for key in keys if key > ContinuationToken]
+        page = keys[:1000]
+        if operation_name == "list_object_versions":
+            response = {"Versions": [{"Key": key, "VersionId": "1"} for key in page]}
+        else:
+            response = {"Contents": [{"Key": key} for key in page]}
+
+        if len(keys) > len(page):
+            response["NextToken"] = page[-1]
+        return response
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._count("delete_objects")
+        if len(Delete.get("Objects", [])) > 1000:
+            raise ClientError(
+                {"Error": {"Code": "MalformedXML", "Message": "Too many keys"}},
+                "DeleteObjects",
+            )
+
+        time.sleep(self.delete_latency)
+        with self.lock:
+            for obj in Delete.get("Objects", []):
+                self.objects.pop((Bucket, obj.get("Key")), None)
+                self.etags.pop((Bucket, obj.get("Key")), None)
+        return {}
+
+
+class FakePaginator:
+    def __init__(self, s3_client, operation_name):
+        self.s3_client = s3_client
+        self.operation_name = operation_name
+
+    def paginate(self, Bucket, Prefix="", **kwargs):
+        token = None
+        while True:
+            response = self.s3_client.list_page(
+                self.operation_name, Bucket, token, Prefix
+            )
+            yield response
+            token = response.get("NextToken")
+            if not token:
+                return
+
+
+def create_model_trace(
+    trace_id, started, duration, prompt, message_content, input_tokens, output_tokens
+):
+    ended = started + duration
+    raw_response = {
+        "output": {"message": {"role": "assistant", "content": message_content}},
+        "stopReason": "tool_use" if "toolUse" in message_content[-1] else "end_turn",
+        "usage": {"inputTokens": input_tokens, "outputTokens": output_tokens},
+    }
+    return [
+        {
+            "trace": {
+                "eventTime": started,
+                "trace": {
+                    "orchestrationTrace": {
+                        "modelInvocationInput": {
+                            "traceId": trace_id,
+                            "type": "ORCHESTRATION",
+                            "text": prompt,
+                        }
+                    }
+                },
+            }
+        },
+        {
+            "trace": {
+                "eventTime": ended,
+                "trace": {
+                    "orchestrationTrace": {
+                        "modelInvocationOutput": {
+                            "traceId": trace_id,
+                            "rawResponse": {"content": json.dumps(raw_response)},
+                            "metadata": {
+                                "startTime": started,
+                                "endTime": ended,
+                                "totalTimeMs": duration / timedelta(milliseconds=1),
+                                "usage": {
+                                    "inputTokens": input_tokens,
+                                    "outputTokens": output_tokens,
+                                },
+                            },
+                        }
+                    }
+                },
+            }
+        },
+    ]
+
+
+def create_action_group_trace(
+    trace_id, started, duration, api_path, parameters, output
+):
+    ended = started + duration
+    return [
+        {
+            "trace": {
+                "eventTime": started,
+                "trace": {
+                    "orchestrationTrace": {
+                        "invocationInput": {
+                            "traceId": trace_id,
+                            "invocationType": "ACTION_GROUP",
+                            "actionGroupInvocationInput": {
+                                "actionGroupName": "QueryAthenaActionGroup",
+                                "apiPath": api_path,
+                                "requestBody": {
+                                    "content": {"application/json": parameters}
+                                },
+                            },
+                        }
+                    }
+                },
+            }
+        },
+        {
+            "trace": {
+                "eventTime": ended,
+                "trace": {
+                    "orchestrationTrace": {
+                        "observation": {
+                            "traceId": trace_id,
+                            "type": "ACTION_GROUP",
+                            "actionGroupInvocationOutput": {
+                                "text": output,
+                                "metadata": {
+                                    "startTime": started,
+                                    "endTime": ended,
+                                    "totalTimeMs": duration / timedelta(milliseconds=1),
+                                },
+                            },
+                        }
+                    }
+                },
+            }
+        },
+    ]
+
+
+def create_trace_events(
+    question,
+    sql,
+    input_tokens=1000,
+    output_tokens=100,
+    schema_lookup=True,
+    timeline_seconds=None,
+):
+    """
+    Builds the events of an invoke_agent completion stream with trace enabled, shaped
+    like a recorded text-to-SQL answer: schema lookup, query and final response steps.
+    Without schema_lookup the agent already knows the schema and starts with the query.
+    With timeline_seconds the step timings are scaled to a timeline of that length.
+    """
+
+    session = uuid.uuid4()
+    prompt = "You are an expert database querying assistant. " * 200 + question
+    schema = (
+        "Table: transaction_data, Schema: transaction_id bigint, amount double. " * 50
+    )
+    results = "".join(
+        f"- **Customer {i}** - ${15234.50 - i * 100:,.2f}\n" for i in range(25)
+    )
+    answer = f"Here are the results of:\n\n```sql\n{sql}\n```\n\n**Query Results:**\n{results}"
+    # Model calls take 1.5s and Lambda calls 0.8s of the recorded timeline
+    clock = datetime.now(timezone.utc)
+    model_time = timedelta(milliseconds=1500)
+    action_group_time = timedelta(milliseconds=800)
+    if timeline_seconds is not None:
+        recorded = (2 + schema_lookup) * model_time + (
+            1 + schema_lookup
+        ) * action_group_time
+        scale = timeline_seconds / recorded.total_seconds()
+        model_time *= scale
+        action_group_time *= scale
+    steps = iter(range(3))
+    events = []
+
+    if schema_lookup:
+        step = next(steps)
+        events += create_model_trace(
+            f"{session}-{step}",
+            clock,
+            model_time,
+            prompt,
+            [
+                {"text": "I need the database schema first."},
+                {
+                    "toolUse": {
+                        "toolUseId": "1",
+                        "name": "GET::QueryAthenaActionGroup::getschema",
+                        "input": {},
+                    }
+                },
+            ],
+            input_tokens,
+            output_tokens,
+        )
+        events += create_action_group_trace(
+            f"{session}-{step}",
+            clock + model_time,
+            action_group_time,
+            "/getschema",
+            [],
+            schema,
+        )
+        clock += model_time + action_group_time
+        prompt += schema
+
+    step = next(steps)
+    events += create_model_trace(
+        f"{session}-{step}",
+        clock,
+        model_time,
+        prompt,
+        [
+            {
+                "toolUse": {
+                    "toolUseId": "2",
+                    "name": "POST::QueryAthenaActionGroup::querydatabase",
+                    "input": {"query": sql},
+                }
+            }
+        ],
+        input_tokens,
+        output_tokens,
+    )
+    events += create_action_group_trace(
+        f"{session}-{step}",
+        clock + model_time,
+        action_group_time,
+        "/querydatabase",
+        [{"name": "query", "type": "string", "value": sql}],
+        "[{'total_spent': '15234.5'}]",
+    )
+    clock += model_time + action_group_time
+
+    step = next(steps)
+    events += create_model_trace(
+        f"{session}-{step}",
+        clock,
+        model_time,
+        prompt,
+        [{"text": answer}],
+        input_tokens,
+        output_tokens,
+    )
+    events += [
+        {
+            "trace": {
+                "eventTime": clock + model_time,
+                "trace": {
+                    "orchestrationTrace": {
+                        "observation": {
+                            "traceId": f"{session}-{step}",
+                            "type": "FINISH",
+                            "finalResponse": {"text": answer},
+                        }
+                    }
+                },
+            }
+        },
+        {"chunk": {"bytes": answer.encode("utf8")}},
+    ]
+    return events
+
+
+class FakeBedrockAgentRuntimeClient:
+    """
+    Local stand-in for the boto3 Bedrock agent runtime client.
+    Every invocation streams the trace events of a recorded answer over the configured
+    number of seconds, and records the peak concurrency. Like the agent, it only looks up
+    the schema when it isn't in the prompt session attributes or earlier in the session.
+    """
+
+    def __init__(
+        self,
+        duration=1.0,
+        sql="SELECT 1",
+        input_tokens=1000,
+        output_tokens=100,
+        scale_trace=False,
+    ):
+        self.duration = duration
+        # The trace timings fit in the duration instead of the recorded timeline
+        self.scale_trace = scale_trace
+        self.sql = sql
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.calls = Counter()
+        self.running = 0
+        self.max_running = 0
+        self.sessions_with_schema = set()
+        self.lock = threading.Lock()
+
+    def invoke_agent(self, inputText, sessionId, sessionState=None, **kwargs):
+        prompt_attributes = (sessionState or {}).get("promptSessionAttributes", {})
+        with self.lock:
+            self.calls["invoke_agent"] += 1
+            schema_lookup = (
+                "database_schema" not in prompt_attributes
+                and sessionId not in self.sessions_with_schema
+            )
+            self.sessions_with_schema.add(sessionId)
+
+        return {
+            "completion": self._stream(inputText, schema_lookup),
+            "sessionId": sessionId,
+        }
+
+    def _stream(self, input_text, schema_lookup):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+        try:
+            events = create_trace_events(
+                input_text,
+                self.sql,
+                self.input_tokens,
+                self.output_tokens,
+                schema_lookup,
+                self.duration if self.scale_trace else None,
+            )
+            for event in events:
+                time.sleep(self.duration / len(events))
+                yield event
+        finally:
+            with self.lock:
+                self.running -= 1
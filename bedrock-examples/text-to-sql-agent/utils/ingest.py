@@ -0,0 +1,79 @@
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+PARQUET_COMPRESSION = "snappy"
+PARQUET_ROW_GROUP_SIZE = 128_000
+# Tables partitioned by year/month of the given timestamp column
+PARTITIONED_TABLES = {
+    "transaction_data": "transaction_date",
+    "sales_data": "sale_date",
+}
+
+
+def read_csv_table(csv_path, partition_column=None):
+    column_types = {}
+    if partition_column:
+        column_types[partition_column] = pa.timestamp("us")
+
+    return pa_csv.read_csv(
+        csv_path,
+        # Addresses in the customer data contain line breaks
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types),
+    )
+
+
+def convert_table(csv_path, table_output_path, partition_column=None):
+    table = read_csv_table(csv_path, partition_column)
+    file_name = os.path.splitext(os.path.basename(csv_path))[0]
+
+    if partition_column:
+        table = table.append_column("year", pc.year(table[partition_column]))
+        table = table.append_column("month", pc.month(table[partition_column]))
+        ds.write_dataset(
+            table,
+            table_output_path,
+            format="parquet",
+            partitioning=["year", "month"],
+            partitioning_flavor="hive",
+            basename_template=f"{file_name}-{{i}}.parquet",
+            file_options=ds.ParquetFileFormat().make_write_options(
+                compression=PARQUET_COMPRESSION
+            ),
+            max_rows_per_group=PARQUET_ROW_GROUP_SIZE,
+            existing_data_behavior="delete_matching",
+        )
+    else:
+        os.makedirs(table_output_path, exist_ok=True)
+        pq.write_table(
+            table,
+            os.path.join(table_output_path, f"{file_name}.parquet"),
+            compression=PARQUET_COMPRESSION,
+            row_group_size=PARQUET_ROW_GROUP_SIZE,
+        )
+
+
+def convert_to_parquet(data_path, output_path):
+    try:
+        shutil.rmtree(output_path, ignore_errors=True)
+
+        for table_name in sorted(os.listdir(data_path)):
+            table_path = os.path.join(data_path, table_name)
+            for filename in sorted(os.listdir(table_path)):
+                if filename.endswith(".csv"):
+                    convert_table(
+                        os.path.join(table_path, filename),
+                        os.path.join(output_path, table_name),
+                        PARTITIONED_TABLES.get(table_name),
+                    )
+
+        print(f"Data converted to Parquet in {output_path} successfully.")
+        return output_path
+    except Exception as e:
+        print(f"Error converting data in {data_path} to Parquet:", e)
@@ -1,12 +1,14 @@
 import json
 import os
-import time
 import zipfile
 from io import BytesIO
 
-from agent import get_agent_id_by_name
+from botocore.exceptions import ClientError
+
+from agent import get_agent_alias_id_by_name, get_agent_id_by_name
 from config.aws_clients import (
     bedrock_agent_client,
+    get_session,
     glue_client,
     iam_client,
     lambda_client,
@@ -33,14 +35,33 @@ from config.constants import (
     LAMBDA_NAME,
     LAMBDA_POLICY_ARNS,
     LAMBDA_ROLE_NAME,
+    PARQUET_DATA_PATH,
     REGION,
-    RESOURCES_PATH,
+    RESULT_CACHE_EXPIRATION_DAYS,
+    RESULT_CACHE_LOC,
+    RESULT_CACHE_PATH,
     S3_DATA_PATH,
     S3_GLUE_TARGET,
     SCHEMA_ARN,
+    SCHEMA_DIGEST_IN_INSTRUCTION,
+    SCHEMA_DIGEST_KEY,
     SCHEMA_KEY,
     SCHEMA_NAME,
 )
+from ingest import convert_to_parquet
+from provisioning import run_steps
+from readiness import (
+    print_readiness_report,
+    retry_until_role_assumable,
+    wait_for_agent,
+    wait_for_agent_alias,
+    wait_for_crawl,
+    wait_for_crawler_ready,
+    wait_for_lambda,
+    wait_for_role,
+)
+from schema import add_schema_digest_to_instruction, publish_schema_digest
+from transfer import create_upload_client, delete_stale_objects, upload_files
 
 
 def create_bucket_and_upload_schema(
@@ -61,6 +82,26 @@ def create_bucket_and_upload_schema(
         print(f"Error {schema_name} uploading schema:", e)
 
 
+def expire_result_cache(s3_client, bucket_name, cache_path, expiration_days):
+    try:
+        s3_client.put_bucket_lifecycle_configuration(
+            Bucket=bucket_name,
+            LifecycleConfiguration={
+                "Rules": [
+                    {
+                        "ID": "expire-result-cache",
+                        "Filter": {"Prefix": f"{cache_path}/"},
+                        "Status": "Enabled",
+                        "Expiration": {"Days": expiration_days},
+                    }
+                ]
+            },
+        )
+        print(f"Result cache lifecycle rule added to {bucket_name} successfully.")
+    except Exception as e:
+        print(f"Error adding the result cache lifecycle rule to {bucket_name}:", e)
+
+
 def create_glue_db(glue_client, account_id, glue_db_name):
     try:
         glue_client.create_database(
@@ -75,17 +116,20 @@ def create_glue_db(glue_client, account_id, glue_db_name):
 
 
 def start_crawler(glue_client, crawler_name):
+    # Returns the start time of the crawl before this one, the crawl step waits for
+    # a newer one
+    previous_start_time = None
     try:
-        crawler = glue_client.get_crawler(Name=crawler_name)
-        if crawler.get("Crawler", {}).get("State", "") == "READY":
+        crawler = glue_client.get_crawler(Name=crawler_name).get("Crawler", {})
+        previous_start_time = crawler.get("LastCrawl", {}).get("StartTime")
+        if crawler.get("State", "") == "READY":
             glue_client.start_crawler(Name=crawler_name)
-            time.sleep(30)
             print(f"Crawler {crawler_name} started successfully.")
-        else:
-            time.sleep(30)
     except Exception as e:
         print(f"Error starting {crawler_name} crawler:", e)
 
+    return previous_start_time
+
 
 def attach_role_policies(iam_client, role_name, policy_arns):
     try:
@@ -139,28 +183,31 @@ def create_policy(iam_client, policy_name, policy_document, policy_arn=None):
 
 def create_crawler(glue_client, crawler_name, role_name, s3_target):
     try:
-        glue_client.create_crawler(
-            Name=crawler_name,
-            Role=role_name,
-            DatabaseName="financialdata",
-            Targets={
-                "CatalogTargets": [],
-                "DeltaTargets": [],
-                "DynamoDBTargets": [],
-                "HudiTargets": [],
-                "IcebergTargets": [],
-                "JdbcTargets": [],
-                "MongoDBTargets": [],
-                "S3Targets": [{"Exclusions": [], "Path": s3_target}],
-            },
-            Classifiers=[],
-            Configuration='{"Version":1.0,"CreatePartitionIndex":true}',
-            LakeFormationConfiguration={
-                "AccountId": "",
-                "UseLakeFormationCredentials": False,
-            },
-            RecrawlPolicy={"RecrawlBehavior": "CRAWL_EVERYTHING"},
-            LineageConfiguration={"CrawlerLineageSettings": "DISABLE"},
+        retry_until_role_assumable(
+            lambda: glue_client.create_crawler(
+                Name=crawler_name,
+                Role=role_name,
+                DatabaseName="financialdata",
+                Targets={
+                    "CatalogTargets": [],
+                    "DeltaTargets": [],
+                    "DynamoDBTargets": [],
+                    "HudiTargets": [],
+                    "IcebergTargets": [],
+                    "JdbcTargets": [],
+                    "MongoDBTargets": [],
+                    "S3Targets": [{"Exclusions": [], "Path": s3_target}],
+                },
+                Classifiers=[],
+                Configuration='{"Version":1.0,"CreatePartitionIndex":true}',
+                LakeFormationConfiguration={
+                    "AccountId": "",
+                    "UseLakeFormationCredentials": False,
+                },
+                RecrawlPolicy={"RecrawlBehavior": "CRAWL_EVERYTHING"},
+                LineageConfiguration={"CrawlerLineageSettings": "DISABLE"},
+            ),
+            f"Crawler {crawler_name}",
         )
         print(f"Crawler {crawler_name} created successfully.")
     except Exception as e:
@@ -169,13 +216,26 @@ def create_crawler(glue_client, crawler_name, role_name, s3_target):
 
 def upload_data(s3_client, s3_path, data_path, bucket_name):
     try:
+        # Keys keep the data folder name, e.g. data/FinancialData/customer_data/...
+        data_root = os.path.dirname(os.path.normpath(data_path))
+        uploads = []
         for root, _, files in os.walk(data_path):
             for filename in files:
                 local_path = os.path.join(root, filename)
                 path = os.path.join(
-                    s3_path, str(os.path.relpath(str(local_path), RESOURCES_PATH))
+                    s3_path, str(os.path.relpath(str(local_path), data_root))
                 )
-                s3_client.upload_file(local_path, bucket_name, path)
+                uploads.append((local_path, path))
+
+        # Earlier runs may have uploaded the other format (CSV or Parquet), the crawler
+        # must only find the files of this upload in each table folder
+        data_prefix = os.path.join(
+            s3_path, os.path.basename(os.path.normpath(data_path))
+        )
+        delete_stale_objects(
+            s3_client, bucket_name, f"{data_prefix}/", [key for _, key in uploads]
+        )
+        upload_files(s3_client, uploads, bucket_name)
 
         print(f"Data uploaded to S3 bucket {bucket_name} successfully.")
     except Exception as e:
@@ -183,7 +243,11 @@ def upload_data(s3_client, s3_path, data_path, bucket_name):
 
 
 def create_lambda_function(
-    lambda_client, lambda_function_name, lambda_role, athena_result_loc
+    lambda_client,
+    lambda_function_name,
+    lambda_role,
+    athena_result_loc,
+    result_cache_loc,
 ):
     try:
         stream = BytesIO()
@@ -191,14 +255,24 @@ def create_lambda_function(
             zip_file.write(LAMBDA_CODE_PATH)
         zip_content = stream.getvalue()
 
-        lambda_function = lambda_client.create_function(
-            FunctionName=lambda_function_name,
-            Runtime="python3.12",
-            Timeout=180,
-            Role=lambda_role.get("Role", {}).get("Arn"),
-            Code={"ZipFile": zip_content},
-            Handler="lambda_function.lambda_handler",
-            Environment={"Variables": {"OUTPUT_LOCATION": athena_result_loc}},
+        lambda_function = retry_until_role_assumable(
+            lambda: lambda_client.create_function(
+                FunctionName=lambda_function_name,
+                Runtime="python3.12",
+                Timeout=180,
+                Role=lambda_role.get("Role", {}).get("Arn"),
+                Code={"ZipFile": zip_content},
+                Handler="lambda_function.lambda_handler",
+                Environment={
+                    "Variables": {
+                        "OUTPUT_LOCATION": athena_result_loc,
+                        "PREWARM_CLIENTS": "true",
+                        "RESULT_CACHE_DIR": "/tmp/result_cache",  # nosec B108
+                        "RESULT_CACHE_S3_LOCATION": result_cache_loc,
+                    }
+                },
+            ),
+            f"Lambda function {lambda_function_name}",
         )
 
         print(f"Lambda function {lambda_function_name} created successfully.")
@@ -219,13 +293,16 @@ def create_lambda_function(
 
 def set_up_agent(bedrock_client, agent_name, model_name, agent_prompt, agent_resources):
     try:
-        response = bedrock_client.create_agent(
-            agentName=agent_name,
-            agentResourceRoleArn=agent_resources.get("Role", {}).get("Arn"),
-            description="Agent for performing SQL queries on financial data.",
-            idleSessionTTLInSeconds=3600,
-            foundationModel=model_name,
-            instruction=agent_prompt,
+        response = retry_until_role_assumable(
+            lambda: bedrock_client.create_agent(
+                agentName=agent_name,
+                agentResourceRoleArn=agent_resources.get("Role", {}).get("Arn"),
+                description="Agent for performing SQL queries on financial data.",
+                idleSessionTTLInSeconds=3600,
+                foundationModel=model_name,
+                instruction=agent_prompt,
+            ),
+            f"Agent {agent_name}",
         )
 
         print(f"Agent {agent_name} created successfully.")
@@ -275,13 +352,29 @@ def add_lambda_permission(lambda_client, lambda_name, region, account_id, agent_
 def prepare_agent(bedrock_client, agent_id, agent_alias_name):
     try:
         bedrock_client.prepare_agent(agentId=agent_id)
-        time.sleep(20)
+        wait_for_agent(bedrock_client, agent_id, ["PREPARED"], replaced_sleep=20)
         print(f"Agent {agent_id} prepared successfully.")
-        bedrock_client.create_agent_alias(
-            agentId=agent_id, agentAliasName=agent_alias_name
-        )
-
-        print(f"Agent alias {agent_alias_name} created successfully.")
+        try:
+            bedrock_client.create_agent_alias(
+                agentId=agent_id, agentAliasName=agent_alias_name
+            )
+            print(f"Agent alias {agent_alias_name} created successfully.")
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConflictException":
+                raise
+
+            # On a re-run, e.g. after the tables changed, the alias exists. Without a
+            # routing configuration it moves to a new version of the prepared draft
+            agent_alias_id = get_agent_alias_id_by_name(
+                bedrock_client, agent_id, agent_alias_name
+            )
+            bedrock_client.update_agent_alias(
+                agentId=agent_id,
+                agentAliasId=agent_alias_id,
+                agentAliasName=agent_alias_name,
+            )
+            wait_for_agent_alias(bedrock_client, agent_id, agent_alias_id)
+            print(f"Agent alias {agent_alias_name} updated successfully.")
     except Exception as e:
         print(
             f"Error preparing agent {agent_id} and creating agent alias {agent_alias_name}:",
@@ -289,137 +382,252 @@ def prepare_agent(bedrock_client, agent_id, agent_alias_name):
         )
 
 
-# All time.sleep() executions are required for granting that AWS entities are finally/fully created
-create_bucket_and_upload_schema(s3_client, BUCKET_NAME, SCHEMA_NAME, SCHEMA_KEY, REGION)
-upload_data(s3_client, S3_DATA_PATH, DATA_PATH, BUCKET_NAME)
+def create_role_with_policies(role_name, role_policy, policy_arns, replaced_sleep):
+    role = create_role(iam_client, role_name, role_policy)
+    attach_role_policies(iam_client, role_name, policy_arns)
+    wait_for_role(iam_client, role_name, policy_arns, replaced_sleep=replaced_sleep)
 
-create_glue_db(glue_client, ACCOUNT_ID, GLUE_DATABASE_NAME)
-create_role(
-    iam_client,
-    GLUE_ROLE_NAME,
-    {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Action": "sts:AssumeRole",
-                "Principal": {"Service": "glue.amazonaws.com"},
-            }
-        ],
-    },
-)
-attach_role_policies(iam_client, GLUE_ROLE_NAME, GLUE_POLICY_ARNS)
-time.sleep(40)
-create_crawler(glue_client, GLUE_CRAWLER_NAME, GLUE_ROLE_NAME, S3_GLUE_TARGET)
-time.sleep(20)
-start_crawler(glue_client, GLUE_CRAWLER_NAME)
+    return role
 
-lambda_role = create_role(
-    iam_client,
-    LAMBDA_ROLE_NAME,
-    {
+
+def assume_role_policy(service):
+    return {
         "Version": "2012-10-17",
         "Statement": [
             {
                 "Effect": "Allow",
                 "Action": "sts:AssumeRole",
-                "Principal": {"Service": "lambda.amazonaws.com"},
+                "Principal": {"Service": service},
             }
         ],
-    },
-)
-attach_role_policies(iam_client, LAMBDA_ROLE_NAME, LAMBDA_POLICY_ARNS)
-time.sleep(40)
-lambda_function = create_lambda_function(
-    lambda_client, LAMBDA_NAME, lambda_role, ATHENA_RESULT_LOC
-)
+    }
 
 
-agent_bedrock_policy = create_policy(
-    iam_client,
-    BEDROCK_AGENT_BEDROCK_ALLOW_POLICY_NAME,
-    {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Action": ["bedrock:InvokeModel*", "bedrock:CreateInferenceProfile"],
-                "Resource": [
-                    "arn:aws:bedrock:*::foundation-model/*",
-                    "arn:aws:bedrock:*:*:inference-profile/*",
-                    "arn:aws:bedrock:*:*:application-inference-profile/*",
-                ],
-            },
-            {
-                "Effect": "Allow",
-                "Action": [
-                    "bedrock:GetInferenceProfile",
-                    "bedrock:ListInferenceProfiles",
-                    "bedrock:DeleteInferenceProfile",
-                    "bedrock:TagResource",
-                    "bedrock:UntagResource",
-                    "bedrock:ListTagsForResource",
-                ],
-                "Resource": [
-                    "arn:aws:bedrock:*:*:inference-profile/*",
-                    "arn:aws:bedrock:*:*:application-inference-profile/*",
-                ],
-            },
-        ],
-    },
-    BEDROCK_POLICY_ARNS[0],
-)
-agent_s3_schema_policy = create_policy(
-    iam_client,
-    BEDROCK_AGENT_S3_ALLOW_POLICY_NAME,
-    {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Sid": "AllowAgentAccessOpenAPISchema",
-                "Effect": "Allow",
-                "Action": ["s3:GetObject"],
-                "Resource": [SCHEMA_ARN],
-            }
-        ],
-    },
-    BEDROCK_POLICY_ARNS[1],
-)
-agent_role = create_role(
-    iam_client,
-    AGENT_ROLE_NAME,
-    {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Principal": {"Service": "bedrock.amazonaws.com"},
-                "Action": "sts:AssumeRole",
-            }
-        ],
-    },
-)
-attach_role_policies(
-    iam_client,
-    AGENT_ROLE_NAME,
-    [
-        agent_bedrock_policy.get("Policy", {}).get("Arn"),
-        agent_s3_schema_policy.get("Policy", {}).get("Arn"),
-    ],
-)
-time.sleep(40)
+def provision_crawler(results):
+    create_crawler(glue_client, GLUE_CRAWLER_NAME, GLUE_ROLE_NAME, S3_GLUE_TARGET)
+    wait_for_crawler_ready(glue_client, GLUE_CRAWLER_NAME, replaced_sleep=20)
 
-agent_id = set_up_agent(
-    bedrock_agent_client, AGENT_NAME, FOUNDATION_MODEL, AGENT_PROMPT, agent_role
-)
-time.sleep(20)
-create_action_group(
-    bedrock_agent_client,
-    agent_id,
-    lambda_function.get("FunctionArn", {}),
-    BUCKET_NAME,
-    SCHEMA_KEY,
-)
-add_lambda_permission(lambda_client, LAMBDA_NAME, REGION, ACCOUNT_ID, agent_id)
-time.sleep(20)
-prepare_agent(bedrock_agent_client, agent_id, AGENT_ALIAS_NAME)
+
+def provision_lambda(results):
+    lambda_function = create_lambda_function(
+        lambda_client,
+        LAMBDA_NAME,
+        results["lambda_role"],
+        ATHENA_RESULT_LOC,
+        RESULT_CACHE_LOC,
+    )
+    wait_for_lambda(lambda_client, LAMBDA_NAME)
+
+    return lambda_function
+
+
+def provision_agent(results):
+    agent_id = set_up_agent(
+        bedrock_agent_client,
+        AGENT_NAME,
+        FOUNDATION_MODEL,
+        AGENT_PROMPT,
+        results["agent_role"],
+    )
+    wait_for_agent(
+        bedrock_agent_client, agent_id, ["NOT_PREPARED", "PREPARED"], replaced_sleep=20
+    )
+
+    return agent_id
+
+
+def provision_action_group(results):
+    create_action_group(
+        bedrock_agent_client,
+        results["agent"],
+        results["lambda"].get("FunctionArn", {}),
+        BUCKET_NAME,
+        SCHEMA_KEY,
+    )
+    wait_for_agent(
+        bedrock_agent_client,
+        results["agent"],
+        ["NOT_PREPARED", "PREPARED"],
+        replaced_sleep=20,
+    )
+
+
+BEDROCK_POLICY_DOCUMENT = {
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Action": ["bedrock:InvokeModel*", "bedrock:CreateInferenceProfile"],
+            "Resource": [
+                "arn:aws:bedrock:*::foundation-model/*",
+                "arn:aws:bedrock:*:*:inference-profile/*",
+                "arn:aws:bedrock:*:*:application-inference-profile/*",
+            ],
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "bedrock:GetInferenceProfile",
+                "bedrock:ListInferenceProfiles",
+                "bedrock:DeleteInferenceProfile",
+                "bedrock:TagResource",
+                "bedrock:UntagResource",
+                "bedrock:ListTagsForResource",
+            ],
+            "Resource": [
+                "arn:aws:bedrock:*:*:inference-profile/*",
+                "arn:aws:bedrock:*:*:application-inference-profile/*",
+            ],
+        },
+    ],
+}
+S3_SCHEMA_POLICY_DOCUMENT = {
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Sid": "AllowAgentAccessOpenAPISchema",
+            "Effect": "Allow",
+            "Action": ["s3:GetObject"],
+            "Resource": [SCHEMA_ARN],
+        }
+    ],
+}
+
+# Each step lists the steps it depends on and runs as soon as they are finished.
+# Readiness waits poll the real resource state instead of sleeping for a fixed time.
+PROVISIONING_STEPS = {
+    "bucket": (
+        [],
+        lambda results: create_bucket_and_upload_schema(
+            s3_client, BUCKET_NAME, SCHEMA_NAME, SCHEMA_KEY, REGION
+        ),
+    ),
+    "result_cache_expiration": (
+        ["bucket"],
+        lambda results: expire_result_cache(
+            s3_client, BUCKET_NAME, RESULT_CACHE_PATH, RESULT_CACHE_EXPIRATION_DAYS
+        ),
+    ),
+    "parquet": ([], lambda results: convert_to_parquet(DATA_PATH, PARQUET_DATA_PATH)),
+    # Falls back to the raw CSV files when the Parquet conversion fails
+    "data": (
+        ["bucket", "parquet"],
+        lambda results: upload_data(
+            create_upload_client(get_session()),
+            S3_DATA_PATH,
+            results["parquet"] or DATA_PATH,
+            BUCKET_NAME,
+        ),
+    ),
+    "glue_db": (
+        [],
+        lambda results: create_glue_db(glue_client, ACCOUNT_ID, GLUE_DATABASE_NAME),
+    ),
+    "glue_role": (
+        [],
+        lambda results: create_role_with_policies(
+            GLUE_ROLE_NAME,
+            assume_role_policy("glue.amazonaws.com"),
+            GLUE_POLICY_ARNS,
+            replaced_sleep=40,
+        ),
+    ),
+    "crawler": (["glue_db", "glue_role"], provision_crawler),
+    "start_crawler": (
+        ["crawler", "data"],
+        lambda results: start_crawler(glue_client, GLUE_CRAWLER_NAME),
+    ),
+    "lambda_role": (
+        [],
+        lambda results: create_role_with_policies(
+            LAMBDA_ROLE_NAME,
+            assume_role_policy("lambda.amazonaws.com"),
+            LAMBDA_POLICY_ARNS,
+            replaced_sleep=40,
+        ),
+    ),
+    "lambda": (["lambda_role"], provision_lambda),
+    "bedrock_policy": (
+        [],
+        lambda results: create_policy(
+            iam_client,
+            BEDROCK_AGENT_BEDROCK_ALLOW_POLICY_NAME,
+            BEDROCK_POLICY_DOCUMENT,
+            BEDROCK_POLICY_ARNS[0],
+        ),
+    ),
+    "s3_schema_policy": (
+        [],
+        lambda results: create_policy(
+            iam_client,
+            BEDROCK_AGENT_S3_ALLOW_POLICY_NAME,
+            S3_SCHEMA_POLICY_DOCUMENT,
+            BEDROCK_POLICY_ARNS[1],
+        ),
+    ),
+    "agent_role": (
+        ["bedrock_policy", "s3_schema_policy"],
+        lambda results: create_role_with_policies(
+            AGENT_ROLE_NAME,
+            assume_role_policy("bedrock.amazonaws.com"),
+            [
+                results["bedrock_policy"].get("Policy", {}).get("Arn"),
+                results["s3_schema_policy"].get("Policy", {}).get("Arn"),
+            ],
+            replaced_sleep=40,
+        ),
+    ),
+    "agent": (["agent_role"], provision_agent),
+    # The action group reads the OpenAPI schema uploaded with the bucket
+    "action_group": (["agent", "lambda", "bucket"], provision_action_group),
+    "permission": (
+        ["agent", "lambda"],
+        lambda results: add_lambda_permission(
+            lambda_client, LAMBDA_NAME, REGION, ACCOUNT_ID, results["agent"]
+        ),
+    ),
+    "prepare": (
+        ["action_group", "permission"]
+        + (["instruction"] if SCHEMA_DIGEST_IN_INSTRUCTION else []),
+        lambda results: prepare_agent(
+            bedrock_agent_client, results["agent"], AGENT_ALIAS_NAME
+        ),
+    ),
+    # The crawler runs while the rest is created, this replaces its fixed sleep
+    "crawl": (
+        ["start_crawler"],
+        lambda results: wait_for_crawl(
+            glue_client,
+            GLUE_CRAWLER_NAME,
+            GLUE_DATABASE_NAME,
+            results["start_crawler"],
+            replaced_sleep=30,
+        ),
+    ),
+    # Compiled from the crawled tables, main.py regenerates it when they change
+    "schema_digest": (
+        ["crawl"],
+        lambda results: publish_schema_digest(
+            glue_client,
+            s3_client,
+            GLUE_DATABASE_NAME,
+            BUCKET_NAME,
+            SCHEMA_DIGEST_KEY,
+            DATA_PATH,
+        ),
+    ),
+}
+
+if SCHEMA_DIGEST_IN_INSTRUCTION:
+    PROVISIONING_STEPS["instruction"] = (
+        ["agent", "schema_digest"],
+        lambda results: add_schema_digest_to_instruction(
+            bedrock_agent_client,
+            results["agent"],
+            AGENT_PROMPT,
+            results["schema_digest"],
+        ),
+    )
+
+run_steps(PROVISIONING_STEPS)
+print_readiness_report()
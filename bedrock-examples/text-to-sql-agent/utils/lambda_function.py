@@ -1,104 +1,841 @@
+import codecs
+import csv
+import hashlib
+import json
 import os
+import random
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import datetime
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-outputLocation = os.environ["OUTPUT_LOCATION"]
+# Set on the Lambda function, the setup scripts import this module without it
+outputLocation = os.environ.get("OUTPUT_LOCATION")
+
+# Clients are created once per container and reused by warm invocations
+PREWARM_CLIENTS = os.environ.get("PREWARM_CLIENTS", "false") == "true"
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.environ.get("MAX_POOL_CONNECTIONS", 20)),
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=60,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+)
+clients = {}
+
+# Query backend, "local" runs the SQL on an embedded SQLite copy of FinancialData
+QUERY_BACKEND = os.environ.get("QUERY_BACKEND", "athena")
+LOCAL_DATA_PATH = os.environ.get(
+    "LOCAL_DATA_PATH",
+    os.path.join(os.path.dirname(__file__), "../../../resources/FinancialData/"),
+)
+# Formats of the CSV values that the Parquet conversion reads as dates and timestamps
+LOCAL_DATE_FORMAT = "%Y-%m-%d"
+LOCAL_TIMESTAMP_FORMATS = ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"]
+# Mirrors the year/month partitions of the Parquet tables uploaded to S3
+LOCAL_PARTITIONED_TABLES = {
+    "transaction_data": "transaction_date",
+    "sales_data": "sale_date",
+}
+local_database = {"connection": None, "tables": []}
+
+# Schema cache, kept at module level to survive across warm Lambda invocations
+SCHEMA_CACHE_TTL_SECONDS = float(os.environ.get("SCHEMA_CACHE_TTL_SECONDS", 300))
+schema_cache = {
+    "schema": None,
+    "version": None,
+    "version_hash": None,
+    "expires_at": 0.0,
+    "requests": 0,
+    "hits": 0,
+}
+
+# Query result cache, an in-memory LRU with optional local disk and S3 tiers
+RESULT_CACHE_TTL_SECONDS = float(os.environ.get("RESULT_CACHE_TTL_SECONDS", 900))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 10_000_000))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_MAX_BYTES = int(
+    os.environ.get("RESULT_CACHE_DISK_MAX_BYTES", 100_000_000)
+)
+RESULT_CACHE_S3_LOCATION = os.environ.get("RESULT_CACHE_S3_LOCATION", "")
+ATHENA_RESULT_REUSE_MINUTES = int(os.environ.get("ATHENA_RESULT_REUSE_MINUTES", 0))
+SQL_QUOTED_PATTERN = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+result_cache = OrderedDict()
+result_cache_metrics = {
+    "hits": 0,
+    "misses": 0,
+    "athena_reuses": 0,
+    "bytes_scanned_avoided": 0,
+    "size": 0,
+}
+
+# Query polling constants, the deadline is kept below the Lambda Timeout=180
+QUERY_TIMEOUT_SECONDS = float(os.environ.get("QUERY_TIMEOUT_SECONDS", 150))
+DEADLINE_SAFETY_MARGIN = 5.0
+POLL_INITIAL_DELAY = 0.2
+POLL_MAX_DELAY = 5.0
+POLL_BACKOFF_FACTOR = 2.0
+POLL_ENGINE_TIME_RATIO = 0.5
+BATCH_GET_QUERY_LIMIT = 50
+RUNNING_STATES = ["QUEUED", "RUNNING"]
+
+# Result fetching constants, Bedrock agents accept up to 25 KB of Lambda response
+RESULT_PAGE_SIZE = 1000
+MAX_RESULT_ROWS = int(os.environ.get("MAX_RESULT_ROWS", 1000))
+MAX_RESULT_BYTES = int(os.environ.get("MAX_RESULT_BYTES", 20000))
+# Results that need more get_query_results pages than the probe and one full page are
+# read from the CSV written to S3, with "api" they are always read page by page
+RESULT_READER = os.environ.get("RESULT_READER", "s3")
+RESULT_PROBE_ROWS = 100
+
+
+def get_client(service_name):
+    if service_name not in clients:
+        clients[service_name] = boto3.client(service_name, config=CLIENT_CONFIG)
+
+    return clients[service_name]
+
+
+def prewarm_clients(service_names=("athena", "glue", "s3")):
+    started = time.perf_counter()
+    for service_name in service_names:
+        get_client(service_name)
+
+    elapsed = time.perf_counter() - started
+    print(f"Clients {list(service_names)} created in {elapsed:.3f}s.")
+
+
+def get_table_version(table):
+    return (
+        table.get("Name", ""),
+        str(table.get("UpdateTime", "")),
+        table.get("VersionId", ""),
+    )
+
+
+def build_schema(table_list):
+    table_schema_list = []
+
+    for table in table_list:
+        # Partition keys are queryable columns too, e.g. year/month of partitioned tables
+        storage_columns = table.get("StorageDescriptor", {}).get("Columns", [])
+        columns = storage_columns + table.get("PartitionKeys", [])
+        schema = {column.get("Name"): column.get("Type") for column in columns}
+        table_schema_list.append({f"Table: {table.get('Name')}": f"Schema: {schema}"})
+
+    return table_schema_list
+
+
+def parse_local_date(value):
+    return datetime.strptime(value, LOCAL_DATE_FORMAT).date().isoformat()
+
+
+def parse_local_timestamp(value):
+    for timestamp_format in LOCAL_TIMESTAMP_FORMATS:
+        try:
+            timestamp = datetime.strptime(value, timestamp_format)
+        except ValueError:
+            continue
+        # Stored the way Athena returns timestamp values
+        return timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+    raise ValueError(f"Invalid timestamp {value!r}")
+
+
+# Converter, Glue type and SQLite type of each column type, tried in order. SQLite has
+# no date types, dates and timestamps are stored as ISO text that sorts correctly.
+LOCAL_STRING_TYPE = (str, "string", "TEXT")
+LOCAL_TIMESTAMP_TYPE = (parse_local_timestamp, "timestamp", "TEXT")
+LOCAL_COLUMN_TYPES = [
+    (int, "bigint", "INTEGER"),
+    (float, "double", "REAL"),
+    (parse_local_date, "date", "TEXT"),
+    LOCAL_TIMESTAMP_TYPE,
+]
+
+
+def infer_column_type(values):
+    for converter, glue_type, sqlite_type in LOCAL_COLUMN_TYPES:
+        try:
+            for value in values:
+                if value != "":
+                    converter(value)
+            return converter, glue_type, sqlite_type
+        except ValueError:
+            continue
+
+    return LOCAL_STRING_TYPE
+
+
+def load_local_table(connection, table_name, csv_path):
+    with open(csv_path, newline="", encoding="utf-8") as csv_file:
+        reader = csv.reader(csv_file)
+        column_names = next(reader)
+        rows = list(reader)
+
+    if partition_column := LOCAL_PARTITIONED_TABLES.get(table_name):
+        index = column_names.index(partition_column)
+        column_names += ["year", "month"]
+        rows = [row + [row[index][:4], str(int(row[index][5:7]))] for row in rows]
+
+    column_types = [infer_column_type(values) for values in zip(*rows)]
+    if partition_column:
+        # Same types as the Parquet tables: ingest.py reads the partition column as
+        # a timestamp, and the crawler registers year/month as string partition keys
+        column_types[index] = LOCAL_TIMESTAMP_TYPE
+        column_types[-2:] = [LOCAL_STRING_TYPE, LOCAL_STRING_TYPE]
+    connection.execute(
+        f"CREATE TABLE {table_name} ("  # nosec B608 - names come from local folders
+        + ", ".join(
+            f'"{name}" {sqlite_type}'
+            for name, (_, _, sqlite_type) in zip(column_names, column_types)
+        )
+        + ")"
+    )
+    connection.executemany(
+        f"INSERT INTO {table_name} VALUES ({', '.join('?' * len(column_names))})",
+        (
+            [
+                converter(value) if value != "" else None
+                for value, (converter, _, _) in zip(row, column_types)
+            ]
+            for row in rows
+        ),
+    )
+
+    columns = [
+        {"Name": name, "Type": glue_type}
+        for name, (_, glue_type, _) in zip(column_names, column_types)
+    ]
+    # Shaped like the Glue table the crawler creates from the Parquet files
+    if partition_column:
+        return {
+            "Name": table_name,
+            "StorageDescriptor": {"Columns": columns[:-2]},
+            "PartitionKeys": columns[-2:],
+        }
+
+    return {"Name": table_name, "StorageDescriptor": {"Columns": columns}}
+
+
+def get_local_database():
+    if local_database["connection"] is None:
+        started = time.perf_counter()
+        connection = sqlite3.connect(":memory:", check_same_thread=False)
+
+        # Every folder is a table, the same way the Glue crawler names them
+        for table_name in sorted(os.listdir(LOCAL_DATA_PATH)):
+            table_path = os.path.join(LOCAL_DATA_PATH, table_name)
+            for filename in sorted(os.listdir(table_path)):
+                if filename.endswith(".csv"):
+                    local_database["tables"].append(
+                        load_local_table(
+                            connection, table_name, os.path.join(table_path, filename)
+                        )
+                    )
+
+        local_database["connection"] = connection
+        elapsed = time.perf_counter() - started
+        print(f"Local database loaded from {LOCAL_DATA_PATH} in {elapsed:.3f}s.")
+
+    return local_database
+
+
+def execute_local_queries(queries):
+    connection = get_local_database().get("connection")
+    results = []
+
+    for query in queries:
+        cursor = connection.execute(query.strip().rstrip(";"))
+        column_names = [column[0] for column in cursor.description or []]
+        # Values are returned as strings, like the VarCharValue cells from Athena
+        rows = (
+            dict(
+                zip(
+                    column_names,
+                    [None if value is None else str(value) for value in row],
+                )
+            )
+            for row in cursor
+        )
+        results.append(
+            take_result_rows(rows, "local", MAX_RESULT_ROWS, MAX_RESULT_BYTES)
+        )
+
+    return results
+
+
+def list_catalog_tables():
+    if QUERY_BACKEND == "local":
+        return list(get_local_database().get("tables")), 0
+
+    glue_client = get_client("glue")
+    table_list = []
+    glue_calls = 0
+
+    # Table columns are part of the get_tables response, no get_table calls needed
+    paginator = glue_client.get_paginator("get_tables")
+    for response in paginator.paginate(DatabaseName="financialdata"):
+        glue_calls += 1
+        table_list.extend(response.get("TableList", []))
+
+    return table_list, glue_calls
+
+
+def refresh_schema_cache():
+    if time.monotonic() < schema_cache["expires_at"]:
+        return 0, False
+
+    table_list, glue_calls = list_catalog_tables()
+
+    version = sorted(get_table_version(table) for table in table_list)
+    rebuilt = version != schema_cache["version"]
+    if rebuilt:
+        print("Glue catalog has changed, rebuilding the schema.")
+        schema_cache["schema"] = build_schema(table_list)
+        schema_cache["version"] = version
+        schema_cache["version_hash"] = hashlib.sha256(
+            repr(version).encode()
+        ).hexdigest()
+
+    schema_cache["expires_at"] = time.monotonic() + SCHEMA_CACHE_TTL_SECONDS
+
+    return glue_calls, rebuilt
 
 
 def get_schema():
     try:
         print("'/getschema' has called.")
-        glue_client = boto3.client("glue")
+        schema_cache["requests"] += 1
 
-        database_name = "financialdata"
-        table_schema_list = []
-        response = glue_client.get_tables(DatabaseName=database_name)
+        glue_calls, rebuilt = refresh_schema_cache()
+        if not rebuilt:
+            schema_cache["hits"] += 1
 
-        table_names = [table.get("Name") for table in response.get("TableList", [])]
-
-        for table_name in table_names:
-            response = glue_client.get_table(
-                DatabaseName=database_name, Name=table_name
-            )
-            columns = (
-                response.get("Table", {})
-                .get("StorageDescriptor", {})
-                .get("Columns", [])
-            )
-            schema = {column.get("Name"): column.get("Type") for column in columns}
-            table_schema_list.append({f"Table: {table_name}": f"Schema: {schema}"})
+        # Without the cache every call costs one get_tables plus one get_table per table
+        saved_calls = 1 + len(schema_cache["schema"]) - glue_calls
+        print(
+            f"Schema cache hit ratio: "
+            f"{schema_cache['hits'] / schema_cache['requests']:.2f}, "
+            f"Glue API calls saved: {saved_calls}."
+        )
 
-        return table_schema_list
+        return schema_cache["schema"]
     except Exception as e:
         error_message = f"Error in 'get_schema' handler occurred: {str(e)}"
         print(error_message)
         return error_message
 
 
-def execute_athena_query(query):
+def normalize_sql(query):
+    # String literals and quoted identifiers are kept as is, everything else is
+    # lowercased with collapsed whitespace
+    parts = SQL_QUOTED_PATTERN.split(query)
+    normalized = "".join(
+        part if i % 2 else re.sub(r"\s+", " ", part).lower()
+        for i, part in enumerate(parts)
+    )
+
+    return re.sub(r"[\s;]+$", "", normalized).strip()
+
+
+def get_catalog_version():
+    # Shares the TTL of the schema cache, so Glue is asked at most once per
+    # SCHEMA_CACHE_TTL_SECONDS and not for every query. When Glue fails the queries
+    # still run, with the last known version or without the result cache.
     try:
-        print("'/querydatabase' has called.")
-        athena_client = boto3.client("athena")
+        refresh_schema_cache()
+    except Exception as e:
+        print("Error refreshing the Glue catalog version:", e)
+
+    return schema_cache["version_hash"]
+
+
+def get_result_cache_key(query, catalog_version):
+    return hashlib.sha256(
+        f"{catalog_version}\n{normalize_sql(query)}".encode()
+    ).hexdigest()
+
+
+def is_cache_entry_expired(entry):
+    return time.time() - entry.get("created", 0) > RESULT_CACHE_TTL_SECONDS
+
+
+def remove_disk_cache_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def evict_disk_cache():
+    # Lambda's /tmp is small and shared with everything else, so expired files go
+    # first and the oldest ones after them until the tier fits its byte budget
+    files = []
+    for item in os.scandir(RESULT_CACHE_DIR):
+        if not item.name.endswith(".json"):
+            continue
+
+        stat = item.stat()
+        if time.time() - stat.st_mtime > RESULT_CACHE_TTL_SECONDS:
+            remove_disk_cache_file(item.path)
+        else:
+            files.append((stat.st_mtime, stat.st_size, item.path))
+
+    size = sum(file_size for _, file_size, _ in files)
+    for _, file_size, path in sorted(files):
+        if size <= RESULT_CACHE_DISK_MAX_BYTES:
+            break
+
+        remove_disk_cache_file(path)
+        size -= file_size
+
+
+def read_disk_cache_entry(cache_key):
+    path = os.path.join(RESULT_CACHE_DIR, f"{cache_key}.json")
+    try:
+        with open(path) as cache_file:
+            entry = json.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error reading result cache file {path}:", e)
+        remove_disk_cache_file(path)
+        return None
+
+    if is_cache_entry_expired(entry):
+        remove_disk_cache_file(path)
+        return None
+
+    return entry
+
+
+def write_disk_cache_entry(cache_key, body):
+    path = os.path.join(RESULT_CACHE_DIR, f"{cache_key}.json")
+    # Written under a temporary name first, a full disk never leaves half a file
+    temporary_path = f"{path}.tmp"
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        with open(temporary_path, "w") as file:
+            file.write(body)
+        os.replace(temporary_path, path)
+        evict_disk_cache()
+    except Exception as e:
+        print(f"Error writing result cache file {path}:", e)
+        remove_disk_cache_file(temporary_path)
+
+
+def get_s3_cache_location(cache_key):
+    bucket_name, prefix = RESULT_CACHE_S3_LOCATION.removeprefix("s3://").split("/", 1)
+    return bucket_name, f"{prefix}{cache_key}.json"
+
+
+def read_s3_cache_entry(cache_key):
+    key = cache_key
+    try:
+        # A malformed RESULT_CACHE_S3_LOCATION only skips the S3 tier
+        bucket_name, key = get_s3_cache_location(cache_key)
+        response = get_client("s3").get_object(Bucket=bucket_name, Key=key)
+        entry = json.loads(response.get("Body").read())
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "NoSuchKey":
+            print(f"Error reading result cache object {key}:", e)
+        return None
+    except Exception as e:
+        print(f"Error reading result cache object {key}:", e)
+        return None
+
+    if is_cache_entry_expired(entry):
+        try:
+            get_client("s3").delete_object(Bucket=bucket_name, Key=key)
+        except Exception as e:
+            print(f"Error deleting expired result cache object {key}:", e)
+        return None
 
-        response = athena_client.start_query_execution(
-            QueryString=query,
-            QueryExecutionContext={"Database": "financialdata"},
-            ResultConfiguration={"OutputLocation": outputLocation},
+    return entry
+
+
+def write_s3_cache_entry(cache_key, body):
+    key = cache_key
+    try:
+        bucket_name, key = get_s3_cache_location(cache_key)
+        get_client("s3").put_object(Bucket=bucket_name, Key=key, Body=body.encode())
+    except Exception as e:
+        print(f"Error writing result cache object {key}:", e)
+
+
+# The disk and S3 tiers only save work, their failures are logged and the query
+# runs as if the result wasn't cached
+def read_result_cache_tier(cache_key):
+    entry = None
+
+    if RESULT_CACHE_DIR:
+        entry = read_disk_cache_entry(cache_key)
+
+    if entry is None and RESULT_CACHE_S3_LOCATION:
+        entry = read_s3_cache_entry(cache_key)
+
+    return entry
+
+
+def write_result_cache_tier(cache_key, entry):
+    body = json.dumps(entry)
+
+    if RESULT_CACHE_DIR:
+        write_disk_cache_entry(cache_key, body)
+
+    if RESULT_CACHE_S3_LOCATION:
+        write_s3_cache_entry(cache_key, body)
+
+
+def put_memory_cache_entry(cache_key, entry):
+    if cache_key in result_cache:
+        result_cache_metrics["size"] -= result_cache.pop(cache_key).get("size", 0)
+
+    result_cache[cache_key] = entry
+    result_cache_metrics["size"] += entry.get("size", 0)
+
+    while result_cache and result_cache_metrics["size"] > RESULT_CACHE_MAX_BYTES:
+        _, evicted = result_cache.popitem(last=False)
+        result_cache_metrics["size"] -= evicted.get("size", 0)
+
+
+def get_cached_result(cache_key):
+    entry = result_cache.get(cache_key) or read_result_cache_tier(cache_key)
+
+    if entry is None or is_cache_entry_expired(entry):
+        if cache_key in result_cache:
+            result_cache_metrics["size"] -= result_cache.pop(cache_key).get("size", 0)
+        result_cache_metrics["misses"] += 1
+        return None
+
+    put_memory_cache_entry(cache_key, entry)
+    result_cache_metrics["hits"] += 1
+    result_cache_metrics["bytes_scanned_avoided"] += entry.get("data_scanned", 0)
+
+    return entry.get("result")
+
+
+def put_cached_result(cache_key, result, data_scanned):
+    entry = {"result": result, "created": time.time(), "data_scanned": data_scanned}
+    entry["size"] = len(json.dumps(result))
+
+    put_memory_cache_entry(cache_key, entry)
+    write_result_cache_tier(cache_key, entry)
+
+
+def get_query_deadline(context=None):
+    deadline = time.monotonic() + QUERY_TIMEOUT_SECONDS
+
+    if context is not None:
+        remaining = (
+            context.get_remaining_time_in_millis() / 1000 - DEADLINE_SAFETY_MARGIN
         )
+        deadline = min(deadline, time.monotonic() + remaining)
+
+    return deadline
+
+
+def get_query_state(query_execution):
+    return query_execution.get("Status", {}).get("State", "")
+
+
+def next_poll_delay(attempt, engine_time_ms, remaining):
+    backoff = min(POLL_MAX_DELAY, POLL_INITIAL_DELAY * POLL_BACKOFF_FACTOR**attempt)
+    # A query that has already been running for a while usually needs a comparable
+    # amount of time to finish, so there is no point in polling it much sooner.
+    predicted = engine_time_ms / 1000 * POLL_ENGINE_TIME_RATIO
+    delay = min(POLL_MAX_DELAY, max(backoff, predicted))
+    delay = random.uniform(delay / 2, delay)  # nosec B311 - jitter, not crypto
 
+    return max(0.0, min(delay, remaining))
+
+
+def start_queries(athena_client, queries):
+    query_execution_ids = []
+    request = {
+        "QueryExecutionContext": {"Database": "financialdata"},
+        "ResultConfiguration": {"OutputLocation": outputLocation},
+    }
+    if ATHENA_RESULT_REUSE_MINUTES:
+        request["ResultReuseConfiguration"] = {
+            "ResultReuseByAgeConfiguration": {
+                "Enabled": True,
+                "MaxAgeInMinutes": ATHENA_RESULT_REUSE_MINUTES,
+            }
+        }
+
+    for query in queries:
+        response = athena_client.start_query_execution(QueryString=query, **request)
         query_execution_id = response.get("QueryExecutionId")
         print(f"Query Execution ID: {query_execution_id}")
+        query_execution_ids.append(query_execution_id)
+
+    return query_execution_ids
 
-        response_wait = athena_client.get_query_execution(
-            QueryExecutionId=query_execution_id
-        )
 
-        while response_wait.get("QueryExecution", {}).get("Status", {}).get(
-            "State", ""
-        ) in ["QUEUED", "RUNNING"]:
-            print("Query is still running.")
-            response_wait = athena_client.get_query_execution(
-                QueryExecutionId=query_execution_id
+def wait_for_queries(athena_client, query_execution_ids, deadline):
+    pending = list(dict.fromkeys(query_execution_ids))
+    query_executions = {}
+    attempt = 0
+
+    while pending:
+        for start in range(0, len(pending), BATCH_GET_QUERY_LIMIT):
+            end = start + BATCH_GET_QUERY_LIMIT
+            response = athena_client.batch_get_query_execution(
+                QueryExecutionIds=pending[start:end]
             )
+            for query_execution in response.get("QueryExecutions", []):
+                query_executions[query_execution.get("QueryExecutionId")] = (
+                    query_execution
+                )
+
+        pending = [
+            query_execution_id
+            for query_execution_id in pending
+            if get_query_state(query_executions.get(query_execution_id, {}))
+            in RUNNING_STATES
+            or query_execution_id not in query_executions
+        ]
+        if not pending:
+            break
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            for query_execution_id in pending:
+                athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
+                print(f"Query {query_execution_id} exceeded the deadline, stopped.")
+            break
+
+        engine_time_ms = min(
+            query_executions.get(query_execution_id, {})
+            .get("Statistics", {})
+            .get("EngineExecutionTimeInMillis", 0)
+            for query_execution_id in pending
+        )
+        delay = next_poll_delay(attempt, engine_time_ms, remaining)
+        print(f"{len(pending)} queries are still running, next poll in {delay:.2f}s.")
+        time.sleep(delay)
+        attempt += 1
+
+    return query_executions
+
+
+def execute_athena_queries(queries, deadline=None):
+    if QUERY_BACKEND == "local":
+        return execute_local_queries(queries)
+
+    athena_client = get_client("athena")
+    s3_client = get_client("s3")
+    deadline = deadline or get_query_deadline()
+
+    catalog_version = get_catalog_version()
+    cache_keys = [get_result_cache_key(query, catalog_version) for query in queries]
+    # Without a catalog version, cached results of changed tables can't be told apart
+    results = [
+        get_cached_result(cache_key) if catalog_version else None
+        for cache_key in cache_keys
+    ]
+    # Queries that normalize to the same SQL are executed only once
+    missed = {}
+    for i, result in enumerate(results):
+        if result is None:
+            missed.setdefault(cache_keys[i], []).append(i)
+
+    query_execution_ids = start_queries(
+        athena_client, [queries[indexes[0]] for indexes in missed.values()]
+    )
+    query_executions = wait_for_queries(athena_client, query_execution_ids, deadline)
 
-        if (
-            response_wait.get("QueryExecution", {}).get("Status", {}).get("State", "")
-            == "SUCCEEDED"
-        ):
+    for (cache_key, indexes), query_execution_id in zip(
+        missed.items(), query_execution_ids
+    ):
+        query_execution = query_executions.get(query_execution_id, {})
+
+        if get_query_state(query_execution) == "SUCCEEDED":
             print("Query succeeded!")
-            query_results = athena_client.get_query_results(
-                QueryExecutionId=query_execution_id
+            extracted_output = fetch_result_data(
+                athena_client, s3_client, query_execution
             )
-            extracted_output = extract_result_data(query_results)
             print(extracted_output)
-            return extracted_output
+            for i in indexes:
+                results[i] = extracted_output
 
+            statistics = query_execution.get("Statistics", {})
+            if statistics.get("ResultReuseInformation", {}).get("ReusedPreviousResult"):
+                result_cache_metrics["athena_reuses"] += 1
+            if catalog_version:
+                put_cached_result(
+                    cache_key,
+                    extracted_output,
+                    statistics.get("DataScannedInBytes", 0),
+                )
         else:
             print(f"Query {query_execution_id} haven't reached 'SUCCEEDED' status.")
-            return None
+
+    print(
+        f"Result cache hits: {result_cache_metrics['hits']}, "
+        f"misses: {result_cache_metrics['misses']}, "
+        f"Athena result reuses: {result_cache_metrics['athena_reuses']}, "
+        f"bytes scanned avoided: {result_cache_metrics['bytes_scanned_avoided']}."
+    )
+
+    return results
+
+
+def execute_athena_query(query, deadline=None):
+    try:
+        print("'/querydatabase' has called.")
+        return execute_athena_queries([query], deadline)[0]
     except Exception as e:
         error_message = f"Error in 'execute_athena_query' handler occurred: {str(e)}\nExecution query: {query}"
         print(error_message)
         return error_message
 
 
-def extract_result_data(query_results):
-    result_data = []
-
+def get_column_names(query_results):
     column_info = (
         query_results.get("ResultSet", {})
         .get("ResultSetMetadata", {})
         .get("ColumnInfo", [])
     )
-    column_names = [column.get("Name") for column in column_info]
+    return [column.get("Name") for column in column_info]
+
+
+def extract_row_data(row, column_names):
+    data = [item.get("VarCharValue") for item in row.get("Data", [])]
+    return dict(zip(column_names, data))
+
+
+def extract_result_data(query_results):
+    column_names = get_column_names(query_results)
+
+    return [
+        extract_row_data(row, column_names)
+        for row in query_results.get("ResultSet", {}).get("Rows", [])[1:]
+    ]
+
+
+def iter_result_rows(
+    athena_client, query_execution_id, query_results=None, page_size=RESULT_PAGE_SIZE
+):
+    request = {"QueryExecutionId": query_execution_id, "MaxResults": page_size}
+    if query_results is None:
+        query_results = athena_client.get_query_results(**request)
+
+    column_names = get_column_names(query_results)
+    # Only the first page starts with the header row
+    rows = query_results.get("ResultSet", {}).get("Rows", [])[1:]
+
+    while True:
+        for row in rows:
+            yield extract_row_data(row, column_names)
+
+        if not query_results.get("NextToken"):
+            return
+
+        request["NextToken"] = query_results.get("NextToken")
+        query_results = athena_client.get_query_results(**request)
+        rows = query_results.get("ResultSet", {}).get("Rows", [])
+
+
+def take_result_rows(rows, query_execution_id, max_rows, max_bytes):
+    result_data = []
+    result_size = 2  # Brackets of the stringified list
+
+    for row in rows:
+        row_size = len(str(row)) + 2
+        if len(result_data) >= max_rows or result_size + row_size > max_bytes:
+            print(
+                f"Query {query_execution_id} result was truncated to "
+                f"{len(result_data)} rows ({result_size} bytes)."
+            )
+            break
 
-    for row in query_results.get("ResultSet", {}).get("Rows", [])[1:]:
-        data = [item.get("VarCharValue") for item in row.get("Data", [])]
-        result_data.append(dict(zip(column_names, data)))
+        result_data.append(row)
+        result_size += row_size
 
     return result_data
 
 
+def iter_csv_result_rows(body, column_names):
+    reader = csv.reader(codecs.getreader("utf-8")(body))
+    next(reader, None)  # Header row
+
+    for raw_row in reader:
+        # Values stay strings like the VarCharValue cells, and Athena writes NULL as
+        # an empty field
+        yield dict(
+            zip(column_names, [value if value != "" else None for value in raw_row])
+        )
+
+
+def read_csv_result_data(s3_client, output_location, column_names, max_rows, max_bytes):
+    bucket_name, key = output_location.removeprefix("s3://").split("/", 1)
+    body = s3_client.get_object(Bucket=bucket_name, Key=key).get("Body")
+
+    try:
+        return take_result_rows(
+            iter_csv_result_rows(body, column_names),
+            output_location,
+            max_rows,
+            max_bytes,
+        )
+    finally:
+        # Stops the streamed GET instead of downloading the rest of the object
+        body.close()
+
+
+def is_csv_result_worth_reading(probe_rows, max_rows, max_bytes):
+    # The page reader needs one more request for up to RESULT_PAGE_SIZE rows, the
+    # CSV object only saves requests when the budget allows more than that
+    row_size = sum(len(str(row)) + 2 for row in probe_rows) / max(len(probe_rows), 1)
+    budget_rows = min(max_rows, max_bytes / max(row_size, 1))
+    return budget_rows > len(probe_rows) + RESULT_PAGE_SIZE
+
+
+def fetch_result_data(
+    athena_client,
+    s3_client,
+    query_execution,
+    max_rows=MAX_RESULT_ROWS,
+    max_bytes=MAX_RESULT_BYTES,
+):
+    query_execution_id = query_execution.get("QueryExecutionId")
+    output_location = query_execution.get("ResultConfiguration", {}).get(
+        "OutputLocation", ""
+    )
+
+    query_results = athena_client.get_query_results(
+        QueryExecutionId=query_execution_id, MaxResults=RESULT_PROBE_ROWS
+    )
+
+    if (
+        query_results.get("NextToken")
+        and RESULT_READER == "s3"
+        and output_location.endswith(".csv")
+        and is_csv_result_worth_reading(
+            extract_result_data(query_results), max_rows, max_bytes
+        )
+    ):
+        print(f"Reading query {query_execution_id} result from {output_location}.")
+        return read_csv_result_data(
+            s3_client,
+            output_location,
+            get_column_names(query_results),
+            max_rows,
+            max_bytes,
+        )
+
+    rows = iter_result_rows(athena_client, query_execution_id, query_results)
+    return take_result_rows(rows, query_execution_id, max_rows, max_bytes)
+
+
 def lambda_handler(event, context):
     result = None
     print("Lambda handler has called.")
@@ -119,7 +856,7 @@ def lambda_handler(event, context):
             query = properties[0].get("value")
 
             if query:
-                result = execute_athena_query(query)
+                result = execute_athena_query(query, get_query_deadline(context))
 
     if not result:
         print("Call failed.")
@@ -139,3 +876,8 @@ def lambda_handler(event, context):
     }
 
     return api_response
+
+
+# Lambda init runs with boosted CPU, so building the clients there shortens the first call
+if PREWARM_CLIENTS:
+    prewarm_clients()
@@ -0,0 +1,218 @@
+import math
+import os
+from datetime import datetime, timedelta, timezone
+
+from agent import ActionGroupEvent, ModelInvocationEvent, ToolCallEvent
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+WATERFALL_WIDTH = 40
+MODEL_SPAN_NAMES = {
+    "preProcessingTrace": "llm:pre-processing",
+    "postProcessingTrace": "llm:post-processing",
+    "routingClassifierTrace": "llm:routing",
+}
+
+
+class AgentProfiler:
+    """
+    Builds the waterfall of a single agent invocation from its decoded trace events,
+    with a span per model invocation and per action group (Lambda) call.
+    Orchestration model calls that ask for a tool are named llm:plan, the rest llm:answer.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.open_spans = {}
+        self.tool_steps = set()
+
+    def add(self, agent_event):
+        if isinstance(agent_event, ModelInvocationEvent):
+            self.add_span(agent_event, ("model", agent_event.step), agent_event.stage)
+        elif isinstance(agent_event, ActionGroupEvent):
+            self.add_span(agent_event, ("action_group", agent_event.step), None)
+        elif isinstance(agent_event, ToolCallEvent):
+            self.tool_steps.add(agent_event.step)
+
+    def add_span(self, agent_event, key, stage):
+        event_time = agent_event.event_time or datetime.now(timezone.utc)
+
+        if agent_event.phase == "input":
+            self.open_spans[key] = {
+                "kind": key[0],
+                "stage": stage,
+                "step": key[1],
+                "api_path": getattr(agent_event, "api_path", None),
+                "start": event_time,
+            }
+            return
+
+        span = self.open_spans.pop(key, None) or {
+            "kind": key[0],
+            "stage": stage,
+            "step": key[1],
+            "api_path": None,
+            "start": event_time,
+        }
+        # The trace metadata holds the service side timings when available
+        metadata = agent_event.metadata
+        span["start"] = metadata.get("startTime", span["start"])
+        span["end"] = metadata.get("endTime", event_time)
+        span["duration_ms"] = metadata.get(
+            "totalTimeMs", (span["end"] - span["start"]).total_seconds() * 1000
+        )
+        usage = getattr(agent_event, "usage", {})
+        span["input_tokens"] = usage.get("inputTokens", 0)
+        span["output_tokens"] = usage.get("outputTokens", 0)
+        self.spans.append(span)
+
+    def get_span_name(self, span):
+        if span["kind"] == "action_group":
+            return f"action:{span['api_path'] or 'unknown'}"
+
+        if span["stage"] in MODEL_SPAN_NAMES:
+            return MODEL_SPAN_NAMES[span["stage"]]
+
+        return "llm:plan" if span["step"] in self.tool_steps else "llm:answer"
+
+    def waterfall(self):
+        if not self.spans:
+            return []
+
+        started = min(span["start"] for span in self.spans)
+        return [
+            {
+                "name": self.get_span_name(span),
+                "step": span["step"],
+                "offset_ms": round((span["start"] - started).total_seconds() * 1000),
+                "duration_ms": round(span["duration_ms"]),
+                "input_tokens": span["input_tokens"],
+                "output_tokens": span["output_tokens"],
+                "start_time": span["start"].isoformat(),
+            }
+            for span in sorted(self.spans, key=lambda span: span["start"])
+        ]
+
+
+def format_waterfall(waterfall, width=WATERFALL_WIDTH):
+    if not waterfall:
+        return "No trace timings received."
+
+    total_ms = max(span["offset_ms"] + span["duration_ms"] for span in waterfall) or 1
+    lines = [
+        f"{'Step':<22} {'Start':>8} {'Duration':>9} {'Tokens in/out':>14}  Timeline"
+    ]
+    for span in waterfall:
+        offset = round(span["offset_ms"] / total_ms * width)
+        length = max(1, round(span["duration_ms"] / total_ms * width))
+        lines.append(
+            f"{span['name']:<22} {span['offset_ms'] / 1000:7.2f}s "
+            f"{span['duration_ms'] / 1000:8.2f}s "
+            f"{span['input_tokens']:>7}/{span['output_tokens']:<6} "
+            f"|{' ' * offset}{'#' * length}{' ' * (width - offset - length)}|"
+        )
+
+    return "\n".join(lines)
+
+
+def to_otel_spans(waterfall, question, service_name="text-to-sql-agent"):
+    # OTLP JSON, can be sent to any OpenTelemetry collector over HTTP
+    trace_id = os.urandom(16).hex()
+    root_span_id = os.urandom(8).hex()
+
+    def to_nanos(start_time, offset_ms=0):
+        started = datetime.fromisoformat(start_time) + timedelta(milliseconds=offset_ms)
+        return str((started - EPOCH) // timedelta(microseconds=1) * 1000)
+
+    spans = []
+    for span in waterfall:
+        spans.append(
+            {
+                "traceId": trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": root_span_id,
+                "name": span["name"],
+                "startTimeUnixNano": to_nanos(span["start_time"]),
+                "endTimeUnixNano": to_nanos(span["start_time"], span["duration_ms"]),
+                "attributes": [
+                    {"key": "agent.step", "value": {"stringValue": span["step"] or ""}},
+                    {
+                        "key": "gen_ai.usage.input_tokens",
+                        "value": {"intValue": span["input_tokens"]},
+                    },
+                    {
+                        "key": "gen_ai.usage.output_tokens",
+                        "value": {"intValue": span["output_tokens"]},
+                    },
+                ],
+            }
+        )
+
+    if waterfall:
+        ends = [int(span["endTimeUnixNano"]) for span in spans]
+        spans.insert(
+            0,
+            {
+                "traceId": trace_id,
+                "spanId": root_span_id,
+                "name": "invoke_agent",
+                "startTimeUnixNano": spans[0]["startTimeUnixNano"],
+                "endTimeUnixNano": str(max(ends)),
+                "attributes": [
+                    {"key": "agent.question", "value": {"stringValue": question}}
+                ],
+            },
+        )
+
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": service_name}}
+                    ]
+                },
+                "scopeSpans": [
+                    {"scope": {"name": "text-to-sql-agent.profiler"}, "spans": spans}
+                ],
+            }
+        ]
+    }
+
+
+def get_percentile(values, percentile):
+    # Nearest-rank percentile, exact for the small samples of a batch run
+    values = sorted(values)
+    return values[max(0, math.ceil(percentile / 100 * len(values)) - 1)]
+
+
+def summarize_waterfalls(waterfalls, latencies):
+    durations = {"total": [latency * 1000 for latency in latencies]}
+    for waterfall in waterfalls:
+        per_question = {}
+        for span in waterfall:
+            per_question[span["name"]] = (
+                per_question.get(span["name"], 0) + span["duration_ms"]
+            )
+        for name, duration in per_question.items():
+            durations.setdefault(name, []).append(duration)
+
+    return {
+        name: {
+            "count": len(values),
+            "p50_ms": get_percentile(values, 50),
+            "p95_ms": get_percentile(values, 95),
+        }
+        for name, values in durations.items()
+        if values
+    }
+
+
+def format_summary(summary):
+    lines = [f"{'Step':<22} {'Questions':>9} {'p50':>9} {'p95':>9}"]
+    for name, stats in sorted(summary.items()):
+        lines.append(
+            f"{name:<22} {stats['count']:>9} {stats['p50_ms'] / 1000:8.2f}s "
+            f"{stats['p95_ms'] / 1000:8.2f}s"
+        )
+
+    return "\n".join(lines)
@@ -0,0 +1,111 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+PROVISIONING_MAX_WORKERS = 8
+
+
+def run_step(name, function, results):
+    started = time.monotonic()
+    failed = False
+    try:
+        result = function(results)
+    except Exception as e:
+        print(f"Error running step {name}:", e)
+        result = None
+        failed = True
+
+    return result, failed, started, time.monotonic()
+
+
+def get_critical_path(steps, timings):
+    finished = {}
+
+    def finish_time(name):
+        if name not in finished:
+            dependencies, _ = steps[name]
+            started, ended = timings[name]
+            finished[name] = max(
+                (finish_time(dependency) for dependency in dependencies), default=0
+            ) + (ended - started)
+        return finished[name]
+
+    # Failed steps count up to their failure, skipped steps not at all
+    return max((finish_time(name) for name in timings), default=0)
+
+
+def run_steps(steps, max_workers=PROVISIONING_MAX_WORKERS):
+    for name, (dependencies, _) in steps.items():
+        if unknown := set(dependencies) - set(steps):
+            raise ValueError(f"Step {name} depends on unknown steps {unknown}")
+
+    pending = dict(steps)
+    running = {}
+    results = {}
+    timings = {}
+    # Steps that failed, and steps skipped because a step they depend on failed or
+    # was skipped itself, with that step
+    failed = set()
+    skipped = {}
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            progressed = False
+            for name, (dependencies, function) in list(pending.items()):
+                if blocked := [
+                    dependency
+                    for dependency in dependencies
+                    if dependency in failed or dependency in skipped
+                ]:
+                    del pending[name]
+                    skipped[name] = blocked
+                    print(f"Step {name} skipped, it depends on {', '.join(blocked)}.")
+                    progressed = True
+                elif all(dependency in results for dependency in dependencies):
+                    del pending[name]
+                    future = executor.submit(run_step, name, function, results)
+                    running[future] = name
+                    progressed = True
+
+            if not running:
+                # Skipping a step may unblock the skipping of its dependents
+                if progressed:
+                    continue
+                raise ValueError(f"Steps {list(pending)} have circular dependencies")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                result, step_failed, step_started, step_ended = future.result()
+                timings[name] = (step_started, step_ended)
+                if step_failed:
+                    failed.add(name)
+                    print(f"Step {name} failed after {step_ended - step_started:.1f}s.")
+                else:
+                    results[name] = result
+                    print(f"Step {name} finished in {step_ended - step_started:.1f}s.")
+
+    elapsed = time.monotonic() - started
+    serial = sum(ended - step_started for step_started, ended in timings.values())
+    print(
+        f"All steps took {elapsed:.1f}s, critical path "
+        f"{get_critical_path(steps, timings):.1f}s, serial run {serial:.1f}s."
+    )
+    for name, (step_started, step_ended) in sorted(
+        timings.items(), key=lambda item: item[1]
+    ):
+        print(
+            f"  {name:<20} {step_started - started:7.1f}s -> "
+            f"{step_ended - started:7.1f}s{' (failed)' if name in failed else ''}"
+        )
+
+    if skipped:
+        print(f"{len(skipped)} steps were skipped:")
+        for name, blocked in skipped.items():
+            reasons = [
+                f"{dependency} {'failed' if dependency in failed else 'was skipped'}"
+                for dependency in blocked
+            ]
+            print(f"  {name:<20} {', '.join(reasons)}")
+
+    return results
@@ -0,0 +1,220 @@
+import threading
+import time
+
+from botocore.exceptions import ClientError, ParamValidationError
+
+READINESS_TIMEOUT = 600
+READINESS_INITIAL_DELAY = 1.0
+READINESS_MAX_DELAY = 15.0
+# IAM is eventually consistent, other services may not be able to assume a new role
+# right away and reject it until then
+ROLE_PROPAGATION_TIMEOUT = 120
+ROLE_PROPAGATION_ERROR_CODES = [
+    "InvalidInputException",
+    "InvalidParameterValueException",
+    "ValidationException",
+]
+NOT_FOUND_ERROR_CODES = [
+    "404",
+    "EntityNotFoundException",
+    "NoSuchBucket",
+    "NoSuchEntity",
+    "ResourceNotFoundException",
+]
+# Waiting longer won't fix these, the resource should exist and be accessible
+NON_RETRYABLE_ERROR_CODES = NOT_FOUND_ERROR_CODES + [
+    "AccessDenied",
+    "AccessDeniedException",
+    "UnauthorizedOperation",
+]
+readiness_report = {"waited": 0.0, "replaced": 0.0}
+# Waits run concurrently on the provisioning thread pool
+readiness_report_lock = threading.Lock()
+
+
+def wait_until(check, description, replaced_sleep=0.0, timeout=READINESS_TIMEOUT):
+    started = time.monotonic()
+    delay = READINESS_INITIAL_DELAY
+
+    while True:
+        try:
+            ready = check()
+        except ParamValidationError:
+            raise
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in NON_RETRYABLE_ERROR_CODES:
+                print(f"{description} can't become ready:", e)
+                raise
+
+            print(f"{description} is not ready yet:", e)
+            ready = False
+        except Exception as e:
+            print(f"{description} is not ready yet:", e)
+            ready = False
+
+        elapsed = time.monotonic() - started
+        if ready:
+            with readiness_report_lock:
+                readiness_report["waited"] += elapsed
+                readiness_report["replaced"] += replaced_sleep
+            print(
+                f"{description} is ready after {elapsed:.1f}s "
+                f"({replaced_sleep - elapsed:.1f}s saved against the fixed sleep)."
+            )
+            return True
+
+        if elapsed >= timeout:
+            print(f"{description} didn't become ready in {timeout}s.")
+            return False
+
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * 2, READINESS_MAX_DELAY)
+
+
+def is_role_propagation_error(error):
+    error = error.response.get("Error", {})
+    return (
+        error.get("Code") in ROLE_PROPAGATION_ERROR_CODES
+        and "assum" in error.get("Message", "").lower()
+    )
+
+
+def retry_until_role_assumable(create, description, timeout=ROLE_PROPAGATION_TIMEOUT):
+    """Calls create until the service it calls can assume the new role."""
+    started = time.monotonic()
+    delay = READINESS_INITIAL_DELAY
+
+    while True:
+        try:
+            result = create()
+        except ClientError as e:
+            elapsed = time.monotonic() - started
+            if not is_role_propagation_error(e) or elapsed >= timeout:
+                raise
+
+            print(f"{description} is waiting for its role:", e)
+            time.sleep(min(delay, timeout - elapsed))
+            delay = min(delay * 2, READINESS_MAX_DELAY)
+            continue
+
+        with readiness_report_lock:
+            readiness_report["waited"] += time.monotonic() - started
+        return result
+
+
+def wait_for_role(iam_client, role_name, policy_arns, replaced_sleep=0.0):
+    def check():
+        iam_client.get_role(RoleName=role_name)
+        attached_policies = set()
+        paginator = iam_client.get_paginator("list_attached_role_policies")
+        for response in paginator.paginate(RoleName=role_name):
+            attached_policies.update(
+                policy.get("PolicyArn")
+                for policy in response.get("AttachedPolicies", [])
+            )
+
+        return set(policy_arns) <= attached_policies
+
+    return wait_until(check, f"Role {role_name}", replaced_sleep)
+
+
+def wait_for_crawler_ready(glue_client, crawler_name, replaced_sleep=0.0):
+    def check():
+        crawler = glue_client.get_crawler(Name=crawler_name).get("Crawler", {})
+        return crawler.get("State") == "READY"
+
+    return wait_until(check, f"Crawler {crawler_name}", replaced_sleep)
+
+
+def wait_for_crawl(
+    glue_client,
+    crawler_name,
+    database_name,
+    previous_start_time=None,
+    replaced_sleep=0.0,
+):
+    def check():
+        crawler = glue_client.get_crawler(Name=crawler_name).get("Crawler", {})
+        if crawler.get("State") != "READY":
+            return False
+
+        # On a re-run the crawler is READY with the crawl of the previous run until
+        # the new one starts
+        last_crawl = crawler.get("LastCrawl", {})
+        if previous_start_time and (
+            last_crawl.get("StartTime", previous_start_time) <= previous_start_time
+        ):
+            return False
+
+        if last_crawl.get("Status") != "SUCCEEDED":
+            return False
+
+        tables = glue_client.get_tables(DatabaseName=database_name, MaxResults=1)
+        return bool(tables.get("TableList"))
+
+    return wait_until(check, f"Crawl of {crawler_name}", replaced_sleep)
+
+
+def wait_for_lambda(lambda_client, lambda_name, replaced_sleep=0.0):
+    def check():
+        configuration = lambda_client.get_function_configuration(
+            FunctionName=lambda_name
+        )
+        return (
+            configuration.get("State") == "Active"
+            and configuration.get("LastUpdateStatus") != "InProgress"
+        )
+
+    return wait_until(check, f"Lambda function {lambda_name}", replaced_sleep)
+
+
+def wait_for_agent(bedrock_client, agent_id, statuses, replaced_sleep=0.0):
+    def check():
+        agent = bedrock_client.get_agent(agentId=agent_id).get("agent", {})
+        if agent.get("agentStatus") == "FAILED":
+            # Waiting longer won't help, the next steps report the failure
+            print(f"Agent {agent_id} failed:", agent.get("failureReasons"))
+            return True
+
+        return agent.get("agentStatus") in statuses
+
+    return wait_until(check, f"Agent {agent_id}", replaced_sleep)
+
+
+def wait_for_agent_alias(bedrock_client, agent_id, agent_alias_id, replaced_sleep=0.0):
+    def check():
+        agent_alias = bedrock_client.get_agent_alias(
+            agentId=agent_id, agentAliasId=agent_alias_id
+        ).get("agentAlias", {})
+        if agent_alias.get("agentAliasStatus") == "FAILED":
+            print(
+                f"Agent alias {agent_alias_id} failed:",
+                agent_alias.get("failureReasons"),
+            )
+            return True
+
+        return agent_alias.get("agentAliasStatus") == "PREPARED"
+
+    return wait_until(check, f"Agent alias {agent_alias_id}", replaced_sleep)
+
+
+def wait_for_deletion(get_resource, description):
+    def check():
+        try:
+            get_resource()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in NOT_FOUND_ERROR_CODES:
+                return True
+            raise
+
+        return False
+
+    return wait_until(check, f"Deletion of {description}")
+
+
+def print_readiness_report():
+    saved = readiness_report["replaced"] - readiness_report["waited"]
+    print(
+        f"Readiness waits took {readiness_report['waited']:.1f}s instead of "
+        f"{readiness_report['replaced']:.1f}s of fixed sleeps, {saved:.1f}s saved."
+    )
@@ -0,0 +1,263 @@
+import csv
+import hashlib
+import json
+import math
+import os
+
+from botocore.exceptions import ClientError
+
+from lambda_function import build_schema
+from readiness import wait_for_agent
+
+SCHEMA_DIGEST_TOKEN_BUDGET = int(os.getenv("SCHEMA_DIGEST_TOKEN_BUDGET", "600"))
+# Rough average for identifiers and short English text, there is no tokenizer
+# for the agent model available locally
+CHARS_PER_TOKEN = 4
+SAMPLE_ROWS = 1000
+# Columns with more distinct values (ids, names, dates) don't get sample values
+MAX_SAMPLE_VALUES = 5
+
+
+def fetch_tables(glue_client, database_name):
+    paginator = glue_client.get_paginator("get_tables")
+    return [
+        table
+        for response in paginator.paginate(DatabaseName=database_name)
+        for table in response.get("TableList", [])
+    ]
+
+
+def fetch_schema(glue_client, database_name):
+    return str(build_schema(fetch_tables(glue_client, database_name)))
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def get_catalog_version(table_list):
+    # Changes whenever the crawler adds, removes or updates a table
+    versions = sorted(
+        f"{table.get('Name')}@{table.get('UpdateTime', '')}" for table in table_list
+    )
+    return hashlib.md5("\n".join(versions).encode(), usedforsecurity=False).hexdigest()
+
+
+def is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def collect_sample_values(data_path, max_values=MAX_SAMPLE_VALUES):
+    # Low-cardinality text columns of the local CSV files, such as categories or
+    # payment methods, so the agent can filter on the exact values
+    samples = {}
+
+    for table_name in sorted(os.listdir(data_path)):
+        table_path = os.path.join(data_path, table_name)
+        if not os.path.isdir(table_path):
+            continue
+
+        values = {}
+        for file_name in sorted(os.listdir(table_path)):
+            if not file_name.endswith(".csv"):
+                continue
+
+            with open(
+                os.path.join(table_path, file_name), newline="", encoding="utf-8"
+            ) as csv_file:
+                for row_number, row in enumerate(csv.DictReader(csv_file)):
+                    if row_number >= SAMPLE_ROWS:
+                        break
+                    for column, value in row.items():
+                        if value:
+                            values.setdefault(column, {})[value] = None
+
+        samples[table_name] = {
+            column: list(column_values)
+            for column, column_values in values.items()
+            if len(column_values) <= max_values
+            and not any(is_number(value) for value in column_values)
+        }
+
+    return samples
+
+
+def find_join_keys(table_list):
+    # Id columns shared by several tables, joined to the table they are named after
+    tables_by_column = {}
+    for table in table_list:
+        for column in table.get("StorageDescriptor", {}).get("Columns", []):
+            if column.get("Name", "").endswith("_id"):
+                tables_by_column.setdefault(column["Name"], []).append(table["Name"])
+
+    join_keys = []
+    for column, table_names in sorted(tables_by_column.items()):
+        if len(table_names) < 2:
+            continue
+
+        owners = [name for name in table_names if name.startswith(column[:-3])]
+        owner = owners[0] if owners else table_names[0]
+        join_keys.extend(
+            f"{name}.{column}->{owner}" for name in table_names if name != owner
+        )
+
+    return join_keys
+
+
+def format_column(column, values):
+    # Most columns are strings, only the other types are written out
+    text = column.get("Name")
+    if column.get("Type") != "string":
+        text += f":{column.get('Type')}"
+    if values:
+        text += f"[{'|'.join(values)}]"
+
+    return text
+
+
+def format_schema_digest(table_list, samples, join_keys, max_values):
+    lines = ["Tables (columns are string unless typed, [sample values]):"]
+
+    for table in table_list:
+        table_samples = samples.get(table.get("Name"), {})
+        columns = [
+            format_column(
+                column, table_samples.get(column.get("Name"), [])[:max_values]
+            )
+            for column in table.get("StorageDescriptor", {}).get("Columns", [])
+        ]
+        line = f"{table.get('Name')}({','.join(columns)})"
+        if partition_keys := table.get("PartitionKeys"):
+            line += " partitioned by " + ",".join(
+                column.get("Name") for column in partition_keys
+            )
+        lines.append(line)
+
+    if join_keys:
+        lines.append("Joins: " + " ".join(join_keys))
+
+    return "\n".join(lines)
+
+
+def compile_schema_digest(
+    table_list, samples=None, token_budget=SCHEMA_DIGEST_TOKEN_BUDGET
+):
+    join_keys = find_join_keys(table_list)
+
+    # Sample values are the first thing left out when the digest gets too long
+    for max_values in range(MAX_SAMPLE_VALUES, -1, -1):
+        digest = format_schema_digest(table_list, samples or {}, join_keys, max_values)
+        if estimate_tokens(digest) <= token_budget:
+            return digest
+
+    print(
+        f"Schema digest is {estimate_tokens(digest)} tokens, "
+        f"over the budget of {token_budget}."
+    )
+    return digest
+
+
+def save_schema_digest(s3_client, bucket_name, key, catalog_version, samples, digest):
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=key,
+        Body=json.dumps(
+            {"catalog_version": catalog_version, "samples": samples, "digest": digest}
+        ).encode(),
+        ContentType="application/json",
+    )
+
+
+def publish_schema_digest(
+    glue_client,
+    s3_client,
+    database_name,
+    bucket_name,
+    key,
+    data_path=None,
+    token_budget=SCHEMA_DIGEST_TOKEN_BUDGET,
+):
+    table_list = fetch_tables(glue_client, database_name)
+    if not table_list:
+        print(f"No tables found in {database_name}, skipping the schema digest.")
+        return None
+
+    samples = collect_sample_values(data_path) if data_path else {}
+    digest = compile_schema_digest(table_list, samples, token_budget)
+    save_schema_digest(
+        s3_client,
+        bucket_name,
+        key,
+        get_catalog_version(table_list),
+        samples,
+        digest,
+    )
+    print(
+        f"Schema digest uploaded to {bucket_name}/{key}: {estimate_tokens(digest)} "
+        f"tokens instead of {estimate_tokens(str(build_schema(table_list)))}."
+    )
+
+    return digest
+
+
+def load_schema_digest(
+    glue_client,
+    s3_client,
+    database_name,
+    bucket_name,
+    key,
+    token_budget=SCHEMA_DIGEST_TOKEN_BUDGET,
+):
+    table_list = fetch_tables(glue_client, database_name)
+    catalog_version = get_catalog_version(table_list)
+
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key)
+        artifact = json.loads(response["Body"].read())
+    except (ClientError, ValueError):
+        artifact = {}
+
+    if artifact.get("catalog_version") == catalog_version:
+        return artifact["digest"]
+
+    # The crawler changed the tables since the digest was compiled, the sample
+    # values of the previous digest are kept as the CSV files may not be local
+    samples = artifact.get("samples", {})
+    digest = compile_schema_digest(table_list, samples, token_budget)
+    save_schema_digest(s3_client, bucket_name, key, catalog_version, samples, digest)
+    print(f"Schema digest regenerated for catalog version {catalog_version}.")
+
+    return digest
+
+
+def format_agent_instruction(agent_prompt, digest):
+    return f"{agent_prompt}\n\nDatabase schema:\n{digest}"
+
+
+def add_schema_digest_to_instruction(bedrock_client, agent_id, agent_prompt, digest):
+    if not digest:
+        return False
+
+    try:
+        agent = bedrock_client.get_agent(agentId=agent_id).get("agent", {})
+        bedrock_client.update_agent(
+            agentId=agent_id,
+            agentName=agent.get("agentName"),
+            agentResourceRoleArn=agent.get("agentResourceRoleArn"),
+            description=agent.get("description"),
+            idleSessionTTLInSeconds=agent.get("idleSessionTTLInSeconds"),
+            foundationModel=agent.get("foundationModel"),
+            instruction=format_agent_instruction(agent_prompt, digest),
+        )
+        wait_for_agent(
+            bedrock_client, agent_id, ["NOT_PREPARED", "PREPARED"], replaced_sleep=5
+        )
+        print(f"Schema digest added to the instruction of agent {agent_id}.")
+        return True
+    except Exception as e:
+        print(f"Error adding the schema digest to agent {agent_id}:", e)
+        return False
@@ -0,0 +1,70 @@
+import time
+import uuid
+
+SESSION_MAX_TURNS = 20
+# Below the idleSessionTTLInSeconds the agent is created with
+SESSION_IDLE_SECONDS = 3000
+SCHEMA_REFRESH_SECONDS = 300
+
+
+class SessionManager:
+    """
+    Keeps one agent session per conversation, so that follow-up questions keep their
+    context, and rolls over to a new session after SESSION_MAX_TURNS questions or before
+    the agent would expire it. The database schema returned by load_schema goes with
+    every question as a prompt session attribute, so the agent doesn't need a
+    /getschema call.
+    """
+
+    def __init__(
+        self,
+        load_schema,
+        max_turns=SESSION_MAX_TURNS,
+        idle_seconds=SESSION_IDLE_SECONDS,
+    ):
+        self.load_schema = load_schema
+        self.max_turns = max_turns
+        self.idle_seconds = idle_seconds
+        self.session_id = None
+        self.turns = 0
+        self.last_used = 0.0
+        self.schema = None
+        self.schema_fetched = None
+
+    def get_schema(self):
+        now = time.monotonic()
+        if (
+            self.schema_fetched is None
+            or now - self.schema_fetched > SCHEMA_REFRESH_SECONDS
+        ):
+            try:
+                self.schema = self.load_schema()
+                self.schema_fetched = now
+            except Exception as e:
+                # The agent falls back to calling /getschema
+                print("Error fetching database schema:", e)
+
+        return self.schema
+
+    def next_turn(self):
+        now = time.monotonic()
+        if (
+            self.session_id is None
+            or self.turns >= self.max_turns
+            or now - self.last_used > self.idle_seconds
+        ):
+            self.session_id = str(uuid.uuid4())
+            self.turns = 0
+
+        self.turns += 1
+        self.last_used = now
+
+        session_state = {}
+        if schema := self.get_schema():
+            # Prompt session attributes only last for one turn, so they are sent every time
+            session_state["promptSessionAttributes"] = {"database_schema": schema}
+
+        return self.session_id, session_state
+
+    def reset(self):
+        self.session_id = None
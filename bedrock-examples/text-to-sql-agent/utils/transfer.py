@@ -0,0 +1,223 @@
+import hashlib
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+UPLOAD_MAX_WORKERS = 8
+PURGE_MAX_WORKERS = 8
+# delete_objects accepts up to 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_CHUNK_SIZE,
+    multipart_chunksize=MULTIPART_CHUNK_SIZE,
+    max_concurrency=4,
+)
+
+
+def create_upload_client(
+    session, max_workers=UPLOAD_MAX_WORKERS, transfer_config=TRANSFER_CONFIG
+):
+    # Every file worker runs up to max_concurrency part uploads on the shared client,
+    # with the default pool of 10 connections urllib3 discards the extra ones
+    return session.client(
+        "s3",
+        config=Config(
+            max_pool_connections=max_workers * transfer_config.max_concurrency
+        ),
+    )
+
+
+def compute_etag(local_path, transfer_config=TRANSFER_CONFIG):
+    multipart = os.path.getsize(local_path) >= transfer_config.multipart_threshold
+    digests = []
+
+    with open(local_path, "rb") as file:
+        while chunk := file.read(transfer_config.multipart_chunksize):
+            digests.append(hashlib.md5(chunk, usedforsecurity=False).digest())
+
+    if not multipart:
+        # Files below the threshold fit into a single chunk
+        digest = digests[0] if digests else hashlib.md5(usedforsecurity=False).digest()
+        return f'"{digest.hex()}"'
+
+    # Multipart uploads get the MD5 of the part digests with a "-<parts>" suffix
+    combined = hashlib.md5(b"".join(digests), usedforsecurity=False)
+    return f'"{combined.hexdigest()}-{len(digests)}"'
+
+
+def is_uploaded(s3_client, local_path, bucket_name, key, transfer_config):
+    try:
+        remote = s3_client.head_object(Bucket=bucket_name, Key=key)
+    except ClientError:
+        return False
+
+    return remote.get("ContentLength") == os.path.getsize(local_path) and remote.get(
+        "ETag"
+    ) == compute_etag(local_path, transfer_config)
+
+
+def upload_file_if_changed(s3_client, local_path, bucket_name, key, transfer_config):
+    started = time.perf_counter()
+
+    if is_uploaded(s3_client, local_path, bucket_name, key, transfer_config):
+        return False, 0, time.perf_counter() - started
+
+    s3_client.upload_file(local_path, bucket_name, key, Config=transfer_config)
+    return True, os.path.getsize(local_path), time.perf_counter() - started
+
+
+def upload_files(
+    s3_client,
+    uploads,
+    bucket_name,
+    max_workers=UPLOAD_MAX_WORKERS,
+    transfer_config=TRANSFER_CONFIG,
+):
+    started = time.perf_counter()
+    uploaded_bytes = 0
+    skipped_files = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                upload_file_if_changed,
+                s3_client,
+                local_path,
+                bucket_name,
+                key,
+                transfer_config,
+            ): key
+            for local_path, key in uploads
+        }
+
+        for done, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            uploaded, size, elapsed = future.result()
+
+            if uploaded:
+                uploaded_bytes += size
+                throughput = size / max(elapsed, 1e-6) / 1024 / 1024
+                print(
+                    f"[{done}/{len(futures)}] {key} uploaded, "
+                    f"{size / 1024:.1f} KiB in {elapsed:.2f}s ({throughput:.2f} MiB/s)."
+                )
+            else:
+                skipped_files += 1
+                print(f"[{done}/{len(futures)}] {key} is up to date, skipped.")
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"Uploaded {len(futures) - skipped_files} files "
+        f"({uploaded_bytes / 1024 / 1024:.2f} MiB), skipped {skipped_files} "
+        f"in {elapsed:.2f}s ({uploaded_bytes / max(elapsed, 1e-6) / 1024 / 1024:.2f} MiB/s)."
+    )
+
+    return uploaded_bytes, skipped_files
+
+
+def iter_bucket_objects(s3_client, bucket_name):
+    versioning = s3_client.get_bucket_versioning(Bucket=bucket_name).get("Status")
+
+    if versioning in ["Enabled", "Suspended"]:
+        paginator = s3_client.get_paginator("list_object_versions")
+        for response in paginator.paginate(Bucket=bucket_name):
+            for version in response.get("Versions", []) + response.get(
+                "DeleteMarkers", []
+            ):
+                yield {"Key": version.get("Key"), "VersionId": version.get("VersionId")}
+    else:
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for response in paginator.paginate(Bucket=bucket_name):
+            for obj in response.get("Contents", []):
+                yield {"Key": obj.get("Key")}
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def delete_objects_batch(s3_client, bucket_name, objects):
+    response = s3_client.delete_objects(
+        Bucket=bucket_name, Delete={"Objects": objects, "Quiet": True}
+    )
+    errors = response.get("Errors", [])
+    for error in errors[:5]:
+        print(f"Error deleting {error.get('Key')}: {error.get('Message')}")
+
+    return len(objects) - len(errors), len(errors)
+
+
+def delete_stale_objects(s3_client, bucket_name, prefix, keys):
+    keys = set(keys)
+    paginator = s3_client.get_paginator("list_objects_v2")
+    stale_objects = (
+        {"Key": obj.get("Key")}
+        for response in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+        for obj in response.get("Contents", [])
+        if obj.get("Key") not in keys
+    )
+
+    deleted_objects = 0
+    failed_objects = 0
+    for batch in iter_batches(stale_objects, DELETE_BATCH_SIZE):
+        deleted, failed = delete_objects_batch(s3_client, bucket_name, batch)
+        deleted_objects += deleted
+        failed_objects += failed
+
+    print(
+        f"Deleted {deleted_objects} stale objects under {prefix} "
+        f"({failed_objects} failed)."
+    )
+
+    return deleted_objects, failed_objects
+
+
+def purge_bucket(s3_client, bucket_name, max_workers=PURGE_MAX_WORKERS):
+    started = time.perf_counter()
+    deleted_objects = 0
+    failed_objects = 0
+    running = set()
+
+    def collect(done):
+        nonlocal deleted_objects, failed_objects
+        for future in done:
+            deleted, failed = future.result()
+            deleted_objects += deleted
+            failed_objects += failed
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        batches = iter_batches(
+            iter_bucket_objects(s3_client, bucket_name), DELETE_BATCH_SIZE
+        )
+        for batch in batches:
+            running.add(
+                executor.submit(delete_objects_batch, s3_client, bucket_name, batch)
+            )
+
+            # Bounds the number of listed keys kept in memory
+            if len(running) >= max_workers * 2:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        collect(as_completed(running))
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"Deleted {deleted_objects} objects from {bucket_name} ({failed_objects} failed) "
+        f"in {elapsed:.2f}s ({deleted_objects / max(elapsed, 1e-6):.0f} objects/s)."
+    )
+
+    return deleted_objects, failed_objects
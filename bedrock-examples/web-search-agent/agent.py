@@ -1,5 +1,22 @@
+import json
+import time
+import warnings
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from context import CONTEXT_MAX_TOKENS, ConversationContext
 from tools import call_function
 
+TOOL_MAX_WORKERS = 8
+TOOL_TIMEOUT_SECONDS = 30
+# Model calls and tokens (input and output, over all calls) one question may use
+AGENT_MAX_STEPS = 8
+AGENT_MAX_TOKENS = 100_000
+BUDGET_EXHAUSTED_PROMPT = (
+    "You have used up the budget for tool calls. Answer the query now with the "
+    "information you have, without calling any more tools."
+)
+
 
 class Agent:
     def __init__(
@@ -9,17 +26,53 @@ class Agent:
         tool_config,
         system_prompt,
         messages=None,
-        max_retries=3,
+        max_retries=None,
+        max_steps=AGENT_MAX_STEPS,
+        max_tokens=AGENT_MAX_TOKENS,
+        max_tool_workers=TOOL_MAX_WORKERS,
+        tool_timeout=TOOL_TIMEOUT_SECONDS,
+        context_tokens=CONTEXT_MAX_TOKENS,
     ):
         if messages is None:
             messages = []
+        if max_retries is not None:
+            # Kept in its old position so that existing calls still work
+            warnings.warn(
+                "max_retries is deprecated and ignored, the tool loop is limited by "
+                "max_steps and max_tokens instead",
+                DeprecationWarning,
+                stacklevel=2,
+            )
 
         self.bedrock_client = bedrock_client
         self.model_id = model_id
         self.messages = messages
-        self.max_retires = max_retries
+        # Compacts self.messages in place, None keeps the whole history
+        self.context = ConversationContext(messages, context_tokens)
+        # URL -> toolUseId of the search result that sent its content to the model
+        self.seen_urls = {}
+        self.max_steps = max_steps
+        self.max_tokens = max_tokens
+        self.llm_calls = 0
+        self.used_tokens = 0
         self.tool_config = tool_config
         self.system_prompt = [{"text": system_prompt}]
+        self.max_tool_workers = max_tool_workers
+        self.tool_timeout = tool_timeout
+        # Shared across turns, a tool that timed out may still hold a worker
+        self.tool_executor = ThreadPoolExecutor(
+            max_workers=max_tool_workers, thread_name_prefix="tool"
+        )
+
+    def close(self):
+        # Doesn't wait for tools that are still running past their timeout
+        self.tool_executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def call_converse_api_with_tools(self, messages):
         try:
@@ -34,137 +87,247 @@ class Agent:
         except Exception as e:
             return {"error": str(e)}
 
-    def handle_tool_use(self, func_name, func_params):
+    def call_converse_stream_api_with_tools(self, messages):
+        try:
+            response = self.bedrock_client.converse_stream(
+                modelId=self.model_id,
+                system=self.system_prompt,
+                messages=messages,
+                toolConfig=self.tool_config,
+            )
+            return response
+
+        except Exception as e:
+            return {"error": str(e)}
+
+    def read_converse_stream(self, stream, submitted):
+        """
+        Yields the text deltas of a converse_stream response and returns the response in
+        the shape of converse. Each tool starts as soon as its input is complete, while
+        the model is still generating the rest of the message.
+        """
+        blocks = {}
+        response = {"stopReason": None, "usage": {}}
+
+        for event in stream:
+            if "contentBlockStart" in event:
+                start = event["contentBlockStart"]
+                if "toolUse" in start["start"]:
+                    blocks[start["contentBlockIndex"]] = {
+                        "toolUse": {**start["start"]["toolUse"], "input": ""}
+                    }
+            elif "contentBlockDelta" in event:
+                index = event["contentBlockDelta"]["contentBlockIndex"]
+                delta = event["contentBlockDelta"]["delta"]
+                if "text" in delta:
+                    blocks.setdefault(index, {"text": ""})["text"] += delta["text"]
+                    yield delta["text"]
+                elif "toolUse" in delta:
+                    blocks[index]["toolUse"]["input"] += delta["toolUse"]["input"]
+            elif "contentBlockStop" in event:
+                block = blocks.get(event["contentBlockStop"]["contentBlockIndex"], {})
+                if "toolUse" in block:
+                    tool_use = block["toolUse"]
+                    tool_use["input"] = json.loads(tool_use["input"] or "{}")
+                    submitted.append(self.submit_tool_call(tool_use))
+            elif "messageStop" in event:
+                response["stopReason"] = event["messageStop"]["stopReason"]
+            elif "metadata" in event:
+                response["usage"] = event["metadata"].get("usage", {})
+
+        response["output"] = {
+            "message": {
+                "role": "assistant",
+                "content": [blocks[index] for index in sorted(blocks)],
+            }
+        }
+        return response
+
+    def handle_tool_use(self, func_name, func_params, tool_use_id=None, sent_urls=None):
         allowed_tools = [tool["toolSpec"]["name"] for tool in self.tool_config["tools"]]
 
         if func_name in allowed_tools:
-            results = call_function(func_name, func_params)
+            # The tool records the URLs it sends in sent_urls, they only count as seen
+            # once its result goes to the model
+            results = call_function(
+                func_name,
+                func_params,
+                seen_urls=ChainMap(
+                    {} if sent_urls is None else sent_urls, self.seen_urls
+                ),
+                tool_use_id=tool_use_id,
+            )
             return results
 
         raise Exception("An unexpected tool was used")
 
-    def process_user_input(self, user_input):
-        self.messages.append({"role": "user", "content": [{"text": user_input}]})
-        print("Invoking LLM")
-
-        response_message = self.call_converse_api_with_tools(
-            messages=self.messages,
+    def submit_tool_call(self, function):
+        tool_name = function["name"]
+        tool_args = function["input"] or {}
+
+        print(f"Function calling - Calling Tool :{tool_name}(**{tool_args})")
+        sent_urls = {}
+        future = self.tool_executor.submit(
+            self.handle_tool_use,
+            tool_name,
+            tool_args,
+            function["toolUseId"],
+            sent_urls,
         )
+        return future, time.monotonic(), sent_urls
+
+    def run_tool_calls(self, function_calling, submitted=None):
+        # The tools of one model turn run concurrently, the results keep the order of
+        # the toolUse blocks
+        if not submitted:
+            submitted = [
+                self.submit_tool_call(function) for function in function_calling
+            ]
 
-        if "error" in response_message:
-            return f"An error occurred: {response_message['error']}"
-
-        # Add the intermediate output to the list of messages
-        self.messages.append(response_message["output"]["message"])
-        print("Received message from the LLM")
-
-        function_calling = [
-            content["toolUse"]
-            for content in response_message["output"]["message"]["content"]
-            if "toolUse" in content
-        ]
+        tool_results = []
+        for index, (function, (future, started, sent_urls)) in enumerate(
+            zip(function_calling, submitted)
+        ):
+            # Calls beyond the pool size wait for a free worker before their timeout starts
+            deadline = started + self.tool_timeout * (
+                index // self.max_tool_workers + 1
+            )
+            tool_result = {"toolUseId": function["toolUseId"]}
+            try:
+                tool_response = future.result(
+                    timeout=max(0, deadline - time.monotonic())
+                )
+                print(f"Function calling - Got Tool Response: {tool_response}")
+                self.seen_urls.update(sent_urls)
+            except TimeoutError:
+                future.cancel()
+                tool_response = (
+                    f"Tool {function['name']} timed out after {self.tool_timeout}s."
+                )
+                print(f"Function calling - {tool_response}")
+                tool_result["status"] = "error"
+            except Exception as e:
+                # Every toolUse needs its toolResult, or the next converse call fails
+                tool_response = f"Tool {function['name']} failed. Error: {e}"
+                print(f"Function calling - {tool_response}")
+                tool_result["status"] = "error"
 
-        if function_calling:
-            print(f"Function Calling - List of function calls : {function_calling}")
-            tool_result_message = {"role": "user", "content": []}
+            tool_result["content"] = [{"text": tool_response}]
+            tool_results.append({"toolResult": tool_result})
 
-            for function in function_calling:
-                tool_name = function["name"]
-                tool_args = function["input"] or {}
+        return tool_results
 
-                print(f"Function calling - Calling Tool :{tool_name}(**{tool_args})")
-                tool_response = self.handle_tool_use(tool_name, tool_args)
+    def get_text(self, message):
+        return "\n".join(
+            content["text"] for content in message["content"] if "text" in content
+        )
 
-                print(f"Function calling - Got Tool Response: {tool_response}")
-                tool_result_message["content"].append(
-                    {
-                        "toolResult": {
-                            "toolUseId": function["toolUseId"],
-                            "content": [{"text": tool_response}],
-                        }
-                    }
+    def run_user_input(self, user_input, stream=False):
+        """
+        Yields the text deltas of the model when streaming and returns the final answer.
+        """
+        self.context.append({"role": "user", "content": [{"text": user_input}]})
+        used_tokens = 0
+        last_step = self.max_steps
+        step = 0
+
+        # The model calls tools until it stops with an answer or the budgets run out
+        while True:
+            step += 1
+            compacted = self.context.compact()
+            if compacted:
+                # The model no longer has these pages, later searches send them again
+                self.seen_urls = {
+                    url: tool_use_id
+                    for url, tool_use_id in self.seen_urls.items()
+                    if tool_use_id not in compacted
+                }
+            print(f"Invoking LLM (step {step})")
+            submitted = []
+            if stream:
+                response_message = self.call_converse_stream_api_with_tools(
+                    messages=self.messages,
+                )
+                if "error" not in response_message:
+                    try:
+                        response_message = yield from self.read_converse_stream(
+                            response_message["stream"], submitted
+                        )
+                    except Exception as e:
+                        response_message = {"error": str(e)}
+            else:
+                response_message = self.call_converse_api_with_tools(
+                    messages=self.messages,
                 )
-
-            # Add the intermediate tool output to the list of messages
-            self.messages.append(tool_result_message)
-
-            print("Function calling - Calling LLM with Tool Result")
-            response_message = self.call_converse_api_with_tools(messages=self.messages)
 
             if "error" in response_message:
                 return f"An error occurred: {response_message['error']}"
 
-            # Add the intermediate output to the list of messages
-            self.messages.append(response_message["output"]["message"])
-
-            print("Function calling - Received message from the LLM")
-        return response_message["output"]["message"]["content"][0]["text"]
+            self.llm_calls += 1
+            used_tokens += response_message.get("usage", {}).get("totalTokens", 0)
+            message = response_message["output"]["message"]
+            print("Received message from the LLM")
+            stop_reason = response_message.get("stopReason")
+
+            if stop_reason == "tool_use" and step == last_step:
+                # The results of these calls are never sent, so their URLs stay unseen
+                for future, _, _ in submitted:
+                    future.cancel()
+                # Without results for its tool calls, the message would make the next
+                # converse call fail
+                message["content"] = [
+                    content for content in message["content"] if "text" in content
+                ] or [{"text": "Sorry, the query could not be answered in time."}]
+                print("Step budget exhausted")
+                stop_reason = "max_steps"
 
-    def check_for_final_answer(self, user_input, ai_response):
-        messages = []
-
-        for message in self.messages:
-            _messages = {"role": message["role"], "content": []}
-
-            for _content in message["content"]:
-                if "text" in _content.keys():
-                    _messages["content"].append(_content)
-                elif "toolResult" in _content.keys():
-                    _messages["content"].extend(_content["toolResult"]["content"])
+            # Add the intermediate output to the list of messages
+            self.context.append(message)
 
-            messages.append(_messages)
+            if stop_reason != "tool_use":
+                break
 
-        messages.append(
-            {
+            function_calling = [
+                content["toolUse"]
+                for content in message["content"]
+                if "toolUse" in content
+            ]
+            print(f"Function Calling - List of function calls : {function_calling}")
+            tool_result_message = {
                 "role": "user",
-                "content": [
-                    {"text": f"User Query: {user_input}\nAI Response: {ai_response}"}
-                ],
+                "content": self.run_tool_calls(function_calling, submitted),
             }
-        )
 
-        try:
-            response = self.bedrock_client.converse(
-                modelId=self.model_id,
-                system=[
-                    {
-                        "text": "You are an expert at extracting the answer to user's query in the AI's response. "
-                        "If you are not able to determine whether the query was answered then return: "
-                        "Sorry cannot answer the query. Please try again. You have previous conversation "
-                        "to provide you the context."
-                    }
-                ],
-                messages=messages,
-            )
-            print(response)
-            return response["output"]["message"]["content"][0]["text"]
+            if step == last_step - 1 or used_tokens >= self.max_tokens:
+                print("Function calling - Asking the LLM for a final answer")
+                tool_result_message["content"].append({"text": BUDGET_EXHAUSTED_PROMPT})
+                last_step = step + 1
 
-        except Exception as e:
-            return {"error": str(e)}
+            # Add the intermediate tool output to the list of messages
+            self.context.append(tool_result_message)
 
-    def invoke(self, user_input):
-        for i in range(self.max_retires):
-            print(f"{'-'*15}Trial {i+1}{'-'*15}")
-            response_text = self.process_user_input(user_input)
+        self.used_tokens += used_tokens
+        return self.get_text(message)
 
-            if "FINAL ANSWER" in response_text:
-                print(39 * "-")
-                return response_text
+    def process_user_input(self, user_input):
+        steps = self.run_user_input(user_input)
+        while True:
+            try:
+                next(steps)
+            except StopIteration as stop:
+                return stop.value
 
-            else:
-                print("LLM Parser Invoked")
-                llm_parser_output = self.check_for_final_answer(
-                    user_input, response_text
-                )
-                print(f"LLM Parser Output:\n{llm_parser_output}")
+    def invoke(self, user_input):
+        print(f"{'-' * 15}Question{'-' * 15}")
+        response_text = self.process_user_input(user_input)
+        print(39 * "-")
 
-                if "error" not in llm_parser_output:
-                    print(39 * "-")
-                    return llm_parser_output
+        return response_text
 
-        return "\n".join(
-            [
-                msg["content"][0].get("text", "<skipped> Tool Use <skipped>")
-                for msg in self.messages
-            ]
-        )
+    def invoke_stream(self, user_input):
+        # Yields the text of the model as it is generated, returns the final answer
+        print(f"{'-' * 15}Question{'-' * 15}")
+        response_text = yield from self.run_user_input(user_input, stream=True)
+        print(39 * "-")
+
+        return response_text
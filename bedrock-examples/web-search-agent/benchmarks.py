@@ -0,0 +1,309 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+from fakes import FakeBedrockRuntimeClient, FakeDDGS
+
+# Searches go to the local stand-in instead of DuckDuckGo
+sys.modules["ddgs"] = types.SimpleNamespace(DDGS=FakeDDGS)
+
+import tools  # noqa: E402
+from agent import Agent  # noqa: E402
+from search_cache import SearchCache  # noqa: E402
+from tools import tool_config  # noqa: E402
+
+QUESTION = "What is the GDP of India from 2009 to 2025"
+# Repeated, reworded and related searches of one research session
+CACHE_QUERIES = [
+    "GDP of India 2009",
+    "gdp of India, 2009",
+    "What is the GDP of India 2009?",
+    "GDP of India 2025",
+    "India GDP growth 2025",
+    "GDP of India 2025",
+    "population of India 2025",
+    "Tell me about the population of India 2025",
+]
+
+
+def original_web_search(query):
+    # The previous tool, without cache or deduplication
+    try:
+        results = FakeDDGS().text(query=query, max_results=5)
+        return "\n".join([json.dumps(result) for result in results])
+    except Exception as e:
+        return f"Failed to search. Error: {e}"
+
+
+def create_agent(bedrock_client, **kwargs):
+    # Every agent starts without cached searches, so the timings don't depend on the
+    # benchmarks run before
+    tools.search_cache = SearchCache(path="")
+    return Agent(
+        bedrock_client=bedrock_client,
+        model_id="fake-model",
+        tool_config=tool_config,
+        system_prompt="You are a researcher AI.",
+        **kwargs,
+    )
+
+
+def benchmark_tools(args):
+    FakeDDGS.latency = args.duration
+    # One search hangs, the others finish well within the timeout
+    FakeDDGS.latencies = {f"{QUESTION} 0.0": args.duration * 10}
+
+    for name, kwargs in [
+        ("serial", {"max_tool_workers": 1}),
+        ("parallel", {}),
+        ("parallel with timeout", {"tool_timeout": args.duration * 2}),
+    ]:
+        agent = create_agent(
+            FakeBedrockRuntimeClient(tools_per_turn=args.queries), **kwargs
+        )
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent.process_user_input(QUESTION)
+        elapsed = time.perf_counter() - started
+
+        timed_out = sum(
+            content["toolResult"].get("status") == "error"
+            for message in agent.messages
+            for content in message["content"]
+            if "toolResult" in content
+        )
+        print(
+            f"{name:>22}: {elapsed:.2f}s for {args.queries} searches, "
+            f"{timed_out} timed out"
+        )
+        agent.tool_executor.shutdown(wait=False)
+
+
+def invoke_original(agent, user_input, max_retries=3):
+    # Replicates the previous single tool round, the FINAL ANSWER check, the extra
+    # parser call and the retries
+    def process_user_input():
+        agent.messages.append({"role": "user", "content": [{"text": user_input}]})
+        response_message = agent.call_converse_api_with_tools(messages=agent.messages)
+        agent.messages.append(response_message["output"]["message"])
+
+        function_calling = [
+            content["toolUse"]
+            for content in response_message["output"]["message"]["content"]
+            if "toolUse" in content
+        ]
+        if function_calling:
+            agent.messages.append(
+                {"role": "user", "content": agent.run_tool_calls(function_calling)}
+            )
+            response_message = agent.call_converse_api_with_tools(
+                messages=agent.messages
+            )
+            agent.messages.append(response_message["output"]["message"])
+
+        return response_message["output"]["message"]["content"][0]["text"]
+
+    def check_for_final_answer(ai_response):
+        messages = []
+        for message in agent.messages:
+            _messages = {"role": message["role"], "content": []}
+            for _content in message["content"]:
+                if "text" in _content:
+                    _messages["content"].append(_content)
+                elif "toolResult" in _content:
+                    _messages["content"].extend(_content["toolResult"]["content"])
+            messages.append(_messages)
+
+        messages.append(
+            {
+                "role": "user",
+                "content": [
+                    {"text": f"User Query: {user_input}\nAI Response: {ai_response}"}
+                ],
+            }
+        )
+        response = agent.bedrock_client.converse(
+            modelId=agent.model_id, system=agent.system_prompt, messages=messages
+        )
+        return response["output"]["message"]["content"][0]["text"]
+
+    for _ in range(max_retries):
+        response_text = process_user_input()
+        if "FINAL ANSWER" in response_text:
+            return response_text
+
+        llm_parser_output = check_for_final_answer(response_text)
+        if "error" not in llm_parser_output:
+            return llm_parser_output
+
+
+def benchmark_loop(args):
+    FakeDDGS.latency = 0
+    FakeDDGS.latencies = {}
+
+    for name, kwargs in [
+        ("one tool round", {"tool_rounds": 1}),
+        ("answer without prefix", {"tool_rounds": 1, "answer_prefix": ""}),
+        ("two tool rounds", {"tool_rounds": 2}),
+    ]:
+        results = []
+        for invoke in [invoke_original, Agent.invoke]:
+            bedrock_client = FakeBedrockRuntimeClient(**kwargs)
+            agent = create_agent(bedrock_client)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(args.queries):
+                    invoke(agent, f"Question {i}")
+            # Tool calls left without results break the next converse call on Bedrock
+            dangling = sum(
+                "toolUse" in content
+                for message in agent.messages[-1:]
+                for content in message["content"]
+            )
+            results.append(
+                f"{bedrock_client.calls['converse'] / args.queries:.2f} LLM calls"
+                + (f" ({dangling} dangling tool calls)" if dangling else "")
+            )
+            agent.tool_executor.shutdown(wait=False)
+
+        print(f"{name:>22}: {results[0]} before, {results[1]} after per question")
+
+
+def benchmark_stream(args):
+    for scenario, latencies in [
+        ("equal searches", {}),
+        # Tools only finish earlier when the ones started first are the slow ones
+        (
+            "first search slower",
+            {f"Question {i} 0.0": args.duration * 2 for i in range(args.queries)},
+        ),
+    ]:
+        FakeDDGS.latency = args.duration
+        FakeDDGS.latencies = latencies
+        print(f"{scenario}:")
+
+        for name, stream in [("converse", False), ("converse_stream", True)]:
+            first_tokens = []
+            totals = []
+            for i in range(args.queries):
+                agent = create_agent(
+                    FakeBedrockRuntimeClient(latency=0.5, token_latency=0.05)
+                )
+                started = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if stream:
+                        first_token = None
+                        for _ in agent.invoke_stream(f"Question {i}"):
+                            first_token = first_token or time.perf_counter()
+                    else:
+                        agent.invoke(f"Question {i}")
+                        # Nothing is shown before the whole answer is there
+                        first_token = time.perf_counter()
+                first_tokens.append(first_token - started)
+                totals.append(time.perf_counter() - started)
+                agent.tool_executor.shutdown(wait=False)
+
+            print(
+                f"{name:>18}: {statistics.median(first_tokens):.2f}s to first token, "
+                f"{statistics.median(totals):.2f}s end-to-end"
+            )
+
+
+def benchmark_history(args):
+    FakeDDGS.latency = 0
+    FakeDDGS.latencies = {}
+    # Every question of the session is shown once, the rest are in between
+    shown = {0, args.queries // 2, args.queries - 1}
+
+    for name, context_tokens in [("full history", None), ("compacted", 16_000)]:
+        bedrock_client = FakeBedrockRuntimeClient(input_token_latency=0.00001)
+        agent = create_agent(bedrock_client, context_tokens=context_tokens)
+        print(f"{name}:")
+
+        for i in range(args.queries):
+            calls = len(bedrock_client.input_tokens)
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                agent.invoke(f"Question {i}")
+            elapsed = time.perf_counter() - started
+
+            if i in shown:
+                input_tokens = bedrock_client.input_tokens[calls:]
+                print(
+                    f"{f'question {i + 1}':>14}: "
+                    f"{sum(input_tokens) / len(input_tokens):8.0f} input tokens "
+                    f"per LLM call, {elapsed:.2f}s"
+                )
+        agent.tool_executor.shutdown(wait=False)
+
+
+def benchmark_cache(args):
+    FakeDDGS.latency = args.duration
+    FakeDDGS.latencies = {}
+    FakeDDGS.topic_urls = True
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "search_cache.sqlite")
+        for name, search_cache in [
+            ("no cache", None),
+            ("memory cache", SearchCache(path="")),
+            ("SQLite cache, first run", SearchCache(path=path)),
+            ("SQLite cache, next run", SearchCache(path=path)),
+        ]:
+            tools.search_cache = search_cache
+            FakeDDGS.calls.clear()
+            # One conversation, which still has all earlier results
+            seen_urls = {}
+            output_chars = 0
+            started = time.perf_counter()
+            for i, query in enumerate(CACHE_QUERIES):
+                output = (
+                    tools.web_search(query, seen_urls, f"tooluse_{i}")
+                    if search_cache
+                    else original_web_search(query)
+                )
+                output_chars += len(output)
+            elapsed = time.perf_counter() - started
+
+            hits = (
+                f", {search_cache.stats['memory']} memory and "
+                f"{search_cache.stats['disk']} disk hits"
+                if search_cache
+                else ""
+            )
+            print(
+                f"{name:>24}: {FakeDDGS.calls['text']} searches in {elapsed:.2f}s, "
+                f"~{output_chars // 4} result tokens{hits}"
+            )
+            if search_cache and search_cache.connection:
+                search_cache.connection.close()
+
+
+BENCHMARKS = {
+    "tools": benchmark_tools,
+    "loop": benchmark_loop,
+    "stream": benchmark_stream,
+    "history": benchmark_history,
+    "cache": benchmark_cache,
+}
+# The history only outgrows the compaction budget after about a dozen questions
+DEFAULT_QUERIES = {"history": 20}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline web search agent benchmarks.")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        "--queries", type=int, help="Searches or questions (4, 20 for history)"
+    )
+    parser.add_argument("--duration", type=float, default=0.5)
+    args = parser.parse_args()
+    if args.queries is None:
+        args.queries = DEFAULT_QUERIES.get(args.benchmark, 4)
+
+    BENCHMARKS[args.benchmark](args)
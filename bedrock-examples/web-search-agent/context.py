@@ -0,0 +1,123 @@
+import json
+import math
+
+# Estimated tokens of the messages sent with each converse call
+CONTEXT_MAX_TOKENS = 16_000
+# Old tool results are cut down to this many characters first
+TOOL_RESULT_MAX_CHARS = 500
+# Rough average for English text and JSON, there is no tokenizer for the model here
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(message):
+    chars = 0
+    for content in message["content"]:
+        if "text" in content:
+            chars += len(content["text"])
+        elif "toolUse" in content:
+            chars += len(content["toolUse"]["name"])
+            chars += len(json.dumps(content["toolUse"]["input"]))
+        elif "toolResult" in content:
+            chars += sum(
+                len(result.get("text", ""))
+                for result in content["toolResult"]["content"]
+            )
+
+    return math.ceil(chars / CHARS_PER_TOKEN)
+
+
+def get_tool_use_ids(message):
+    return {
+        content["toolResult"]["toolUseId"]
+        for content in message["content"]
+        if "toolResult" in content
+    }
+
+
+def truncate_tool_results(message, max_chars):
+    truncated = set()
+    for content in message["content"]:
+        for result in content.get("toolResult", {}).get("content", []):
+            text = result.get("text", "")
+            if len(text) > max_chars:
+                result["text"] = (
+                    f"{text[:max_chars]}... [{len(text) - max_chars} characters cut]"
+                )
+                truncated.add(content["toolResult"]["toolUseId"])
+
+    return truncated
+
+
+def is_question(message):
+    return (
+        message["role"] == "user"
+        and any("text" in content for content in message["content"])
+        and not any("toolResult" in content for content in message["content"])
+    )
+
+
+class ConversationContext:
+    """
+    Keeps the messages of an agent within max_tokens estimated tokens, in place.
+    Tool results older than the latest one are truncated first, then whole turns are
+    dropped from the start, so every toolUse keeps its toolResult and the history
+    still starts with a question of the user. The current turn is never dropped.
+    """
+
+    def __init__(
+        self,
+        messages,
+        max_tokens=CONTEXT_MAX_TOKENS,
+        tool_result_max_chars=TOOL_RESULT_MAX_CHARS,
+    ):
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.tool_result_max_chars = tool_result_max_chars
+        self.tokens = [estimate_tokens(message) for message in messages]
+
+    def append(self, message):
+        self.messages.append(message)
+        self.tokens.append(estimate_tokens(message))
+
+    def total_tokens(self):
+        return sum(self.tokens)
+
+    def compact(self):
+        # Returns the toolUseIds of the tool results that were cut or dropped
+        compacted = set()
+        if self.max_tokens is None or self.total_tokens() <= self.max_tokens:
+            return compacted
+
+        tool_result_indexes = [
+            index
+            for index, message in enumerate(self.messages)
+            if any("toolResult" in content for content in message["content"])
+        ]
+        for index in tool_result_indexes[:-1]:
+            if truncated := truncate_tool_results(
+                self.messages[index], self.tool_result_max_chars
+            ):
+                compacted |= truncated
+                self.tokens[index] = estimate_tokens(self.messages[index])
+                if self.total_tokens() <= self.max_tokens:
+                    return compacted
+
+        while self.total_tokens() > self.max_tokens:
+            # Turns start at a question, the current turn is the one of the last question
+            next_question = next(
+                (
+                    index
+                    for index, message in enumerate(self.messages)
+                    if index > 0 and is_question(message)
+                ),
+                None,
+            )
+            if next_question is None:
+                break
+
+            for message in self.messages[:next_question]:
+                compacted |= get_tool_use_ids(message)
+            del self.messages[:next_question]
+            del self.tokens[:next_question]
+
+        return compacted
@@ -0,0 +1,185 @@
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+
+
+class FakeDDGS:
+    """
+    Local stand-in for the DuckDuckGo search client, every search takes the configured
+    latency (or its own one from latencies) and returns max_results made-up hits.
+    With topic_urls, the hits link to one page per word of the query, so that queries
+    on related topics return some of the same pages.
+    """
+
+    latency = 0.5
+    latencies = {}
+    topic_urls = False
+    calls = Counter()
+    lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def text(self, query, max_results=5, **kwargs):
+        with self.lock:
+            self.calls["text"] += 1
+
+        time.sleep(self.latencies.get(query, self.latency))
+        words = sorted(set(re.findall(r"\w+", query.lower())))
+        results = []
+        for i in range(max_results):
+            if self.topic_urls:
+                topic = words[i % len(words)]
+                href = f"https://example.com/{topic}/{i // len(words)}"
+            else:
+                href = f"https://example.com/{i}?q={query.replace(' ', '+')}"
+
+            results.append(
+                {
+                    "title": f"Result {i} for {query}",
+                    "href": href,
+                    "body": f"Made-up snippet {i} about {query}. " * 10,
+                }
+            )
+
+        return results
+
+
+class FakeBedrockRuntimeClient:
+    """
+    Local stand-in for the boto3 Bedrock runtime client. The model asks for
+    tools_per_turn web searches in each of its first tool_rounds turns, then answers
+    with answer_words words, with answer_prefix in front. Every call takes latency
+    plus input_token_latency per input token before the first token, then token_latency
+    per streamed chunk (a word of text or 8 characters of tool input), converse returns
+    once all of them are generated. The input tokens of every call are kept in input_tokens.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        tool_rounds=1,
+        tools_per_turn=3,
+        answer_prefix="FINAL ANSWER: ",
+        answer_words=40,
+        token_latency=0.0,
+        input_token_latency=0.0,
+    ):
+        self.latency = latency
+        self.tool_rounds = tool_rounds
+        self.tools_per_turn = tools_per_turn
+        self.answer_prefix = answer_prefix
+        self.answer_words = answer_words
+        self.token_latency = token_latency
+        self.input_token_latency = input_token_latency
+        self.calls = Counter()
+        self.input_tokens = []
+
+    def create_response(self, messages, toolConfig):
+        # Tool rounds done since the last question of the user
+        tool_rounds = 0
+        for message in reversed(messages):
+            if message["role"] == "user" and "text" in message["content"][0]:
+                question = message["content"][0]["text"]
+                break
+            if message["role"] == "user":
+                tool_rounds += 1
+
+        if toolConfig and tool_rounds < self.tool_rounds:
+            content = [{"text": "Let me search for that."}] + [
+                {
+                    "toolUse": {
+                        "toolUseId": f"tooluse_{uuid.uuid4().hex[:12]}",
+                        "name": "web_search",
+                        "input": {"query": f"{question} {tool_rounds}.{i}"},
+                    }
+                }
+                for i in range(self.tools_per_turn)
+            ]
+            stop_reason = "tool_use"
+        else:
+            answer = " ".join(["Made-up answer."] * (self.answer_words // 2))
+            content = [{"text": f"{self.answer_prefix}{answer}"}]
+            stop_reason = "end_turn"
+
+        input_tokens = sum(len(str(message["content"])) for message in messages) // 4
+        self.input_tokens.append(input_tokens)
+        return {
+            "output": {"message": {"role": "assistant", "content": content}},
+            "stopReason": stop_reason,
+            "usage": {
+                "inputTokens": input_tokens,
+                "outputTokens": len(str(content)) // 4,
+                "totalTokens": input_tokens + len(str(content)) // 4,
+            },
+        }
+
+    def get_chunks(self, block):
+        if "text" in block:
+            words = block["text"].split(" ")
+            return [word + " " for word in words[:-1]] + words[-1:]
+
+        tool_input = json.dumps(block["toolUse"]["input"])
+        return re.findall(".{1,8}", tool_input)
+
+    def converse(self, modelId, messages, system=None, toolConfig=None, **kwargs):
+        self.calls["converse"] += 1
+        response = self.create_response(messages, toolConfig)
+        chunks = sum(
+            len(self.get_chunks(block))
+            for block in response["output"]["message"]["content"]
+        )
+        input_tokens = response["usage"]["inputTokens"]
+        time.sleep(
+            self.latency
+            + input_tokens * self.input_token_latency
+            + chunks * self.token_latency
+        )
+
+        return response
+
+    def converse_stream(
+        self, modelId, messages, system=None, toolConfig=None, **kwargs
+    ):
+        self.calls["converse_stream"] += 1
+        return {"stream": self.stream(self.create_response(messages, toolConfig))}
+
+    def stream(self, response):
+        time.sleep(
+            self.latency + response["usage"]["inputTokens"] * self.input_token_latency
+        )
+        yield {"messageStart": {"role": "assistant"}}
+
+        for index, block in enumerate(response["output"]["message"]["content"]):
+            if "toolUse" in block:
+                tool_use = block["toolUse"]
+                yield {
+                    "contentBlockStart": {
+                        "contentBlockIndex": index,
+                        "start": {
+                            "toolUse": {
+                                "toolUseId": tool_use["toolUseId"],
+                                "name": tool_use["name"],
+                            }
+                        },
+                    }
+                }
+
+            for chunk in self.get_chunks(block):
+                time.sleep(self.token_latency)
+                delta = (
+                    {"toolUse": {"input": chunk}}
+                    if "toolUse" in block
+                    else {"text": chunk}
+                )
+                yield {
+                    "contentBlockDelta": {"contentBlockIndex": index, "delta": delta}
+                }
+
+            yield {"contentBlockStop": {"contentBlockIndex": index}}
+
+        yield {"messageStop": {"stopReason": response["stopReason"]}}
+        yield {"metadata": {"usage": response["usage"], "metrics": {"latencyMs": 0}}}
@@ -9,8 +9,8 @@ load_dotenv()
 
 system_prompt = (
     "You are a researcher AI. Your task is to use the tools available to you and answer "
-    "the user's query to the best of your capabilities. When you have final answer to "
-    "the user's query then you are to strictly prefix it with FINAL ANSWER to stop the iterations."
+    "the user's query to the best of your capabilities. Call the tools as many times as you "
+    "need, and when you have the final answer to the user's query, reply with it directly."
 )
 
 # Create boto3 session with manually defined credentials.
@@ -24,13 +24,20 @@ base_session = session.Session(
 # Create a Bedrock Runtime client.
 client = base_session.client("bedrock-runtime")
 
-researcher_agent = Agent(
+query = "What is the GDP of India from 2009 to 2025"
+
+with Agent(
     bedrock_client=client,
     model_id=os.getenv("AWS_BEDROCK_MODEL_ID", "us.writer.palmyra-x5-v1:0"),
     tool_config=tool_config,
     system_prompt=system_prompt,
-)
-
-output = researcher_agent.invoke("What is the GDP of India from 2009 to 2025")
-
-print(output)
+) as researcher_agent:
+    if os.getenv("AGENT_STREAM", "") == "true":
+        # Prints the text of the model as it is generated
+        for text in researcher_agent.invoke_stream(query):
+            print(text, end="", flush=True)
+        print()
+    else:
+        output = researcher_agent.invoke(query)
+
+        print(output)
@@ -0,0 +1,127 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_TTL_SECONDS = 3600
+# SQLite file that keeps the results across runs, empty keeps them in memory only
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "")
+# Filler words dropped from the start of a query only, the rest keeps its order so
+# that "flights from Paris to London" and its reverse stay apart
+LEADING_FILLER_WORDS = {
+    "a",
+    "about",
+    "an",
+    "are",
+    "can",
+    "find",
+    "is",
+    "me",
+    "please",
+    "search",
+    "show",
+    "tell",
+    "the",
+    "what",
+    "you",
+}
+
+
+def normalize_query(query):
+    words = re.findall(r"\w+", query.lower())
+    while words and words[0] in LEADING_FILLER_WORDS:
+        words.pop(0)
+
+    return " ".join(words)
+
+
+class SearchCache:
+    """
+    Search results by normalized query, in an in-memory LRU of max_size entries and,
+    when a path is given, a SQLite file shared across runs. Entries expire after ttl
+    seconds.
+    """
+
+    def __init__(
+        self,
+        max_size=SEARCH_CACHE_SIZE,
+        ttl=SEARCH_CACHE_TTL_SECONDS,
+        path=SEARCH_CACHE_PATH,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.stats = Counter()
+        # Tools of one model turn run on several threads
+        self.lock = threading.Lock()
+        self.connection = None
+
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS search_cache "
+                "(key TEXT PRIMARY KEY, query TEXT, stored_at REAL, results TEXT)"
+            )
+
+    def get(self, query):
+        key = normalize_query(query)
+        now = time.time()
+
+        with self.lock:
+            if key in self.entries:
+                entry = self.entries[key]
+                if now - entry[0] <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.stats["memory"] += 1
+                    return entry[1], entry[2]
+                del self.entries[key]
+
+            if self.connection:
+                try:
+                    row = self.connection.execute(
+                        "SELECT query, stored_at, results FROM search_cache "
+                        "WHERE key = ?",
+                        (key,),
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    print("Error reading the search cache:", e)
+                    row = None
+
+                if row and now - row[1] <= self.ttl:
+                    results = json.loads(row[2])
+                    self.store(key, row[1], row[0], results)
+                    self.stats["disk"] += 1
+                    return row[0], results
+
+            self.stats["miss"] += 1
+            return None
+
+    def put(self, query, results):
+        key = normalize_query(query)
+        now = time.time()
+
+        with self.lock:
+            self.store(key, now, query, results)
+            if self.connection:
+                try:
+                    with self.connection:
+                        self.connection.execute(
+                            "INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?)",
+                            (key, query, now, json.dumps(results)),
+                        )
+                except sqlite3.Error as e:
+                    print("Error writing the search cache:", e)
+
+    def store(self, key, stored_at, query, results):
+        if self.max_size <= 0:
+            return
+
+        self.entries[key] = (stored_at, query, results)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
@@ -1,24 +1,79 @@
 import json
 
 from ddgs import DDGS
+from search_cache import SearchCache
 
+search_cache = SearchCache()
 
-def web_search(query: str) -> str:
+
+def split_seen(results, seen_urls, tool_use_id):
+    # Results whose page an earlier search of the conversation already sent in full
+    new_results = []
+    seen_results = []
+
+    for result in results:
+        url = result.get("href")
+        if url and seen_urls.setdefault(url, tool_use_id) != tool_use_id:
+            seen_results.append(result)
+        else:
+            new_results.append(result)
+
+    if not new_results:
+        # Never answer with titles only, the model gets the full results again
+        for result in seen_results:
+            seen_urls[result.get("href")] = tool_use_id
+        return seen_results, []
+
+    return new_results, seen_results
+
+
+def web_search(query: str, seen_urls=None, tool_use_id=None) -> str:
     """
     Function to research and collect more information to answer the query
     Args:
         query: The query that needs to be answered or more information needs to be collected.
+        seen_urls: URLs the model already got in full in this conversation, results
+            linking to them are only listed. Updated with the newly sent URLs.
+        tool_use_id: Id of this tool call, recorded for the sent URLs.
     """
-    try:
-        results = DDGS().text(query=query, max_results=5)
-        return "\n".join([json.dumps(result) for result in results])
-    except Exception as e:
-        return f"Failed to search. Error: {e}"
+    lines = []
+    if cached := search_cache.get(query):
+        cached_query, results = cached
+        lines.append(f"(Cached results of the earlier search for {cached_query!r})")
+    else:
+        try:
+            results = DDGS().text(query=query, max_results=5)
+        except Exception as e:
+            return f"Failed to search. Error: {e}"
+        search_cache.put(query, results)
+
+    new_results, seen_results = (
+        split_seen(results, seen_urls, tool_use_id)
+        if seen_urls is not None
+        else (results, [])
+    )
+    lines.extend(json.dumps(result) for result in new_results)
+    if seen_results:
+        # A short reminder instead of sending the same results again
+        lines.append(
+            "(Already returned by earlier searches: "
+            + "; ".join(
+                f"{result.get('title')} <{result.get('href')}>"
+                for result in seen_results
+            )
+            + ")"
+        )
+
+    return "\n".join(lines)
 
 
-def call_function(tool_name, parameters):
+def call_function(tool_name, parameters, **context):
+    # The context (such as seen_urls) comes from the agent, the model can't set it
     func = globals()[tool_name]
-    output = func(**parameters)
+    model_parameters = {
+        name: value for name, value in parameters.items() if name not in context
+    }
+    output = func(**model_parameters, **context)
     return output
 
 
@@ -1,13 +1,28 @@
 import json
 import os
+import sys
 
 from ddgs import DDGS
 from dotenv import load_dotenv
 from strands import Agent, tool
 from strands.models.writer import WriterModel
 
+# Loaded first, SEARCH_CACHE_PATH is read when search_cache is imported
 load_dotenv()
 
+# Shares the search cache (normalized query keys, LRU, optional SQLite file through
+# SEARCH_CACHE_PATH) with the Bedrock web search agent example
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "../../bedrock-examples/web-search-agent",
+    )
+)
+from search_cache import SearchCache  # noqa: E402
+
+# Strands may run tools concurrently, SearchCache locks its entries
+search_cache = SearchCache()
+
 
 @tool
 def web_search(query: str) -> str:
@@ -16,11 +31,28 @@ def web_search(query: str) -> str:
     Args:
         query: The query that needs to be answered or more information needs to be collected.
     """
-    try:
-        results = DDGS().text(query=query, max_results=5)
-        return "\n".join([json.dumps(result) for result in results])
-    except Exception as e:
-        return f"Failed to search. Error: {e}"
+    lines = []
+
+    if cached := search_cache.get(query):
+        cached_query, results = cached
+        lines.append(f"(Cached results of the earlier search for {cached_query!r})")
+    else:
+        try:
+            results = DDGS().text(query=query, max_results=5)
+        except Exception as e:
+            return f"Failed to search. Error: {e}"
+
+        search_cache.put(query, results)
+
+    # The agent's conversation manager may drop earlier results, so only the
+    # duplicates within this search are left out
+    urls = set()
+    for result in results:
+        if result.get("href") not in urls:
+            lines.append(json.dumps(result))
+            urls.add(result.get("href"))
+
+    return "\n".join(lines)
 
 
 model = WriterModel(